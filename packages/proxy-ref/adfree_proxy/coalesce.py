@@ -0,0 +1,114 @@
+# adfree_proxy/coalesce.py
+
+"""
+Agrupación de peticiones idénticas concurrentes (single-flight).
+
+Cuando llegan a la vez muchas peticiones Adfree-Want para la misma URL, la
+primera (líder) hace la petición al upstream, valida la política y reescribe;
+las demás (seguidoras) esperan y reciben el HTML reescrito del líder. Solo
+se agrupan GET sin credenciales; la clave es método + URL + las cabeceras de
+la petición que suelen variar la respuesta (Cookie, Accept-Language). Si la
+respuesta del líder declara Vary sobre otras cabeceras, solo se comparte
+con las seguidoras que envían los mismos valores.
+
+La espera está acotada: si el líder no termina a tiempo, si su respuesta no
+se puede compartir (privada, Set-Cookie, demasiado grande, sin reescribir)
+o si falla, cada seguidora hace su propia petición.
+"""
+
+import asyncio
+from typing import Dict, Iterable, Optional, Tuple
+
+from .metrics import COALESCE_INFLIGHT, COALESCE_RESULT
+from .response_cache import CachedResponse, parse_cache_control
+
+# Cabeceras de la petición que forman parte de la clave por defecto
+DEFAULT_KEY_HEADERS = ('Cookie', 'Accept-Language')
+
+
+def response_is_shareable(status: int, headers) -> bool:
+    """Respuesta que se puede entregar a otros clientes además del líder."""
+    if status != 200 or 'Set-Cookie' in headers:
+        return False
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    return 'private' not in directives and 'no-store' not in directives
+
+
+class SharedResponse:
+    """HTML reescrito por el líder, listo para servir a las seguidoras."""
+
+    __slots__ = ('entry', 'policy', 'request_headers')
+
+    def __init__(self, entry: CachedResponse, policy, request_headers: Dict[str, str]):
+        self.entry = entry
+        self.policy = policy
+        self.request_headers = request_headers
+
+    def matches(self, request_headers) -> bool:
+        """La seguidora envía los mismos valores para las cabeceras del Vary."""
+        vary = self.entry.header('Vary') or ''
+        for name in vary.split(','):
+            name = name.strip().lower()
+            if not name or name == 'accept-encoding':
+                continue
+            if name == '*' or request_headers.get(name) != self.request_headers.get(name):
+                return False
+        return True
+
+
+class Flight:
+    __slots__ = ('key', 'future', 'request_headers', 'followers')
+
+    def __init__(self, key, request_headers):
+        self.key = key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.request_headers = request_headers
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self, max_wait: float = 5.0, max_body: int = 4 * 1024 * 1024,
+                 key_headers: Iterable[str] = DEFAULT_KEY_HEADERS):
+        self.max_wait = max_wait
+        self.max_body = max_body
+        self.key_headers = tuple(key_headers)
+        self._flights: Dict[Tuple, Flight] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def key(self, request, url: str) -> Optional[Tuple]:
+        """Clave de agrupación, o None si la petición no se puede agrupar."""
+        if request.method != 'GET' or 'Authorization' in request.headers or request.body_exists:
+            return None
+        return (request.method, url) + tuple(request.headers.get(name, '') for name in self.key_headers)
+
+    def join(self, key: Tuple, request_headers) -> Tuple[Flight, bool]:
+        """Vuelo en curso para la clave y si quien llama es el líder."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.followers += 1
+            return flight, False
+        flight = self._flights[key] = Flight(key, {k.lower(): v for k, v in request_headers.items()})
+        COALESCE_RESULT['leader'].inc()
+        COALESCE_INFLIGHT.set(len(self._flights))
+        return flight, True
+
+    async def wait(self, flight: Flight) -> Optional[SharedResponse]:
+        """Resultado del líder; None si no hay nada que compartir o se agota la espera."""
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.future), self.max_wait)
+        except asyncio.TimeoutError:
+            return None
+
+    def release(self, flight: Flight, shared: Optional[SharedResponse] = None) -> None:
+        """
+        Cierra el vuelo: las seguidoras reciben shared (o None y van por su
+        cuenta) y las peticiones nuevas ya no se unen a él. Se puede llamar
+        varias veces; solo cuenta la primera.
+        """
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+            COALESCE_INFLIGHT.set(len(self._flights))
+        if not flight.future.done():
+            flight.future.set_result(shared)
@@ -0,0 +1,251 @@
+# adfree_proxy/compression.py
+
+"""
+Descompresión y recompresión en streaming para el camino de reescritura.
+
+El upstream puede enviar el HTML con gzip, deflate o br. El cuerpo se
+descomprime por trozos hacia HtmlRewriter y la salida se vuelve a comprimir
+con la codificación que el cliente acepta (Accept-Encoding), al nivel
+configurado. Las respuestas que no se reescriben no pasan por aquí: se
+reenvían comprimidas tal cual.
+
+br requiere el paquete opcional ``brotli``; sin él solo se negocian gzip y
+deflate.
+"""
+
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import brotli
+except ImportError:  # Dependencia opcional
+    brotli = None
+
+from .metrics import CONTENT_ENCODING
+
+# Orden de preferencia del proxy cuando el cliente acepta varias con igual q
+SUPPORTED_ENCODINGS: Tuple[str, ...] = (('br',) if brotli is not None else ()) + ('gzip', 'deflate')
+
+# Tope de salida por llamada a zlib: una bomba de compresión no puede inflar
+# un trozo de 64 KB a cientos de MB en memoria de una vez.
+MAX_DECODED_CHUNK = 256 * 1024
+
+_ALIASES = {'x-gzip': 'gzip'}
+
+
+class CompressionError(Exception):
+    """Cuerpo comprimido corrupto o codificación no soportada."""
+
+
+class CompressionConfig:
+    """Codificaciones ofrecidas al cliente en la recompresión y su nivel."""
+
+    def __init__(self, level: int = 6, brotli_quality: int = 4,
+                 encodings: Optional[Iterable[str]] = None):
+        self.level = level
+        self.brotli_quality = brotli_quality
+        wanted = SUPPORTED_ENCODINGS if encodings is None else tuple(encodings)
+        # Las no disponibles (br sin brotli) se ignoran
+        self.encodings = tuple(e for e in wanted if e in SUPPORTED_ENCODINGS)
+
+
+def normalize_encoding(content_encoding: Optional[str]) -> str:
+    """Content-Encoding en minúsculas; 'identity' si falta."""
+    if not content_encoding:
+        return 'identity'
+    encoding = content_encoding.strip().lower()
+    return _ALIASES.get(encoding, encoding)
+
+
+def can_decode(encoding: str) -> bool:
+    return encoding == 'identity' or encoding in SUPPORTED_ENCODINGS
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """Accept-Encoding como {codificación: q}; los q inválidos cuentan como 0."""
+    prefs = {}
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        coding = _ALIASES.get(parts[0].strip().lower(), parts[0].strip().lower())
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        prefs[coding] = q
+    return prefs
+
+
+def _quality(prefs: Dict[str, float], coding: str) -> float:
+    if coding in prefs:
+        return prefs[coding]
+    if '*' in prefs:
+        return prefs['*']
+    return 1.0 if coding == 'identity' else 0.0
+
+
+def acceptable_encodings(header: Optional[str],
+                         offered: Iterable[str] = SUPPORTED_ENCODINGS) -> List[str]:
+    """Codificaciones de offered que el cliente acepta (q > 0), en orden de offered."""
+    prefs = parse_accept_encoding(header)
+    return [coding for coding in offered if _quality(prefs, coding) > 0]
+
+
+def negotiate_encoding(header: Optional[str],
+                       offered: Iterable[str] = SUPPORTED_ENCODINGS) -> Optional[str]:
+    """
+    Codificación para la respuesta: la de mayor q entre offered; a igual q
+    gana el orden de offered, y 'identity' solo si su q es mayor. None si el
+    cliente no acepta ninguna, ni siquiera identity (identity;q=0 o *;q=0):
+    hay que responder 406.
+    """
+    prefs = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in offered:
+        q = _quality(prefs, coding)
+        if q > best_q:
+            best, best_q = coding, q
+    if _quality(prefs, 'identity') > best_q:
+        return 'identity'
+    return best
+
+
+def upstream_accept_encoding(client_header: Optional[str]) -> str:
+    """
+    Accept-Encoding que se envía al upstream en el camino Adfree: solo lo que
+    el proxy sabe descomprimir y el cliente acepta, de modo que si al final
+    no hay reescritura los bytes comprimidos se pueden reenviar tal cual.
+    """
+    codings = acceptable_encodings(client_header)
+    return ', '.join(codings) if codings else 'identity'
+
+
+class StreamDecoder:
+    """Descompresor incremental; decompress() genera trozos de salida acotados."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        self._zlib = None
+        self._brotli = None
+        self._head = b''
+        if encoding == 'gzip':
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'br' and brotli is not None:
+            self._brotli = brotli.Decompressor()
+        elif encoding not in ('identity', 'deflate'):
+            raise CompressionError(f"Unsupported content-encoding: {encoding}")
+
+    def decompress(self, data: bytes) -> Iterator[bytes]:
+        if self.encoding == 'identity':
+            if data:
+                yield data
+            return
+        if self._brotli is not None:
+            try:
+                out = self._brotli.process(data)
+            except brotli.error as e:
+                raise CompressionError(f"Corrupt br body: {e}") from e
+            if out:
+                yield out
+            return
+        if self._zlib is None:
+            # deflate: según la RFC es zlib, pero hay servidores que envían
+            # deflate crudo; se distingue por la cabecera zlib (2 bytes)
+            self._head += data
+            if len(self._head) < 2:
+                return
+            data, self._head = self._head, b''
+            cmf, flg = data[0], data[1]
+            wbits = zlib.MAX_WBITS if (cmf & 0x0f) == 8 and ((cmf << 8) | flg) % 31 == 0 else -zlib.MAX_WBITS
+            self._zlib = zlib.decompressobj(wbits)
+        yield from self._inflate(data)
+
+    def _inflate(self, data: bytes) -> Iterator[bytes]:
+        try:
+            while True:
+                out = self._zlib.decompress(data, MAX_DECODED_CHUNK)
+                if out:
+                    yield out
+                if self._zlib.eof:
+                    data = self._zlib.unused_data
+                    if not data or self.encoding != 'gzip':
+                        return
+                    # gzip con varios miembros concatenados
+                    self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    continue
+                data = self._zlib.unconsumed_tail
+                if not data and len(out) < MAX_DECODED_CHUNK:
+                    return
+        except zlib.error as e:
+            raise CompressionError(f"Corrupt {self.encoding} body: {e}") from e
+
+    def flush(self) -> bytes:
+        """Resto de la salida al terminar el cuerpo (un cuerpo truncado no es error)."""
+        if self._head:
+            # deflate de menos de 2 bytes: no hay nada que descomprimir
+            self._head = b''
+        if self._zlib is not None:
+            try:
+                return self._zlib.flush()
+            except zlib.error as e:
+                raise CompressionError(f"Corrupt {self.encoding} body: {e}") from e
+        return b''
+
+
+class StreamEncoder:
+    """
+    Compresor incremental. Cada compress() hace un flush de sincronización
+    para que el cliente reciba cada trozo reescrito sin esperar al final.
+    """
+
+    def __init__(self, encoding: str, config: Optional[CompressionConfig] = None):
+        config = config or CompressionConfig()
+        self.encoding = encoding
+        self._zlib = None
+        self._brotli = None
+        if encoding == 'gzip':
+            self._zlib = zlib.compressobj(config.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._zlib = zlib.compressobj(config.level)
+        elif encoding == 'br' and brotli is not None:
+            self._brotli = brotli.Compressor(quality=config.brotli_quality)
+        elif encoding != 'identity':
+            raise CompressionError(f"Unsupported content-encoding: {encoding}")
+
+    def compress(self, data: bytes) -> bytes:
+        if not data:
+            return b''
+        if self._zlib is not None:
+            return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.flush()
+        return data
+
+    def finish(self) -> bytes:
+        if self._zlib is not None:
+            return self._zlib.flush()
+        if self._brotli is not None:
+            return self._brotli.finish()
+        return b''
+
+
+_LABELLED_ENCODINGS = frozenset({'identity', 'gzip', 'deflate', 'br'})
+_ENCODING_CHILDREN = {}
+
+
+def record_encoding(path: str, upstream: str, client: str) -> None:
+    """Cuenta la elección de codificación; valores desconocidos como 'other'."""
+    if upstream not in _LABELLED_ENCODINGS:
+        upstream = 'other'
+    if client not in _LABELLED_ENCODINGS:
+        client = 'other'
+    key = (path, upstream, client)
+    child = _ENCODING_CHILDREN.get(key)
+    if child is None:
+        child = _ENCODING_CHILDREN[key] = CONTENT_ENCODING.labels(path=path, upstream=upstream, client=client)
+    child.inc()
@@ -0,0 +1,228 @@
+# adfree_proxy/diagnostics.py
+
+"""
+Diagnóstico del event loop: retraso del loop, callbacks que lo bloquean y
+un profiler por muestreo bajo demanda.
+
+LoopMonitor programa un sleep periódico y mide cuánto tarda de más en
+volver (adfree_event_loop_lag_seconds). Un hilo vigilante comprueba que ese
+sleep no se haya pasado de plazo más de slow_callback segundos: si es así,
+el loop sigue bloqueado en ese instante y se registra la pila del hilo del
+loop y la tarea en curso, es decir, el código que lo está bloqueando.
+
+SamplingProfiler toma la pila de los hilos con sys._current_frames() a
+intervalos fijos durante N segundos y devuelve las pilas colapsadas
+("a;b;c 12" por línea), el formato de entrada de flamegraph.pl y speedscope.
+Solo existe un hilo de muestreo mientras dura un perfil, propio (no el
+executor por defecto, que comparten la caché en disco y las reglas); fuera
+de eso no cuesta nada. El muestreador necesita el GIL para leer las pilas, así que
+durante el perfil se baja sys.setswitchinterval por debajo del intervalo de
+muestreo: si no, las muestras caerían casi siempre donde el loop suelta el
+GIL (el select) y el código Python que lo ocupa quedaría infrarrepresentado.
+El intervalo entre muestras lleva además un jitter aleatorio para no
+sincronizarse con trabajo periódico del loop.
+"""
+
+import asyncio
+import hmac
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Callable, Dict, Optional
+
+from aiohttp import web
+
+from .metrics import LOOP_LAG, LOOP_STALLS
+
+logger = logging.getLogger(__name__)
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.5, slow_callback: float = 0.1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.interval = interval
+        self.slow_callback = slow_callback  # 0 desactiva el vigilante
+        self.clock = clock
+        self.max_lag = 0.0
+        self._due: Optional[float] = None  # Cuándo debería despertar el sleep en curso
+        self._reported: Optional[float] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._task = self._loop.create_task(self._run())
+        if self.slow_callback > 0:
+            self._watchdog = threading.Thread(target=self._watch, name='adfree-loop-watchdog', daemon=True)
+            self._watchdog.start()
+
+    async def _run(self) -> None:
+        while True:
+            self._due = self.clock() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, self.clock() - self._due)
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG.set(lag)
+
+    def _watch(self) -> None:
+        # Comprobar a medio umbral detecta el bloqueo mientras todavía dura
+        while not self._stopped.wait(self.slow_callback / 2):
+            due = self._due
+            if due is None or due == self._reported:
+                continue
+            overdue = self.clock() - due
+            if overdue > self.slow_callback:
+                self._reported = due  # Un aviso por bloqueo
+                LOOP_STALLS.inc()
+                logger.warning(f"Event loop blocked for {overdue * 1000:.0f} ms{self._blocker()}")
+
+    def _blocker(self) -> str:
+        """Tarea en curso y pila del hilo del loop (leídas desde el vigilante)."""
+        task = asyncio.current_task(self._loop)
+        where = f" by task {task.get_name()} ({_coro_name(task)})" if task is not None else ''
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return where
+        return where + ':\n' + ''.join(traceback.format_stack(frame, limit=20)).rstrip()
+
+    async def close(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def _coro_name(task: asyncio.Task) -> str:
+    coro = task.get_coro()
+    return getattr(coro, '__qualname__', None) or repr(coro)
+
+
+def _frame_label(code, labels: Dict[object, str]) -> str:
+    label = labels.get(code)
+    if label is None:
+        name = getattr(code, 'co_qualname', code.co_name)
+        label = labels[code] = f"{name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+    return label
+
+
+class SamplingProfiler:
+    """Profiler por muestreo de pilas; un solo perfil a la vez."""
+
+    def __init__(self, interval: float = 0.005, max_seconds: float = 60.0):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    def sample(self, seconds: float, thread_id: Optional[int] = None) -> Counter:
+        """
+        Muestrea durante seconds las pilas de thread_id (o de todos los hilos
+        menos el propio) y devuelve {pila colapsada: muestras}.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError('A profile is already running')
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, self.interval / 5))
+        try:
+            return self._sample(min(seconds, self.max_seconds), thread_id)
+        finally:
+            sys.setswitchinterval(switch_interval)
+            self._lock.release()
+
+    async def profile(self, seconds: float, thread_id: Optional[int] = None) -> Counter:
+        """sample() en un hilo creado para este perfil, sin bloquear el loop."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def settle(result, error):
+            if not future.done():
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+        def run():
+            try:
+                result, error = self.sample(seconds, thread_id), None
+            except Exception as e:
+                result, error = None, e
+            loop.call_soon_threadsafe(settle, result, error)
+
+        threading.Thread(target=run, name='adfree-profiler', daemon=True).start()
+        return await future
+
+    def _sample(self, seconds: float, thread_id: Optional[int]) -> Counter:
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        labels: Dict[object, str] = {}
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frames = sys._current_frames()
+            if thread_id is not None:
+                frames = {thread_id: frames[thread_id]} if thread_id in frames else {}
+            for ident, frame in frames.items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code, labels))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f'thread-{ident}'))
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval * random.uniform(0.5, 1.5))
+        return stacks
+
+
+def collapsed(stacks: Counter) -> str:
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+def is_admin(request: web.Request, admin_token: Optional[str]) -> bool:
+    """
+    Authorization: Bearer <admin_token>. Sin admin_token nadie es
+    administrador: en un proxy forward los navegadores que lo usan son
+    clientes locales, así que la dirección no autentica nada.
+    """
+    if not admin_token:
+        return False
+    return hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                               f'Bearer {admin_token}'.encode())
+
+
+def profile_handler(profiler: SamplingProfiler, admin_token: Optional[str] = None):
+    """
+    Handler de /debug/profile?seconds=N[&threads=all]: perfila el hilo del
+    event loop (o todos los hilos) y responde con las pilas colapsadas.
+    """
+    async def handler(request: web.Request) -> web.Response:
+        if not is_admin(request, admin_token):
+            return web.Response(status=403, text='Forbidden')
+        try:
+            seconds = float(request.query.get('seconds', 10))
+        except ValueError:
+            return web.Response(status=400, text='seconds must be a number')
+        if not 0 < seconds <= profiler.max_seconds:
+            return web.Response(status=400, text=f'seconds must be in (0, {profiler.max_seconds:g}]')
+        if profiler.running:
+            return web.Response(status=409, text='A profile is already running')
+        thread_id = None if request.query.get('threads') == 'all' else threading.get_ident()
+        try:
+            stacks = await profiler.profile(seconds, thread_id)
+        except RuntimeError as e:
+            return web.Response(status=409, text=str(e))
+        return web.Response(text=collapsed(stacks))
+
+    return handler
@@ -2,35 +2,156 @@
 
 Middleware and helpers for applying Adfree policies to upstream responses.
 This file provides a clean, self-contained implementation that expects a
-ClientSession to be injected by the caller. It uses ReportClient to send
-policy violation reports (fire-and-forget via asyncio.create_task).
+ClientSession to be injected by the caller. Requests are forwarded to the
+real upstream; responses that need no rewriting are streamed back untouched
+and HTML that does is rewritten chunk by chunk (see rewriter.py).
+It uses ReportClient to send policy violation reports (queued and sent in
+batches per report_to endpoint).
 """
 
 import asyncio
+import functools
 import logging
-import re
-import json
-from typing import Dict, Any, List, Optional
-
-from aiohttp import web, ClientSession
-
-from .policy import AdfreePolicy, validate_policy
-from .metrics import REQUEST_COUNT, BLOCKED_REQUESTS
+import math
+import os
+import time
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import urlsplit
+
+from aiohttp import web, ClientSession, ClientResponse, ClientError
+from multidict import CIMultiDict
+
+from .coalesce import SharedResponse, SingleFlight, response_is_shareable
+from .compression import (
+    CompressionConfig,
+    CompressionError,
+    StreamDecoder,
+    StreamEncoder,
+    can_decode,
+    negotiate_encoding,
+    normalize_encoding,
+    record_encoding,
+    upstream_accept_encoding,
+)
+from .keys import PublicKeyCache
+from .policy import validate_policy_header
+from .policy_cache import VerifiedPolicyCache, policy_digest
+from .policy_store import PolicyStore
+from .metrics import (
+    REQUEST_METRICS,
+    BLOCKED_REQUESTS,
+    BLOCKED_DOMAIN_LABELS,
+    COALESCE_RESULT,
+    REWRITE_BYTE,
+    REWRITE_CACHE_RESULT,
+    REWRITE_CACHE_SAVED,
+    STAGE,
+)
+from .ratelimit import RateLimiter
+from .report_only import ReportOnlyScanner
 from .reporter import ReportClient
+from .response_cache import (
+    CachedResponse,
+    ResponseCache,
+    freshness_lifetime,
+    merge_304_headers,
+    parse_cache_control,
+    request_bypasses_cache,
+    request_forces_revalidation,
+    response_is_storable,
+)
+from .rewriter import HtmlRewriter, IFRAME_BLOCKED, REDIRECT_BLOCKER_SCRIPT, SCRIPT_BLOCKED
+from .rules import RuleStore
+from .tls import UpstreamTLS
+from .upstream import (
+    STREAM_CHUNK_SIZE,
+    build_upstream_url,
+    filter_headers,
+    forward_request_headers,
+    is_forwarding_loop,
+    open_upstream,
+    stream_upstream_response,
+    targets_proxy,
+)
+from .utils import strip_port
+from .verify_pool import SignatureVerifier
+
+if TYPE_CHECKING:
+    from .schema import AdfreePolicy
 
 logger = logging.getLogger(__name__)
 
+# Report ``type`` per violation kind (the rest are reported under the kind itself)
+_REPORT_TYPES = {IFRAME_BLOCKED: 'blocked_iframe', SCRIPT_BLOCKED: 'blocked_script'}
+
 
 class AdfreeInterceptor:
-    def __init__(self, session: ClientSession):
+    def __init__(self, session: ClientSession, upstream_url: Optional[str] = None,
+                 key_cache: Optional[PublicKeyCache] = None,
+                 policy_cache: Optional[VerifiedPolicyCache] = None,
+                 verifier: Optional[SignatureVerifier] = None,
+                 reporter: Optional[ReportClient] = None,
+                 policy_store: Optional[PolicyStore] = None,
+                 compression: Optional[CompressionConfig] = None,
+                 response_cache: Optional[ResponseCache] = None,
+                 single_flight: Optional[SingleFlight] = None,
+                 rules: Optional[RuleStore] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 report_only: Optional[ReportOnlyScanner] = None,
+                 upstream_tls: Optional[UpstreamTLS] = None):
         """Create interceptor with an injected aiohttp ClientSession.
 
-        The caller owns the session lifecycle; this class will use it to send
-        reports via ReportClient.
+        The caller owns the session lifecycle; this class uses it both to
+        forward requests upstream and to send reports via ReportClient. Build
+        it with ``create_upstream_session`` to get pooled keep-alive
+        connections, DNS caching and timeouts.
+
+        ``upstream_url`` turns the proxy into a reverse proxy for a single
+        upstream; when omitted, requests go to the host they were sent to.
+        Policy keys are looked up through ``key_cache`` (one sharing the
+        session is created by default) and verified policies are memoized in
+        ``policy_cache``, which is flushed for an origin when its key rotates.
+        ``verifier`` moves signature checks to a thread or process pool; by
+        default they run inline on the event loop. ``reporter`` replaces the
+        default ReportClient (e.g. one backed by an on-disk spool).
+        ``policy_store`` bounds ``active_policies`` (LRU + TTL per origin).
+        ``compression`` sets which encodings and levels rewritten HTML is
+        re-compressed with, negotiated against the client's Accept-Encoding.
+        ``response_cache`` enables reuse of rewritten HTML for cacheable
+        GETs; without it every response goes through the rewriter.
+        ``single_flight`` collapses concurrent identical Adfree-Want GETs
+        onto one upstream fetch and rewrite.
+        ``rules`` holds the operator's local rules (extra blocked domains and
+        per-origin overrides) merged into every origin policy; it can be
+        reloaded while serving.
+        ``rate_limiter`` enforces ``bot_policy.rate_limit`` of origins with an
+        active policy per client address (the peer, or an X-Forwarded-For
+        entry when it trusts proxies in front), answering over-limit requests
+        with 402/429 before they reach the upstream.
+        ``report_only`` samples and scans pages of report-only origins after
+        they have been passed through untouched; a default scanner is used
+        when omitted.
+        ``upstream_tls`` supplies per-origin SSL contexts for https upstreams
+        (built once and reused); without it the session's connector context
+        is used for every origin.
         """
         self.session = session
-        self.reporter = ReportClient(session)
-        self.active_policies: Dict[str, AdfreePolicy] = {}
+        self.upstream_url = upstream_url
+        # Empty caches are falsy (__len__), so test for None explicitly
+        self.key_cache = key_cache if key_cache is not None else PublicKeyCache(session)
+        self.policy_cache = policy_cache if policy_cache is not None else VerifiedPolicyCache()
+        self.key_cache.on_rotate.append(self.policy_cache.invalidate_origin)
+        self.verifier = verifier
+        self.reporter = reporter or ReportClient(session)
+        self.active_policies = policy_store if policy_store is not None else PolicyStore()
+        self.key_cache.on_rotate.append(self.active_policies.pop)
+        self.compression = compression if compression is not None else CompressionConfig()
+        self.response_cache = response_cache
+        self.single_flight = single_flight
+        self.rules = rules
+        self.rate_limiter = rate_limiter
+        self.report_only = report_only if report_only is not None else ReportOnlyScanner()
+        self.upstream_tls = upstream_tls
 
     async def __aenter__(self):
         return self
@@ -41,174 +162,521 @@ class AdfreeInterceptor:
 
     @web.middleware
     async def intercept_request(self, request: web.Request, handler):
-        # Record basic metric
-        REQUEST_COUNT.labels(method=request.method, path=request.path).inc()
-
-        # If client didn't opt-in to Adfree, pass through
-        if 'Adfree-Want' not in request.headers:
-            return await handler(request)
-
-        # For this reference implementation we simulate the upstream response.
-        # In production, this should forward the request to the real upstream
-        # and apply the policy present on the upstream response.
-        response = await self._simulate_upstream_response(request)
-
-        policy_json_str = response.headers.get('Adfree-Policy')
-        signature_b64 = response.headers.get('Adfree-Signature')
-
-        if policy_json_str and signature_b64:
-            try:
-                policy_json = json.loads(policy_json_str)
-                origin = request.host
-
-                policy = await validate_policy(policy_json, signature_b64, origin)
-                if policy:
-                    self.active_policies[origin] = policy
-                    logger.info('Policy activated for %s in mode %s', origin, policy.mode)
-
-                    if policy.mode in ('strict', 'relaxed'):
-                        response = await self._apply_policy_to_response(response, policy, origin)
-                    elif policy.mode == 'report-only':
-                        # report-only: we may still want to scan the body and emit reports
-                        response = await self._apply_policy_to_response(response, policy, origin)
+        start = time.perf_counter()
+        # Local routes only answer requests aimed at the proxy itself; the same
+        # path on any other host is that origin's page and is forwarded
+        local = request.match_info.http_exception is None and targets_proxy(request)
+
+        # Record basic metric with bounded labels (never the raw path)
+        if local:
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else 'local'
+            count, latency = REQUEST_METRICS.children(request.method, route, 'local')
+        else:
+            count, latency = REQUEST_METRICS.children(request.method, 'upstream', request.host.lower())
+        count.inc()
+
+        try:
+            # Local routes of the proxy itself (/metrics, ...) are served directly
+            if local:
+                return await handler(request)
+            return await self._forward(request)
+        finally:
+            latency.observe(time.perf_counter() - start)
+
+    async def _forward(self, request: web.Request) -> web.StreamResponse:
+        if is_forwarding_loop(request):
+            return web.Response(status=508, text='Forwarding loop detected')
+        if self.rate_limiter is not None:
+            limited = self._rate_limited(request)
+            if limited is not None:
+                return limited
+
+        wants_adfree = 'Adfree-Want' in request.headers
+        url = build_upstream_url(request, self.upstream_url)
+        headers = forward_request_headers(request)
+        if wants_adfree:
+            # Only ask for encodings we can inflate for the rewrite and the
+            # client can take as-is if the body ends up passed through
+            headers['Accept-Encoding'] = upstream_accept_encoding(request.headers.get('Accept-Encoding'))
+
+        # Rewritten HTML is reused for GETs while fresh, or after a 304
+        cacheable = wants_adfree and self.response_cache is not None and request.method == 'GET'
+        cached = None
+        if cacheable and request_bypasses_cache(request.headers):
+            REWRITE_CACHE_RESULT['bypass'].inc()
+            cacheable = False
+        if cacheable:
+            cached = await self.response_cache.get(url)
+            if cached is not None:
+                policy = self._cached_policy(cached, request.host)
+                if (policy is not None and self.response_cache.is_fresh(cached)
+                        and not request_forces_revalidation(request.headers)):
+                    return self._serve_cached(request, url, cached, policy, 'hit')
+                conditional = cached.validators()
+                if conditional:
+                    # Our validators replace the client's: a 304 is answered from the cache
+                    headers.popall('If-None-Match', None)
+                    headers.popall('If-Modified-Since', None)
+                    headers.update(conditional)
                 else:
-                    logger.warning('Invalid or unsigned policy from %s', origin)
-            except Exception as e:
-                logger.exception('Error processing policy: %s', e)
-
+                    cached = None
+
+        # Identical concurrent requests wait for one leader instead of all
+        # fetching and rewriting the same page
+        flight = None
+        if wants_adfree and self.single_flight is not None:
+            key = self.single_flight.key(request, url)
+            if key is not None:
+                flight, leader = self.single_flight.join(key, request.headers)
+                if not leader:
+                    shared = await self.single_flight.wait(flight)
+                    if shared is not None and shared.matches(request.headers):
+                        COALESCE_RESULT['follower'].inc()
+                        self._record_violations(shared.entry.violations, shared.policy)
+                        return self._response_from_entry(request, shared.entry, 'coalesced')
+                    COALESCE_RESULT['fallback'].inc()
+                    flight = None
+
+        try:
+            return await self._fetch(request, url, headers, wants_adfree, cacheable, cached, flight)
+        finally:
+            if flight is not None:
+                # No-op if the result was already shared; otherwise followers go on their own
+                self.single_flight.release(flight)
+
+    def _rate_limited(self, request: web.Request) -> Optional[web.Response]:
+        """402/429 if this client is over the origin's bot rate limit, else None."""
+        entry = self.active_policies.get(request.host, count=False)
+        bot = entry.policy.bot_policy if entry is not None else None
+        bucket = bot.token_bucket if bot is not None else None
+        if bucket is None:
+            return None
+        client = self.rate_limiter.client(request.remote, request.headers.getall('X-Forwarded-For', ()))
+        retry_after = self.rate_limiter.take((request.host, client), *bucket)
+        if not retry_after:
+            return None
+        retry_after = math.ceil(retry_after)
+        headers = {'Retry-After': str(retry_after)}
+        link = bot.payment_link
+        if link is not None:
+            headers['Link'] = link
+        return web.json_response(
+            {'error': 'rate_limited', 'payment_url': bot.payment_url, 'retry_after': retry_after},
+            status=402 if bot.payment_required else 429, headers=headers)
+
+    async def _fetch(self, request: web.Request, url: str, headers: CIMultiDict, wants_adfree: bool,
+                     cacheable: bool, cached: Optional[CachedResponse], flight) -> web.StreamResponse:
+        upstream, error = await self._open_upstream(request, url, headers)
+        if error is not None:
+            return error
+
+        try:
+            if cached is not None and upstream.status == 304:
+                response = await self._revalidate_cached(request, url, upstream, cached, flight)
+                if response is not None:
+                    return response
+                # The policy changed since the body was rewritten: fetch it in full
+                REWRITE_CACHE_RESULT['refetch'].inc()
+                upstream.release()
+                for name in cached.validators():
+                    headers.popall(name, None)
+                retry, error = await self._open_upstream(request, url, headers)
+                if error is not None:
+                    return error
+                upstream = retry
+            elif cacheable:
+                REWRITE_CACHE_RESULT['miss'].inc()
+
+            policy = None
+            if wants_adfree and self._is_rewritable(upstream):
+                policy = await self._policy_from_upstream(upstream, request.host)
+                if policy is not None:
+                    policy = self._effective_policy(request.host, policy)
+
+            if policy is not None and policy.mode == 'report-only':
+                if cached is not None:
+                    self.response_cache.invalidate(url)
+                if flight is not None:
+                    self.single_flight.release(flight)
+                return await self._report_only_response(request, upstream, policy)
+
+            # Nothing to rewrite: hand the upstream body through as a stream
+            if policy is None or policy.mode not in ('strict', 'relaxed'):
+                if cached is not None:
+                    self.response_cache.invalidate(url)
+                if flight is not None:
+                    self.single_flight.release(flight)
+                encoding = normalize_encoding(upstream.headers.get('Content-Encoding'))
+                record_encoding('passthrough', encoding, encoding)
+                return await stream_upstream_response(request, upstream)
+
+            cache_url = None
+            if cacheable and response_is_storable(upstream.status, upstream.headers):
+                cache_url = url
+            elif cached is not None:
+                self.response_cache.invalidate(url)
+            if flight is not None and not response_is_shareable(upstream.status, upstream.headers):
+                self.single_flight.release(flight)
+                flight = None
+            return await self._apply_policy_to_response(request, upstream, policy, request.host, cache_url, flight)
+        finally:
+            upstream.release()
+
+    async def _report_only_response(self, request: web.Request, upstream: ClientResponse,
+                                    policy: 'AdfreePolicy') -> web.StreamResponse:
+        """Pass the upstream bytes through; a sample of pages is scanned once sent."""
+        encoding = normalize_encoding(upstream.headers.get('Content-Encoding'))
+        record_encoding('report_only', encoding, encoding)
+        page_url = str(request.url)
+        capture = self.report_only.begin(page_url, encoding, self._report_sample_rate(request.host))
+        response = await stream_upstream_response(request, upstream,
+                                                  tap=capture.feed if capture is not None else None)
+        if capture is not None:
+            self.report_only.submit(capture, self._make_rewriter(policy, request.host),
+                                    functools.partial(self._report_sampled, policy, page_url))
         return response
 
-    async def _simulate_upstream_response(self, request: web.Request) -> web.Response:
-        # This simulates an upstream response that contains a policy header.
-        policy_data = {
-            'version': '1',
-            'mode': 'report-only',
-            'max_ads_per_page': 2,
-            'allow_redirects': False,
-            'allow_iframes': ['self'],
-            'blocked_domains': ['ads.example.com', 'trackers.net'],
-            'report_to': 'http://127.0.0.1:8089/adfree'
-        }
-
-        body = b"<html><head></head><body><h1>Hello</h1><iframe src='https://ads.example.com/banner'></iframe></body></html>"
-
-        return web.Response(
-            body=body,
-            content_type='text/html',
-            headers={
-                'Adfree-Policy': json.dumps(policy_data),
-                'Adfree-Signature': 'SIMULATED_SIGNATURE',
-                'Adfree-Supported': 'true'
-            }
-        )
-
-    async def _apply_policy_to_response(self, response: web.Response, policy: AdfreePolicy, origin: str) -> web.Response:
-        if response.content_type != 'text/html':
-            return response
-
-        body = await response.read()
-        body_str = body.decode('utf-8', errors='ignore')
-
-        # Remove blocked iframes and optionally report violations
-        if getattr(policy, 'blocked_domains', None):
-            body_str = await self._remove_blocked_iframes(body_str, policy)
-
-        # Inject redirect blocker script if redirects not allowed
-        if not getattr(policy, 'allow_redirects', True):
-            body_str = self._inject_redirect_blocker(body_str)
-
-        new_body = body_str.encode('utf-8')
-
-        # Rebuild response preserving status and headers
-        new_headers = dict(response.headers)
-        # Ensure content-length matches
-        new_headers['Content-Length'] = str(len(new_body))
-
-        new_response = web.Response(
-            body=new_body,
-            content_type=response.content_type,
-            headers=new_headers,
-            status=getattr(response, 'status', 200)
-        )
+    def _report_sample_rate(self, origin: str) -> Optional[float]:
+        """Per-origin sample rate from the operator's rules, if any."""
+        if self.rules is None:
+            return None
+        rules = self.rules.current.rules_for(origin)
+        return rules.report_sample_rate if rules is not None else None
+
+    def _report_sampled(self, policy: 'AdfreePolicy', page_url: str, violations) -> None:
+        """Enqueue reports for violations found by a report-only scan."""
+        for url, rule, kind in violations:
+            self.reporter.enqueue_violation(policy, {
+                'type': _REPORT_TYPES.get(kind, kind),
+                'url': url,
+                'domain': rule,
+                'page': page_url,
+                'action': 'reported',
+            })
+
+    async def _open_upstream(self, request: web.Request, url: str, headers: CIMultiDict):
+        """Send the request upstream; returns (response, None) or (None, error response)."""
+        started = time.perf_counter()
+        try:
+            ssl_context = None
+            if self.upstream_tls is not None and url.startswith('https:'):
+                ssl_context = self.upstream_tls.context_for(urlsplit(url).hostname)
+            upstream = await open_upstream(self.session, request, url, headers, ssl_context)
+            STAGE['upstream'].observe(time.perf_counter() - started)
+            return upstream, None
+        except asyncio.TimeoutError:
+            logger.warning('Upstream timeout for %s', url)
+            return None, web.Response(status=504, text='Upstream timeout')
+        except ClientError as e:
+            logger.warning('Upstream error for %s: %s', url, e)
+            return None, web.Response(status=502, text='Bad gateway')
+
+    def _effective_policy(self, origin: str, policy: 'AdfreePolicy') -> 'AdfreePolicy':
+        """Origin policy with the operator's rules merged in."""
+        if self.rules is None:
+            return policy
+        return self.rules.current.apply(origin, policy)
+
+    def _rules_version(self) -> str:
+        return self.rules.current.version if self.rules is not None else ''
+
+    def _cached_policy(self, cached: CachedResponse, origin: str) -> Optional['AdfreePolicy']:
+        """Effective policy if it is the one the cached body was rewritten with."""
+        if cached.rules_version != self._rules_version():
+            return None
+        entry = self.active_policies.get(origin, count=False)
+        key = self.key_cache.peek(origin)
+        if (entry is not None and entry.digest == cached.policy_digest
+                and key is not None and entry.key_fingerprint == key.fingerprint):
+            return self._effective_policy(origin, entry.policy)
+        return None
 
-        return new_response
+    async def _revalidate_cached(self, request: web.Request, url: str, upstream: ClientResponse,
+                                 cached: CachedResponse, flight=None) -> Optional[web.Response]:
+        """Answer a 304 from the cache unless the origin's policy has changed."""
+        not_modified = filter_headers(upstream.headers)
+        merged = merge_304_headers(cached.headers, not_modified)
+        raw_policy, signature = merged.get('Adfree-Policy'), merged.get('Adfree-Signature')
+        if not (raw_policy and signature) or policy_digest(raw_policy, signature) != cached.policy_digest:
+            return None
+        if cached.rules_version != self._rules_version():
+            return None
+        policy = await self._policy_from_headers(merged, request.host)
+        if policy is None:
+            return None
+        policy = self._effective_policy(request.host, policy)
+        ttl = freshness_lifetime(parse_cache_control(merged.get('Cache-Control')))
+        self.response_cache.refresh(url, cached, not_modified, ttl)
+        if flight is not None:
+            self.single_flight.release(flight, SharedResponse(cached, policy, flight.request_headers))
+        return self._serve_cached(request, url, cached, policy, 'revalidated')
+
+    def _serve_cached(self, request: web.Request, url: str, cached: CachedResponse,
+                      policy: 'AdfreePolicy', result: str) -> web.Response:
+        """Build the response from a cache entry; the rewriter is not involved."""
+        REWRITE_CACHE_RESULT[result].inc()
+        REWRITE_CACHE_SAVED['rewrite'].inc(len(cached.body))
+        if result == 'hit':
+            REWRITE_CACHE_SAVED['upstream'].inc(cached.upstream_size)
+
+        # Same metrics and reports as a rewrite of the same body would produce
+        self._record_violations(cached.violations, policy)
+        response = self._response_from_entry(request, cached, 'cache', url)
+        response.headers['Age'] = str(self.response_cache.age(cached))
+        return response
 
-    async def _remove_blocked_iframes(self, html_text: str, policy: AdfreePolicy) -> str:
-        """Remove iframe tags whose src matches any blocked domain.
+    def _response_from_entry(self, request: web.Request, entry: CachedResponse, source: str,
+                             url: Optional[str] = None) -> web.Response:
+        """Response with an already rewritten body, encoded for this client."""
+        encoding = negotiate_encoding(request.headers.get('Accept-Encoding'), self.compression.encodings)
+        if encoding is None:
+            return self._not_acceptable()
+        if url is not None:
+            body = self.response_cache.encoded(url, entry, encoding, self.compression)
+        else:
+            body = entry.encoded(encoding, self.compression)
+        record_encoding(source, 'identity', encoding)
+        headers = CIMultiDict(entry.headers)
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return web.Response(status=entry.status, body=body, headers=headers)
+
+    @staticmethod
+    def _not_acceptable() -> web.Response:
+        """406 for a client that refuses identity and every encoding we offer."""
+        return web.Response(status=406, text='No acceptable content-coding', headers={'Vary': 'Accept-Encoding'})
+
+    @staticmethod
+    def _is_rewritable(upstream: ClientResponse) -> bool:
+        if upstream.content_type != 'text/html':
+            return False
+        return can_decode(normalize_encoding(upstream.headers.get('Content-Encoding')))
+
+    async def _policy_from_upstream(self, upstream: ClientResponse, origin: str) -> Optional['AdfreePolicy']:
+        return await self._policy_from_headers(upstream.headers, origin)
+
+    async def _policy_from_headers(self, headers, origin: str) -> Optional['AdfreePolicy']:
+        policy_json_str = headers.get('Adfree-Policy')
+        signature_b64 = headers.get('Adfree-Signature')
+        if not (policy_json_str and signature_b64):
+            return None
+
+        # Fast path: known origin repeating the policy it already proved, as
+        # long as the key it was verified with is still the origin's live key.
+        # Once that key expires or rotates, the policy goes through
+        # validate_policy_header again (cheap while the key is unchanged).
+        digest = policy_digest(policy_json_str, signature_b64)
+        key = self.key_cache.peek(origin)
+        if key is not None:
+            policy = self.active_policies.lookup(origin, digest, key.fingerprint)
+            if policy is not None:
+                return policy
+
+        try:
+            policy = await validate_policy_header(policy_json_str, signature_b64, origin,
+                                                  self.key_cache, self.policy_cache, self.verifier)
+            if policy:
+                key = self.key_cache.peek(origin)
+                if key is not None:
+                    ttl = self.active_policies.ttl_for(headers.get('Cache-Control'))
+                    self.active_policies.put(origin, policy, digest, ttl, key.fingerprint)
+                logger.info('Policy activated for %s in mode %s', origin, policy.mode)
+                return policy
+            logger.warning('Invalid or unsigned policy from %s', origin)
+        except Exception as e:
+            logger.exception('Error processing policy: %s', e)
+        return None
 
-        This function also schedules a report for each removed iframe when the
-        policy is in 'report-only' mode. It updates the BLOCKED_REQUESTS metric
-        for observability.
+    async def _apply_policy_to_response(self, request: web.Request, response: ClientResponse,
+                                        policy: 'AdfreePolicy', origin: str,
+                                        cache_url: Optional[str] = None, flight=None) -> web.StreamResponse:
+        """Stream the upstream body through HtmlRewriter with chunked encoding.
+
+        A compressed body is inflated chunk by chunk on the way in and the
+        output is re-compressed with the encoding negotiated from the
+        client's Accept-Encoding. Only a split tag and the codec state are
+        held between chunks, so memory stays bounded no matter how large the
+        page is. With ``cache_url`` or ``flight`` the rewritten (uncompressed)
+        output is also collected, up to the cache's entry limit or the
+        single-flight body limit, and stored in the cache or handed to the
+        waiting followers once the response is complete.
         """
-        blocked_domains = getattr(policy, 'blocked_domains', []) or []
-
-        iframe_pattern = r"<iframe\s+[^>]*src\s*=\s*(['\"])(https?://([^/\"'>]+))\1[^>]*>.*?</iframe>"
-
-        # Lista para acumular violaciones (para reportar después)
-        violations_to_report = []
-
-        def repl(match: re.Match) -> str:
-            url = match.group(2)
-            domain = match.group(3)
-
-            for blocked in blocked_domains:
-                if blocked.startswith('*.'):
-                    base = blocked[2:]
-                    if domain.endswith(base):
-                        # Registrar violación para reportar después
-                        violations_to_report.append((url, blocked))
-                        logger.info('Blocked iframe to %s (matched %s)', url, blocked)
-                        return ''  # Eliminar iframe
-                else:
-                    if domain == blocked:
-                        violations_to_report.append((url, blocked))
-                        logger.info('Blocked iframe to %s (matched %s)', url, blocked)
-                        return ''  # Eliminar iframe
-
-            return match.group(0)
-
-        # Aplicar el reemplazo síncronamente
-        cleaned = re.sub(iframe_pattern, repl, html_text, flags=re.IGNORECASE | re.DOTALL)
+        client_encoding = negotiate_encoding(request.headers.get('Accept-Encoding'), self.compression.encodings)
+        if client_encoding is None:
+            return self._not_acceptable()
+        rewriter = self._make_rewriter(policy, origin)
+        rules_version = self._rules_version()  # The one policy was built with
+        upstream_encoding = normalize_encoding(response.headers.get('Content-Encoding'))
+        decoder = StreamDecoder(upstream_encoding)
+        encoder = StreamEncoder(client_encoding, self.compression)
+        record_encoding('rewrite', upstream_encoding, client_encoding)
+
+        # Rebuild response preserving status and headers; length and encoding change
+        base_headers = filter_headers(response.headers)
+        base_headers.popall('Content-Length', None)
+        base_headers.popall('Content-Encoding', None)
+        if 'accept-encoding' not in base_headers.get('Vary', '').lower():
+            base_headers.add('Vary', 'Accept-Encoding')
+        new_headers = base_headers.copy()
+        if client_encoding != 'identity':
+            new_headers['Content-Encoding'] = client_encoding
+
+        new_response = web.StreamResponse(status=response.status, reason=response.reason, headers=new_headers)
+        new_response.enable_chunked_encoding()
+        await new_response.prepare(request)
+
+        # CPU time is split per step so codec cost can be weighed against bandwidth
+        timings = {'decompress': 0.0, 'rewrite': 0.0, 'compress': 0.0}
+        sizes = {'upstream': 0, 'decoded': 0, 'rewritten': 0, 'client': 0}
+        limits = []
+        if cache_url is not None:
+            limits.append(self.response_cache.max_entry_bytes)
+        if flight is not None:
+            limits.append(self.single_flight.max_body)
+        captured = [] if limits else None
+        try:
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                sizes['upstream'] += len(chunk)
+                await self._rewrite_chunk(new_response, decoder.decompress(chunk), rewriter, encoder,
+                                          timings, sizes, capture=captured)
+                if captured is not None and sizes['rewritten'] > max(limits):
+                    captured = None  # Too large to keep; stop holding it
+            started = time.perf_counter()
+            tail = decoder.flush()
+            timings['decompress'] += time.perf_counter() - started
+            await self._rewrite_chunk(new_response, (tail,), rewriter, encoder, timings, sizes,
+                                      final=True, capture=captured)
+        except CompressionError as e:
+            # Headers are gone already: abort so the client sees a broken
+            # transfer rather than a silently truncated page
+            logger.warning('Cannot decode %s body from %s: %s', upstream_encoding, origin, e)
+            raise
+        for step, seconds in timings.items():
+            STAGE[step].observe(seconds)
+        for step, size in sizes.items():
+            REWRITE_BYTE[step].inc(size)
+        await new_response.write_eof()
+
+        started = time.perf_counter()
+        self._record_violations(rewriter.violations, policy)
+        STAGE['report_enqueue'].observe(time.perf_counter() - started)
+
+        if captured is not None:
+            entry = self._rewritten_entry(response, base_headers, b''.join(captured),
+                                          rewriter.violations, sizes['upstream'], rules_version)
+            if flight is not None and len(entry.body) <= self.single_flight.max_body:
+                self.single_flight.release(flight, SharedResponse(entry, policy, flight.request_headers))
+            if (cache_url is not None and entry.policy_digest is not None
+                    and len(entry.body) <= self.response_cache.max_entry_bytes):
+                self.response_cache.put(cache_url, entry)
+        return new_response
 
-        # Ahora, programar las tareas de métricas y reportes (fuera de re.sub)
-        for url, domain in violations_to_report:
+    def _rewritten_entry(self, response: ClientResponse, headers: CIMultiDict, body: bytes,
+                         violations, upstream_size: int, rules_version: str) -> CachedResponse:
+        raw_policy = response.headers.get('Adfree-Policy')
+        signature = response.headers.get('Adfree-Signature')
+        digest = policy_digest(raw_policy, signature) if raw_policy and signature else None
+        now = self.response_cache.clock() if self.response_cache is not None else time.time()
+        ttl = freshness_lifetime(parse_cache_control(response.headers.get('Cache-Control')))
+        return CachedResponse(response.status, list(headers.items()), body, digest,
+                              list(violations), upstream_size, now, now + ttl, rules_version)
+
+    @staticmethod
+    async def _rewrite_chunk(new_response: web.StreamResponse, pieces, rewriter: HtmlRewriter,
+                             encoder: StreamEncoder, timings: dict, sizes: dict, final: bool = False,
+                             capture: Optional[list] = None) -> None:
+        """Run decoded pieces through the rewriter and encoder and write them out."""
+        pieces = iter(pieces)
+        while True:
+            started = time.perf_counter()
+            piece = next(pieces, None)
+            decoded = time.perf_counter()
+            timings['decompress'] += decoded - started
+            if piece is None:
+                break
+            sizes['decoded'] += len(piece)
+            out = rewriter.feed(piece)
+            rewritten = time.perf_counter()
+            timings['rewrite'] += rewritten - decoded
+            sizes['rewritten'] += len(out)
+            if capture is not None:
+                capture.append(out)
+            out = encoder.compress(out)
+            timings['compress'] += time.perf_counter() - rewritten
+            if out:
+                sizes['client'] += len(out)
+                await new_response.write(out)
+        if final:
+            started = time.perf_counter()
+            out = rewriter.close()
+            encoded = time.perf_counter()
+            timings['rewrite'] += encoded - started
+            sizes['rewritten'] += len(out)
+            if capture is not None:
+                capture.append(out)
+            out = encoder.compress(out) + encoder.finish()
+            timings['compress'] += time.perf_counter() - encoded
+            sizes['client'] += len(out)
+            if out:
+                await new_response.write(out)
+
+    @staticmethod
+    def _make_rewriter(policy: 'AdfreePolicy', origin: str) -> HtmlRewriter:
+        # Inject redirect blocker script if redirects not allowed
+        inject = None if getattr(policy, 'allow_redirects', True) else REDIRECT_BLOCKER_SCRIPT
+        # One scanner pass enforces blocked domains, allow_iframes and the ad limit
+        return HtmlRewriter(policy.blocked_matcher, inject, policy.iframe_allowlist,
+                            strip_port(origin), policy.max_ads_per_page)
+
+    def _record_violations(self, violations, policy: 'AdfreePolicy') -> None:
+        """Update BLOCKED_REQUESTS and schedule reports for removed elements."""
+        for url, domain, kind in violations:
+            logger.info('Removed %s %s (matched %s)', kind, url, domain)
             # Incrementar métrica
             try:
-                BLOCKED_REQUESTS.labels(reason='iframe_blocked', domain=domain).inc()
+                BLOCKED_REQUESTS.labels(reason=kind, domain=BLOCKED_DOMAIN_LABELS.limit(domain)).inc()
             except Exception:
                 logger.debug('Could not increment BLOCKED_REQUESTS metric')
 
             # Programar reporte si es report-only
             if getattr(policy, 'mode', '') == 'report-only' and getattr(self, 'reporter', None):
                 violation = {
-                    'type': 'blocked_iframe',
+                    'type': _REPORT_TYPES.get(kind, kind),
                     'url': url,
                     'domain': domain,
                     'action': 'blocked'
                 }
-                try:
-                    asyncio.create_task(self.reporter.report_policy_violation(policy, violation))
-                except Exception:
-                    logger.exception('Failed to schedule report_policy_violation task')
+                self.reporter.enqueue_violation(policy, violation)
 
-        return cleaned
+    async def _remove_blocked_iframes(self, html_text: str, policy: 'AdfreePolicy') -> str:
+        """Remove iframe tags whose src matches any blocked domain.
+
+        Whole-document variant of the streaming path, kept for callers that
+        already hold the decoded body. It updates the BLOCKED_REQUESTS metric
+        and schedules reports like the streaming path does.
+        """
+        rewriter = HtmlRewriter(policy.blocked_matcher)
+        cleaned = rewriter.rewrite(html_text.encode('utf-8'))
+        self._record_violations(rewriter.violations, policy)
+        return cleaned.decode('utf-8')
 
     def _inject_redirect_blocker(self, html_text: str) -> str:
-        script = (
-            '<script>'
-            '(function(){var originalOpen=window.open; window.open=function(){return null;};})();'
-            '</script>'
-        )
-
-        if '</head>' in html_text:
-            return html_text.replace('</head>', script + '</head>')
-        if '</body>' in html_text:
-            return html_text.replace('</body>', script + '</body>')
-        return html_text + script
+        rewriter = HtmlRewriter(inject_script=REDIRECT_BLOCKER_SCRIPT)
+        return rewriter.rewrite(html_text.encode('utf-8')).decode('utf-8')
 
     async def metrics_handler(self, request: web.Request) -> web.Response:
-        from prometheus_client import generate_latest
-        return web.Response(body=generate_latest())
+        from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+
+        if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+            # --workers mode: aggregate the samples written by every worker
+            from prometheus_client import multiprocess
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            body = generate_latest(registry)
+        else:
+            body = generate_latest()
+        return web.Response(body=body, headers={'Content-Type': CONTENT_TYPE_LATEST})
 
 
 class RequestInterceptor:
@@ -0,0 +1,206 @@
+# adfree_proxy/jcs.py
+
+"""
+JSON Canonicalization Scheme (RFC 8785), la forma canónica que se firma en
+Adfree-Policy.
+
+- Objetos con las claves ordenadas por unidades de código UTF-16.
+- Cadenas en UTF-8 escapando solo '"', '\\' y los caracteres de control
+  (\\b \\f \\n \\r \\t o \\u00xx en minúsculas).
+- Números como dobles IEEE 754 con el formato de Number.prototype.toString
+  de ECMAScript: 4.50 -> 4.5, 1E30 -> 1e+30, -0 -> 0, 2**60 ->
+  1152921504606847000. NaN e Infinity no son JSON válido.
+
+loads() parsea la cabecera cruda en una sola pasada dejando cada objeto
+como CanonicalDict, un dict con las claves ya en orden canónico: canonicalize()
+lo serializa sin volver a ordenar, y el mismo dict sirve para validar el
+esquema. Rechaza claves duplicadas (I-JSON, RFC 7493), que harían ambigua
+la firma. Si además no hay decimales ni enteros fuera de ±2**53 (lo normal
+en una política), el encoder en C de json ya produce exactamente la forma
+canónica y se usa en lugar del serializador en Python.
+"""
+
+import json
+from json.encoder import encode_basestring
+from operator import itemgetter
+from typing import Any, List, Union
+
+# Los enteros hasta 2**53 son dobles exactos y su forma más corta es la decimal
+_MAX_EXACT_INT = 2 ** 53
+
+_first = itemgetter(0)
+
+
+class JCSError(ValueError):
+    """El valor no tiene forma canónica JCS (NaN, claves duplicadas, surrogates sueltos...)."""
+
+
+class CanonicalDict(dict):
+    """
+    dict cuyas claves se insertaron en orden JCS; no se reordena al
+    serializar. plain (solo en la raíz que devuelve loads) indica que no
+    contiene números cuyo formato JCS difiera del de json.dumps. No debe
+    modificarse después de parsearlo.
+    """
+
+    __slots__ = ('plain',)
+
+
+def _utf16_key(key: str) -> bytes:
+    return key.encode('utf-16-be', 'surrogatepass')
+
+
+def _sorted_items(items) -> list:
+    items = sorted(items, key=_first)
+    # El orden por código de punto coincide con el de UTF-16 salvo entre
+    # U+E000..U+FFFF y los caracteres fuera del BMP (que en UTF-16 van antes)
+    if items and max(map(_first, items)) >= '\ue000':
+        items.sort(key=lambda item: _utf16_key(item[0]))
+    return items
+
+
+def format_number(value: Union[int, float]) -> str:
+    """Número en el formato de ECMAScript (RFC 8785 §3.2.2.3)."""
+    if isinstance(value, int):
+        if -_MAX_EXACT_INT <= value <= _MAX_EXACT_INT:
+            return str(int(value))
+        try:
+            value = float(value)
+        except OverflowError:
+            raise JCSError(f"Number out of range: {value}") from None
+    if value != value or value in (float('inf'), float('-inf')):
+        raise JCSError(f"{value} is not valid JSON")
+    if value == 0:
+        return '0'  # También -0
+    if value.is_integer() and -_MAX_EXACT_INT <= value <= _MAX_EXACT_INT:
+        return str(int(value))
+
+    # repr da los dígitos más cortos que recuperan el doble, como ECMAScript
+    text = repr(value)
+    sign = ''
+    if text[0] == '-':
+        sign, text = '-', text[1:]
+    mantissa, _, exponent = text.partition('e')
+    integer, _, fraction = mantissa.partition('.')
+    digits = (integer + fraction).lstrip('0')
+    # Posición del punto decimal respecto al primer dígito significativo
+    point = len(integer) + int(exponent or 0) - (len(integer + fraction) - len(digits))
+    digits = digits.rstrip('0')
+    k = len(digits)
+    if k <= point <= 21:
+        return sign + digits + '0' * (point - k)
+    if 0 < point <= 21:
+        return sign + digits[:point] + '.' + digits[point:]
+    if -6 < point <= 0:
+        return sign + '0.' + '0' * -point + digits
+    exp = point - 1
+    exp_text = f"e+{exp}" if exp >= 0 else f"e{exp}"
+    if k == 1:
+        return sign + digits + exp_text
+    return sign + digits[0] + '.' + digits[1:] + exp_text
+
+
+def _serialize(value: Any, out: List[str]) -> None:
+    if isinstance(value, str):
+        out.append(encode_basestring(value))
+    elif value is None:
+        out.append('null')
+    elif value is True:
+        out.append('true')
+    elif value is False:
+        out.append('false')
+    elif isinstance(value, dict):
+        items = value.items() if type(value) is CanonicalDict else _sorted_items(value.items())
+        out.append('{')
+        first = True
+        for key, item in items:
+            if not isinstance(key, str):
+                raise JCSError(f"Object keys must be strings, not {type(key).__name__}")
+            if not first:
+                out.append(',')
+            first = False
+            out.append(encode_basestring(key))
+            out.append(':')
+            _serialize(item, out)
+        out.append('}')
+    elif isinstance(value, (list, tuple)):
+        out.append('[')
+        for i, item in enumerate(value):
+            if i:
+                out.append(',')
+            _serialize(item, out)
+        out.append(']')
+    elif isinstance(value, (int, float)):
+        out.append(format_number(value))
+    else:
+        raise JCSError(f"{type(value).__name__} is not JSON serializable")
+
+
+# Mismo escape de cadenas que JCS; los números solo coinciden si son enteros exactos
+_plain_encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'),
+                                 allow_nan=False, check_circular=False).encode
+
+
+def canonicalize(value: Any) -> bytes:
+    """Forma canónica JCS de un valor JSON ya parseado, en UTF-8."""
+    if type(value) is CanonicalDict and getattr(value, 'plain', False):
+        text = _plain_encode(value)
+    else:
+        out: List[str] = []
+        _serialize(value, out)
+        text = ''.join(out)
+    try:
+        return text.encode('utf-8')
+    except UnicodeEncodeError:
+        raise JCSError('Lone surrogate in string') from None
+
+
+def _object_pairs(pairs: list) -> CanonicalDict:
+    obj = CanonicalDict(_sorted_items(pairs))
+    if len(obj) != len(pairs):
+        raise JCSError('Duplicate object key')
+    return obj
+
+
+def _reject_constant(name: str):
+    raise JCSError(f"{name} is not valid JSON")
+
+
+def loads(raw: Union[str, bytes]) -> Any:
+    """
+    Parsea JSON (str o bytes UTF-8) dejando los objetos como CanonicalDict.
+    Lanza JCSError (un ValueError) si no es JSON válido para JCS.
+    """
+    if isinstance(raw, (bytes, bytearray)):
+        try:
+            raw = raw.decode('utf-8')
+        except UnicodeDecodeError as e:
+            raise JCSError(f"Invalid UTF-8: {e}") from None
+    inexact = []
+
+    def parse_float(text: str) -> float:
+        inexact.append(text)
+        return float(text)
+
+    def parse_int(text: str) -> int:
+        value = int(text)
+        if not -_MAX_EXACT_INT <= value <= _MAX_EXACT_INT:
+            inexact.append(text)
+        return value
+
+    decoder = json.JSONDecoder(object_pairs_hook=_object_pairs, parse_float=parse_float,
+                               parse_int=parse_int, parse_constant=_reject_constant)
+    try:
+        value = decoder.decode(raw)
+    except JCSError:
+        raise
+    except ValueError as e:
+        raise JCSError(str(e)) from None
+    if type(value) is CanonicalDict:
+        value.plain = not inexact
+    return value
+
+
+def canonicalize_raw(raw: Union[str, bytes]) -> bytes:
+    """Forma canónica JCS directamente desde el texto JSON (p. ej. la cabecera cruda)."""
+    return canonicalize(loads(raw))
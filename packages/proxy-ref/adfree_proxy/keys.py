@@ -0,0 +1,293 @@
+# adfree_proxy/keys.py
+
+"""
+Obtención y caché de las claves públicas de política de cada origen.
+
+PublicKeyCache guarda por origen la clave publicada en
+/.well-known/adfree-policy-key con un TTL derivado de Cache-Control,
+revalida con ETag, cachea los fallos con backoff corto y agrupa las
+búsquedas concurrentes del mismo origen en una sola petición. Con una
+SharedCache, las claves obtenidas por un proceso las reutilizan los demás
+procesos del host sin volver a pedirlas al origen.
+"""
+
+import asyncio
+import base64
+import hashlib
+import logging
+import re
+import struct
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import aiohttp
+
+from .metrics import KEY_CACHE_REQUESTS
+from .shared_cache import KIND_KEY, SharedCache, entry_hash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KEY_URL_TEMPLATE = 'https://{origin}/.well-known/adfree-policy-key'
+
+# Longitudes de pem, key_id y etag, y fallos, de una clave en la caché compartida
+_SHARED_KEY = struct.Struct('<HHHI')
+
+_MAX_AGE_RE = re.compile(r'(?:^|,)\s*(s-maxage|max-age)\s*=\s*"?(\d+)"?', re.IGNORECASE)
+
+
+def _b64url_to_int(value: str) -> int:
+    padding = '=' * (-len(value) % 4)
+    return int.from_bytes(base64.urlsafe_b64decode(value + padding), 'big')
+
+
+def jwk_to_pem(jwk_data: Dict[str, Any]) -> bytes:
+    """
+    Convierte una JWK EC P-256 (o un JWK Set con una) a PEM SubjectPublicKeyInfo.
+    """
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives import serialization
+
+    if 'keys' in jwk_data:
+        jwk_data = jwk_data['keys'][0]
+    if jwk_data.get('kty') != 'EC' or jwk_data.get('crv') != 'P-256':
+        raise ValueError('Only EC P-256 keys are supported')
+
+    numbers = ec.EllipticCurvePublicNumbers(
+        _b64url_to_int(jwk_data['x']),
+        _b64url_to_int(jwk_data['y']),
+        ec.SECP256R1(),
+    )
+    return numbers.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+
+
+def parse_cache_lifetime(cache_control: Optional[str]) -> Optional[int]:
+    """
+    Segundos de frescura según Cache-Control; 0 si no se debe reutilizar sin
+    revalidar, None si la cabecera no dice nada.
+    """
+    if not cache_control:
+        return None
+    lowered = cache_control.lower()
+    if 'no-store' in lowered or 'no-cache' in lowered:
+        return 0
+    ages = {name.lower(): int(value) for name, value in _MAX_AGE_RE.findall(cache_control)}
+    if 's-maxage' in ages:
+        return ages['s-maxage']
+    return ages.get('max-age')
+
+
+class CachedKey:
+    """
+    Clave de un origen (o fallo cacheado si pem es None). key_id es el kid
+    que publica el origen, solo informativo: el origen puede reutilizarlo al
+    rotar, así que la identidad de la clave es fingerprint (sha256 del PEM).
+    """
+
+    __slots__ = ('pem', 'key_id', 'etag', 'expires_at', 'failures', 'fingerprint')
+
+    def __init__(self, pem: Optional[bytes], key_id: Optional[str], etag: Optional[str],
+                 expires_at: float, failures: int = 0):
+        self.pem = pem
+        self.fingerprint = hashlib.sha256(pem).digest() if pem else None
+        self.key_id = key_id
+        self.etag = etag
+        self.expires_at = expires_at
+        self.failures = failures
+
+    def to_bytes(self) -> bytes:
+        pem = self.pem or b''
+        key_id = (self.key_id or '').encode('utf-8')
+        etag = (self.etag or '').encode('utf-8')
+        return _SHARED_KEY.pack(len(pem), len(key_id), len(etag), self.failures) + pem + key_id + etag
+
+    @classmethod
+    def from_bytes(cls, data: bytes, expires_at: float) -> 'CachedKey':
+        pem_len, key_id_len, etag_len, failures = _SHARED_KEY.unpack_from(data)
+        pos = _SHARED_KEY.size
+        pem = data[pos:pos + pem_len]
+        pos += pem_len
+        key_id = data[pos:pos + key_id_len].decode('utf-8')
+        pos += key_id_len
+        etag = data[pos:pos + etag_len].decode('utf-8')
+        return cls(pem or None, key_id or None, etag or None, expires_at, failures)
+
+
+class PublicKeyCache:
+    """
+    Caché LRU + TTL de claves públicas por origen.
+
+    Reutiliza la ClientSession compartida del proxy. Los callbacks de
+    on_rotate reciben el origen cuando su clave cambia respecto a la última
+    clave buena (por huella, no por la entrada que haya en caché). shared
+    publica las claves obtenidas (y los fallos) para los demás procesos y se
+    consulta antes de pedir una clave al origen.
+
+    Si la renovación de una clave falla, se sigue sirviendo la última buena
+    (stale-if-error) mientras se reintenta con backoff, hasta stale_if_error
+    segundos; después se cachea el fallo.
+    """
+
+    def __init__(self,
+                 session: Optional[aiohttp.ClientSession] = None,
+                 max_entries: int = 4096,
+                 default_ttl: float = 3600.0,
+                 max_ttl: float = 86400.0,
+                 negative_ttl: float = 5.0,
+                 max_negative_ttl: float = 300.0,
+                 stale_if_error: float = 3600.0,
+                 fetch_timeout: float = 5.0,
+                 url_template: str = DEFAULT_KEY_URL_TEMPLATE,
+                 shared: Optional[SharedCache] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.session = session
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.max_negative_ttl = max_negative_ttl
+        self.stale_if_error = stale_if_error
+        self.fetch_timeout = fetch_timeout
+        self.url_template = url_template
+        self.shared = shared
+        self.clock = clock
+        self.on_rotate: List[Callable[[str], None]] = []
+        self._entries: 'OrderedDict[str, CachedKey]' = OrderedDict()
+        # origen -> huella de su última clave buena (para detectar rotaciones)
+        self._last_good: Dict[str, bytes] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, origin: str) -> Optional[bytes]:
+        """PEM de la clave del origen, o None si no se pudo obtener."""
+        entry = await self.lookup(origin)
+        return entry.pem if entry else None
+
+    async def lookup(self, origin: str) -> Optional[CachedKey]:
+        entry = self._entries.get(origin)
+        if entry is not None and entry.expires_at > self.clock():
+            self._entries.move_to_end(origin)
+            KEY_CACHE_REQUESTS.labels(result='hit' if entry.pem else 'negative_hit').inc()
+            return entry if entry.pem else None
+
+        if self.shared is not None:
+            shared = self._from_shared(origin)
+            if shared is not None:
+                KEY_CACHE_REQUESTS.labels(result='shared_hit').inc()
+                self._adopt(origin, shared)
+                return shared if shared.pem else None
+
+        task = self._inflight.get(origin)
+        if task is None:
+            KEY_CACHE_REQUESTS.labels(result='miss').inc()
+            task = asyncio.ensure_future(self._refresh(origin, entry))
+            self._inflight[origin] = task
+            task.add_done_callback(lambda _: self._inflight.pop(origin, None))
+        else:
+            KEY_CACHE_REQUESTS.labels(result='coalesced').inc()
+
+        # shield: cancelar a un solicitante no cancela la petición compartida
+        entry = await asyncio.shield(task)
+        return entry if entry.pem else None
+
+    def peek(self, origin: str) -> Optional[CachedKey]:
+        """Clave vigente del origen en la caché local, sin pedirla ni contarla en métricas."""
+        entry = self._entries.get(origin)
+        if entry is not None and entry.pem and entry.expires_at > self.clock():
+            return entry
+        return None
+
+    def invalidate(self, origin: str) -> None:
+        self._entries.pop(origin, None)
+
+    def _from_shared(self, origin: str) -> Optional[CachedKey]:
+        found = self.shared.get(KIND_KEY, entry_hash(KIND_KEY, origin.encode('utf-8')))
+        if found is None:
+            return None
+        data, expires_at = found
+        # La caducidad compartida es de reloj de pared; la local, de self.clock
+        return CachedKey.from_bytes(data, self.clock() + (expires_at - self.shared.clock()))
+
+    def _publish(self, origin: str, entry: CachedKey) -> None:
+        expires_at = self.shared.clock() + (entry.expires_at - self.clock())
+        self.shared.put(KIND_KEY, entry_hash(KIND_KEY, origin.encode('utf-8')), entry.to_bytes(), expires_at)
+
+    def _adopt(self, origin: str, entry: CachedKey) -> None:
+        if entry.pem:
+            last_good = self._last_good.get(origin)
+            if last_good is not None and entry.fingerprint != last_good:
+                logger.info(f"Policy key rotated for {origin}")
+                for callback in self.on_rotate:
+                    callback(origin)
+            self._last_good[origin] = entry.fingerprint
+        self._store(origin, entry)
+
+    def _store(self, origin: str, entry: CachedKey) -> None:
+        self._entries[origin] = entry
+        self._entries.move_to_end(origin)
+        while len(self._entries) > self.max_entries:
+            evicted, _ = self._entries.popitem(last=False)
+            self._last_good.pop(evicted, None)
+
+    def _backoff(self, failures: int) -> float:
+        return min(self.negative_ttl * 2 ** (failures - 1), self.max_negative_ttl)
+
+    def _ttl(self, cache_control: Optional[str]) -> float:
+        lifetime = parse_cache_lifetime(cache_control)
+        if lifetime is None:
+            return self.default_ttl
+        return min(float(lifetime), self.max_ttl)
+
+    async def _refresh(self, origin: str, previous: Optional[CachedKey]) -> CachedKey:
+        url = self.url_template.format(origin=origin)
+        etag = previous.etag if previous is not None and previous.pem else None
+        headers = {'Accept': 'application/jwk+json, application/json'}
+        if etag:
+            headers['If-None-Match'] = etag
+
+        try:
+            if self.session is not None:
+                entry = await self._fetch(self.session, origin, url, headers, previous)
+            else:
+                async with aiohttp.ClientSession() as session:
+                    entry = await self._fetch(session, origin, url, headers, previous)
+        except Exception as e:
+            logger.error(f"Error fetching public key from {url}: {e}")
+            entry = None
+
+        if entry is None:
+            failures = (previous.failures if previous is not None else 0) + 1
+            expires_at = self.clock() + self._backoff(failures)
+            stale_for = sum(self._backoff(n) for n in range(1, failures + 1))
+            if previous is not None and previous.pem and stale_for <= self.stale_if_error:
+                # Un fallo pasajero del origen no invalida la última clave buena
+                logger.warning(f"Serving the last good key for {origin} after {failures} failed refreshes")
+                entry = CachedKey(previous.pem, previous.key_id, previous.etag, expires_at, failures)
+            else:
+                entry = CachedKey(None, None, None, expires_at, failures)
+
+        self._adopt(origin, entry)
+        if self.shared is not None:
+            self._publish(origin, entry)
+        return entry
+
+    async def _fetch(self, session: aiohttp.ClientSession, origin: str, url: str,
+                     headers: Dict[str, str], previous: Optional[CachedKey]) -> Optional[CachedKey]:
+        timeout = aiohttp.ClientTimeout(total=self.fetch_timeout)
+        async with session.get(url, headers=headers, timeout=timeout) as resp:
+            ttl = self._ttl(resp.headers.get('Cache-Control'))
+            if resp.status == 304 and previous is not None and previous.pem:
+                return CachedKey(previous.pem, previous.key_id, previous.etag, self.clock() + ttl)
+            if resp.status != 200:
+                logger.error(f"Failed to fetch key from {url}: {resp.status}")
+                return None
+            jwk_data = await resp.json(content_type=None)
+            if 'keys' in jwk_data:
+                jwk_data = jwk_data['keys'][0]
+            pem = jwk_to_pem(jwk_data)
+            return CachedKey(pem, jwk_data.get('kid'), resp.headers.get('ETag'), self.clock() + ttl)
@@ -3,47 +3,468 @@
 import asyncio
 import argparse
 import logging
-from aiohttp import web, ClientSession
-from .interceptor import AdfreeInterceptor
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+from aiohttp import web
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def main():
+# Los módulos del proxy (y con ellos prometheus_client) se importan dentro de
+# serve(): en modo --workers el supervisor tiene que fijar
+# PROMETHEUS_MULTIPROC_DIR antes de que prometheus_client se cargue.
+
+
+# Claves de config.yaml cuyo destino en argparse no es su propio nombre
+_CONFIG_KEYS = {
+    ('policy', 'rules_path'): 'rules',
+    ('policy', 'rules_poll_interval'): 'rules_poll_interval',
+}
+
+
+def load_config(path: str) -> dict:
+    """
+    Lee config.yaml y lo convierte en valores por defecto de argparse: cada
+    clave de una sección (server.port, ...) equivale al flag del mismo
+    nombre. Las rutas relativas de reglas son relativas al propio fichero.
+    """
+    import yaml
+
+    with open(path) as f:
+        data = yaml.safe_load(f) or {}
+    defaults = {}
+    for section, values in data.items():
+        if not isinstance(values, dict):
+            continue
+        for key, value in values.items():
+            defaults[_CONFIG_KEYS.get((section, key), key.replace('-', '_'))] = value
+    rules = defaults.get('rules')
+    if rules and not os.path.isabs(rules):
+        defaults['rules'] = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(path)), rules))
+    return defaults
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(description="Adfree Protocol Reference Proxy")
+    parser.add_argument('--config', default=None,
+                        help='YAML config file (e.g. config.yaml); command-line flags take precedence')
     parser.add_argument('--host', default='127.0.0.1', help='Host to bind')
     parser.add_argument('--port', type=int, default=8080, help='Port to bind')
     parser.add_argument('--mode', choices=['transparent', 'tls-terminator'], default='transparent')
-    args = parser.parse_args()
+    parser.add_argument('--tls-cert', default=None,
+                        help='Default certificate (PEM) for --mode tls-terminator')
+    parser.add_argument('--tls-key', default=None, help='Private key of --tls-cert (if not in the same file)')
+    parser.add_argument('--tls-cert-dir', default=None,
+                        help='Directory of certificates selected by SNI (name.pem, or name.crt + name.key)')
+    parser.add_argument('--tls-session-tickets', type=int, default=2,
+                        help='TLS 1.3 session tickets issued per handshake (0 disables tickets)')
+    parser.add_argument('--upstream-ca-file', default=None,
+                        help='CA bundle used to verify https upstreams (system CAs by default)')
+    parser.add_argument('--upstream-ca-dir', default=None,
+                        help='Directory of per-origin CA bundles (<host>.pem) for https upstreams')
+    parser.add_argument('--upstream', default=None,
+                        help='Upstream base URL (reverse proxy); by default the request Host is used')
+    parser.add_argument('--pool-size', type=int, default=256, help='Max upstream connections')
+    parser.add_argument('--pool-size-per-host', type=int, default=32, help='Max connections per upstream')
+    parser.add_argument('--keepalive-timeout', type=float, default=30.0, help='Idle keep-alive (s)')
+    parser.add_argument('--dns-cache-ttl', type=int, default=300, help='DNS cache TTL (s)')
+    parser.add_argument('--connect-timeout', type=float, default=5.0, help='Upstream connect timeout (s)')
+    parser.add_argument('--read-timeout', type=float, default=30.0, help='Upstream read timeout (s)')
+    parser.add_argument('--key-url-template', default='https://{origin}/.well-known/adfree-policy-key',
+                        help='URL of the policy key; {origin} is replaced by the request host')
+    parser.add_argument('--verify-mode', choices=('inline', 'thread', 'process'), default='inline',
+                        help='Where policy signatures are verified')
+    parser.add_argument('--verify-workers', type=int, default=None, help='Verification pool size')
+    parser.add_argument('--verify-max-pending', type=int, default=1024,
+                        help='Max queued verifications before callers wait')
+    parser.add_argument('--spool-dir', default=None,
+                        help='Directory for undeliverable reports (disabled by default)')
+    parser.add_argument('--spool-max-mb', type=int, default=256, help='Max size of the report spool (MB)')
+    parser.add_argument('--report-max-endpoints', type=int, default=256,
+                        help='Max report_to endpoints batched at once (least recently used is flushed first)')
+    parser.add_argument('--compress-encodings', default='br,gzip,deflate',
+                        help='Encodings offered for rewritten HTML, in order of preference '
+                             '(br needs the brotli package; empty = always identity)')
+    parser.add_argument('--compress-level', type=int, default=6, choices=range(0, 10), metavar='0-9',
+                        help='gzip/deflate level for rewritten HTML')
+    parser.add_argument('--brotli-quality', type=int, default=4, choices=range(0, 12), metavar='0-11',
+                        help='Brotli quality for rewritten HTML')
+    parser.add_argument('--response-cache-mb', type=int, default=0,
+                        help='In-memory cache of rewritten HTML (MB; 0 disables it)')
+    parser.add_argument('--response-cache-dir', default=None,
+                        help='Optional on-disk tier for the rewritten HTML cache')
+    parser.add_argument('--response-cache-disk-mb', type=int, default=1024,
+                        help='Max size of the on-disk rewritten HTML cache (MB)')
+    parser.add_argument('--coalesce-wait', type=float, default=5.0,
+                        help='Max seconds identical concurrent requests wait for a leader (0 disables coalescing)')
+    parser.add_argument('--rules', default=None,
+                        help='Operator rules file (JSON or YAML); reloaded on change or SIGHUP')
+    parser.add_argument('--rules-poll-interval', type=float, default=2.0,
+                        help='Seconds between rules file change checks (0: only on SIGHUP)')
+    parser.add_argument('--report-sample-rate', type=float, default=0.1,
+                        help='Fraction of report-only pages scanned for violations (per-origin in the rules file)')
+    parser.add_argument('--report-cpu-budget', type=float, default=0.05,
+                        help='CPU seconds per second available to report-only scans')
+    parser.add_argument('--report-dedupe-window', type=float, default=600.0,
+                        help='Seconds during which a repeated violation on the same page is not reported again')
+    parser.add_argument('--rate-limit-buckets', type=int, default=100000,
+                        help='Max (origin, client) buckets for bot_policy.rate_limit (0 disables rate limiting)')
+    parser.add_argument('--rate-limit-forwarded-hops', type=int, default=0,
+                        help='Trusted proxies in front that append to X-Forwarded-For; rate limits then key on '
+                             'the client address they saw (0: the peer address)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--shared-cache-slots', type=int, default=16384,
+                        help='Slots of the key/policy cache shared by the workers (0 disables it)')
+    parser.add_argument('--shared-cache-path', default=None,
+                        help='File backing the shared cache, to share it between separately started proxies '
+                             '(by default an anonymous file, and only with --workers > 1)')
+    parser.add_argument('--metrics-dir', default=None,
+                        help='Prometheus multiprocess directory (--workers > 1; a temp dir by default)')
+    parser.add_argument('--shutdown-timeout', type=float, default=30.0,
+                        help='Seconds to drain in-flight requests on SIGTERM')
+    parser.add_argument('--uvloop', action='store_true', help='Use uvloop if it is installed')
+    parser.add_argument('--loop-lag-interval', type=float, default=0.5,
+                        help='Seconds between event loop lag samples (0 disables the loop monitor)')
+    parser.add_argument('--slow-callback', type=float, default=0.1,
+                        help='Log the stack of anything blocking the event loop longer than this (s; 0 disables)')
+    parser.add_argument('--admin-token', default=None,
+                        help='Bearer token for /debug/profile (the endpoint is disabled without it)')
+
+    args = parser.parse_args(argv)
+    if args.config:
+        defaults = load_config(args.config)
+        unknown = sorted(set(defaults) - set(vars(args)))
+        if unknown:
+            logger.warning(f"Ignoring unknown keys in {args.config}: {', '.join(unknown)}")
+        parser.set_defaults(**{k: v for k, v in defaults.items() if k not in unknown})
+        args = parser.parse_args(argv)
+    if args.mode == 'tls-terminator' and not (args.tls_cert or args.tls_cert_dir):
+        parser.error('--mode tls-terminator needs --tls-cert or --tls-cert-dir')
+    return args
+
+
+def load_certificates(args):
+    """CertificateStore con el certificado por defecto y los de --tls-cert-dir."""
+    from .tls import CertificateStore
+
+    store = CertificateStore(session_tickets=args.tls_session_tickets)
+    if args.tls_cert:
+        store.add(args.tls_cert, args.tls_key, default=True)
+    if args.tls_cert_dir:
+        store.load_directory(args.tls_cert_dir)
+    if store.default is None:
+        raise ValueError(f"No usable certificates in {args.tls_cert_dir}")
+    return store
 
-    # Crear sesión HTTP reutilizable
-    session = ClientSession()
+
+def open_shared_cache(args):
+    """SharedCache de claves y políticas, o None si no procede."""
+    from .shared_cache import SharedCache
+
+    if args.shared_cache_slots <= 0 or (args.shared_cache_path is None and args.workers <= 1):
+        return None
+    return SharedCache(args.shared_cache_path, slots=args.shared_cache_slots)
+
+
+async def serve(args, sock: socket.socket = None, worker_id: int = None, shared_cache=None):
+    """
+    Arranca el proxy en el loop actual hasta recibir SIGTERM/SIGINT.
+    Los workers reciben la caché compartida ya abierta por el supervisor.
+    """
+    from .coalesce import SingleFlight
+    from .diagnostics import LoopMonitor, SamplingProfiler, profile_handler
+    from .compression import CompressionConfig
+    from .interceptor import AdfreeInterceptor
+    from .keys import PublicKeyCache
+    from .policy import preload as preload_policy_support
+    from .policy_cache import VerifiedPolicyCache
+    from .reporter import ReportClient
+    from .response_cache import ResponseCache
+    from .ratelimit import RateLimiter
+    from .report_only import ReportOnlyScanner
+    from .rules import RuleStore
+    from .spool import ReportSpool
+    from .tls import TLSSite, UpstreamTLS
+    from .upstream import UpstreamConfig, create_upstream_session
+    from .verify_pool import SignatureVerifier
+
+    # Los certificados se cargan antes de nada: un error aborta el arranque
+    certificates = load_certificates(args) if args.mode == 'tls-terminator' else None
+    upstream_tls = UpstreamTLS(ca_file=args.upstream_ca_file, ca_dir=args.upstream_ca_dir)
+
+    # Crear sesión HTTP reutilizable (pool keep-alive hacia los upstreams)
+    session = create_upstream_session(UpstreamConfig(
+        limit=args.pool_size,
+        limit_per_host=args.pool_size_per_host,
+        keepalive_timeout=args.keepalive_timeout,
+        ttl_dns_cache=args.dns_cache_ttl,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        ssl_context=upstream_tls.default,
+    ))
 
     # Crear interceptor con la sesión
-    interceptor = AdfreeInterceptor(session)
+    owns_shared_cache = shared_cache is None
+    if owns_shared_cache:
+        shared_cache = open_shared_cache(args)
+    key_cache = PublicKeyCache(session, url_template=args.key_url_template, shared=shared_cache)
+    verifier = SignatureVerifier(args.verify_mode, max_workers=args.verify_workers,
+                                 max_pending=args.verify_max_pending)
+    spool = None
+    if args.spool_dir:
+        # Cada worker escribe y drena su propio subdirectorio
+        spool_dir = args.spool_dir if worker_id is None else os.path.join(args.spool_dir, f'worker-{worker_id}')
+        spool = ReportSpool(spool_dir, max_bytes=args.spool_max_mb * 1024 * 1024)
+    reporter = ReportClient(session, max_endpoints=args.report_max_endpoints, spool=spool)
+    reporter.start()
+    compression = CompressionConfig(
+        level=args.compress_level,
+        brotli_quality=args.brotli_quality,
+        encodings=[e.strip() for e in args.compress_encodings.split(',') if e.strip()],
+    )
+    rules = None
+    if args.rules:
+        rules = RuleStore(args.rules, poll_interval=args.rules_poll_interval)
+        rules.load()
+        rules.start()
+
+    response_cache = None
+    if args.response_cache_mb > 0:
+        cache_dir = args.response_cache_dir
+        if cache_dir and worker_id is not None:
+            cache_dir = os.path.join(cache_dir, f'worker-{worker_id}')
+        response_cache = ResponseCache(max_bytes=args.response_cache_mb * 1024 * 1024, directory=cache_dir,
+                                       max_disk_bytes=args.response_cache_disk_mb * 1024 * 1024)
+    interceptor = AdfreeInterceptor(session, upstream_url=args.upstream, key_cache=key_cache,
+                                    policy_cache=VerifiedPolicyCache(shared=shared_cache),
+                                    verifier=verifier, reporter=reporter, compression=compression,
+                                    response_cache=response_cache,
+                                    single_flight=SingleFlight(args.coalesce_wait) if args.coalesce_wait > 0 else None,
+                                    rules=rules,
+                                    rate_limiter=RateLimiter(args.rate_limit_buckets,
+                                                             forwarded_hops=args.rate_limit_forwarded_hops)
+                                    if args.rate_limit_buckets > 0 else None,
+                                    report_only=ReportOnlyScanner(args.report_sample_rate, args.report_cpu_budget,
+                                                                  args.report_dedupe_window),
+                                    upstream_tls=upstream_tls)
 
     # Crear app y registrar middleware
     app = web.Application(middlewares=[interceptor.intercept_request])
 
     # Ruta para métricas Prometheus
     app.router.add_get('/metrics', interceptor.metrics_handler)
+    # Perfil bajo demanda (solo con --admin-token): pilas colapsadas para flame graphs
+    if args.admin_token:
+        app.router.add_get('/debug/profile', profile_handler(SamplingProfiler(), args.admin_token))
 
-    runner = web.AppRunner(app)
+    runner = web.AppRunner(app, shutdown_timeout=args.shutdown_timeout)
     await runner.setup()
-    site = web.TCPSite(runner, args.host, args.port)
+    if certificates is not None:
+        if sock is None:
+            sock = socket.create_server((args.host, args.port), reuse_port=args.workers > 1)
+        site = TLSSite(runner, sock, certificates)
+    elif sock is not None:
+        site = web.SockSite(runner, sock)
+    else:
+        site = web.TCPSite(runner, args.host, args.port, reuse_port=args.workers > 1)
     await site.start()
 
-    logger.info(f"Adfree Proxy running on http://{args.host}:{args.port}")
-    logger.info(f"Metrics available at http://{args.host}:{args.port}/metrics")
+    scheme = 'https' if certificates is not None else 'http'
+    if worker_id is None:
+        logger.info(f"Adfree Proxy running on {scheme}://{args.host}:{args.port}")
+        logger.info(f"Metrics available at {scheme}://{args.host}:{args.port}/metrics")
+    else:
+        logger.info(f"Worker {worker_id} (pid {os.getpid()}) serving on {scheme}://{args.host}:{args.port}")
+
+    loop = asyncio.get_running_loop()
+    # pydantic y cryptography se importan con el proxy ya escuchando y fuera del loop
+    loop.run_in_executor(None, preload_policy_support)
+
+    loop_monitor = None
+    if args.loop_lag_interval > 0:
+        loop_monitor = LoopMonitor(args.loop_lag_interval, args.slow_callback)
+        loop_monitor.start()
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    if rules is not None:
+        # SIGHUP: recargar las reglas sin cortar conexiones
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(rules.reload()))
 
     # Keep alive
     try:
-        await asyncio.Event().wait()
-    except KeyboardInterrupt:
-        pass
+        await stop.wait()
     finally:
-        await session.close()  # Cerrar sesión
+        # Deja de aceptar conexiones y espera a las requests en curso
         await runner.cleanup()
+        if loop_monitor is not None:
+            await loop_monitor.close()
+        if rules is not None:
+            await rules.close()
+        await interceptor.report_only.close()
+        await interceptor.reporter.close()  # Vaciar reportes pendientes
+        if response_cache is not None:
+            await response_cache.close()  # Terminar escrituras en disco
+        await session.close()  # Cerrar sesión
+        verifier.close()
+        if shared_cache is not None and owns_shared_cache:
+            shared_cache.close()
+
+
+async def main():
+    await serve(parse_args())
+
+
+def _install_event_loop(use_uvloop: bool):
+    if not use_uvloop:
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning("uvloop requested but not installed; using the default asyncio loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def _prepare_metrics_dir(path: str = None) -> str:
+    path = path or tempfile.mkdtemp(prefix='adfree-metrics-')
+    os.makedirs(path, exist_ok=True)
+    # Ficheros de una ejecución anterior falsearían los totales
+    for name in os.listdir(path):
+        if name.endswith('.db'):
+            os.remove(os.path.join(path, name))
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = path
+    return path
+
+
+class Supervisor:
+    """
+    Proceso padre del modo --workers: crea los workers con fork, los
+    reinicia si mueren y, con SIGTERM, los drena de forma ordenada.
+
+    Con SO_REUSEPORT cada worker abre su propio socket y el kernel reparte
+    las conexiones; sin él, el supervisor abre el socket y los workers lo
+    heredan.
+    """
+
+    MAX_RESTARTS_PER_MINUTE = 10
+
+    def __init__(self, args):
+        self.args = args
+        self.workers = {}  # pid -> worker_id
+        self.stopping = False
+        self.restarts = []
+        self.sock = None
+        # Se abre antes del fork: todos los workers comparten el mismo mmap
+        self.shared_cache = open_shared_cache(args)
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            self.sock = socket.create_server((args.host, args.port), reuse_port=False)
+            self.sock.set_inheritable(True)
+
+    def spawn(self, worker_id: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)  # serve() instala su handler
+                _install_event_loop(self.args.uvloop)
+                asyncio.run(serve(self.args, sock=self.sock, worker_id=worker_id,
+                                  shared_cache=self.shared_cache))
+            except SystemExit as e:
+                # sys.exit() no es un fallo: se respeta su código
+                code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+            except KeyboardInterrupt:
+                code = 128 + signal.SIGINT
+            except Exception:
+                logger.exception(f"Worker {worker_id} crashed")
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = worker_id
+
+    def _terminate(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _reload(self, signum, frame):
+        # Cada worker recarga sus reglas
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> int:
+        signal.signal(signal.SIGTERM, self._terminate)
+        signal.signal(signal.SIGINT, self._terminate)
+        signal.signal(signal.SIGHUP, self._reload)
+        for worker_id in range(self.args.workers):
+            self.spawn(worker_id)
+        scheme = 'https' if self.args.mode == 'tls-terminator' else 'http'
+        logger.info(f"Adfree Proxy running on {scheme}://{self.args.host}:{self.args.port} "
+                    f"with {self.args.workers} workers")
+
+        # Sin bloquear en waitpid: tras un SIGTERM el handler vuelve y un
+        # waitpid(-1, 0) seguiría esperando aunque un worker no termine nunca
+        deadline = None
+        while self.workers:
+            if self.stopping and deadline is None:
+                deadline = time.monotonic() + self.args.shutdown_timeout + 5
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                if deadline is not None and time.monotonic() > deadline:
+                    for pid in list(self.workers):
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except ProcessLookupError:
+                            pass
+                time.sleep(0.1 if deadline is not None else 0.5)
+                continue
+            self._reap(pid, status)
+        return 0
+
+    def _reap(self, pid: int, status: int):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
+
+        worker_id = self.workers.pop(pid, None)
+        if worker_id is None or self.stopping:
+            return
+        logger.warning(f"Worker {worker_id} (pid {pid}) exited with status {status}; restarting")
+        now = time.monotonic()
+        self.restarts = [t for t in self.restarts if now - t < 60] + [now]
+        if len(self.restarts) > self.MAX_RESTARTS_PER_MINUTE:
+            logger.error("Workers are crash-looping; shutting down")
+            self._terminate(None, None)
+            return
+        self.spawn(worker_id)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    if args.workers <= 1:
+        _install_event_loop(args.uvloop)
+        asyncio.run(serve(args))
+        return 0
+
+    metrics_dir = _prepare_metrics_dir(args.metrics_dir)
+    logger.info(f"Prometheus multiprocess metrics in {metrics_dir}")
+    return Supervisor(args).run()
+
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    sys.exit(run())
@@ -0,0 +1,120 @@
+# adfree_proxy/matcher.py
+
+"""
+Matcher compilado de dominios bloqueados.
+
+DomainMatcher compila una lista de blocked_domains ("ads.example.com",
+"*.trackers.net") en dos conjuntos hash: dominios exactos y sufijos
+comodín. Una consulta cuesta O(número de etiquetas) del dominio consultado,
+independientemente del tamaño de la lista, y los comodines solo casan en
+límite de etiqueta: "*.ads.example.com" bloquea "ads.example.com" y
+"x.ads.example.com", pero no "evilads.example.com".
+
+MatcherChain consulta varios matchers ya compilados en orden (la política
+del origen y las listas del operador) sin fusionarlos en uno nuevo.
+
+IframeAllowlist reutiliza DomainMatcher para los hosts de allow_iframes.
+"""
+
+from typing import Dict, Iterable, Optional
+from urllib.parse import urlsplit
+
+
+def _normalize(domain: str) -> str:
+    return domain.strip().lower().rstrip('.')
+
+
+class DomainMatcher:
+    __slots__ = ('_exact', '_wildcards')
+
+    def __init__(self, blocked_domains: Iterable[str] = ()):
+        # dominio normalizado -> regla original (para métricas y reportes)
+        self._exact: Dict[str, str] = {}
+        self._wildcards: Dict[str, str] = {}
+        for rule in blocked_domains:
+            if rule.startswith('*.'):
+                self._wildcards.setdefault(_normalize(rule[2:]), rule)
+            else:
+                self._exact.setdefault(_normalize(rule), rule)
+
+    def __len__(self) -> int:
+        return len(self._exact) + len(self._wildcards)
+
+    def __bool__(self) -> bool:
+        return bool(self._exact or self._wildcards)
+
+    def match(self, domain: str) -> Optional[str]:
+        """Devuelve la regla que bloquea domain, o None."""
+        domain = _normalize(domain)
+        rule = self._exact.get(domain)
+        if rule is not None:
+            return rule
+        if not self._wildcards:
+            return None
+        # Recorre los sufijos en límite de etiqueta, del más específico al más general
+        suffix = domain
+        while True:
+            rule = self._wildcards.get(suffix)
+            if rule is not None:
+                return rule
+            dot = suffix.find('.')
+            if dot == -1:
+                return None
+            suffix = suffix[dot + 1:]
+
+
+class MatcherChain:
+    """Varios DomainMatcher como uno: la primera regla que casa."""
+
+    __slots__ = ('_matchers',)
+
+    def __init__(self, *matchers: DomainMatcher):
+        self._matchers = tuple(m for m in matchers if m)
+
+    def __len__(self) -> int:
+        return sum(len(m) for m in self._matchers)
+
+    def __bool__(self) -> bool:
+        return bool(self._matchers)
+
+    def match(self, domain: str) -> Optional[str]:
+        for matcher in self._matchers:
+            rule = matcher.match(domain)
+            if rule is not None:
+                return rule
+        return None
+
+
+class IframeAllowlist:
+    """
+    allow_iframes compilado: 'self' (mismo host que el origen), hosts o URLs
+    ("https://cdn.example.org", "*.example.net") y '*' para permitir todos.
+    """
+
+    __slots__ = ('allow_all', 'allow_self', 'hosts')
+
+    def __init__(self, entries: Iterable[str] = ('self',)):
+        hosts = []
+        self.allow_all = False
+        self.allow_self = False
+        for entry in entries:
+            entry = entry.strip()
+            if entry == '*':
+                self.allow_all = True
+            elif entry.lower() == 'self':
+                self.allow_self = True
+            elif '://' in entry:
+                host = urlsplit(entry).hostname
+                if host:
+                    hosts.append(host)
+            elif entry:
+                hosts.append(entry)
+        self.hosts = DomainMatcher(hosts)
+
+    def allows(self, host: Optional[str], origin_host: Optional[str]) -> bool:
+        """host None es un src relativo (mismo origen)."""
+        if self.allow_all:
+            return True
+        if host is None or (origin_host is not None and _normalize(host) == _normalize(origin_host)):
+            return self.allow_self
+        return self.hosts.match(host) is not None
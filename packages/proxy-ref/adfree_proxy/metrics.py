@@ -1,12 +1,16 @@
 # adfree_proxy/metrics.py
 
-from prometheus_client import Counter, Histogram
+from typing import Dict, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
 
 # Métricas clave
+# route: recurso local ('/metrics') o 'upstream'; origin: host acotado por
+# LabelLimiter. Nunca se etiqueta con la URL cruda (cardinalidad sin límite).
 REQUEST_COUNT = Counter(
     'adfree_requests_total',
     'Total de requests procesadas por el proxy',
-    ['method', 'path']
+    ['method', 'route', 'origin']
 )
 
 BLOCKED_REQUESTS = Counter(
@@ -21,10 +25,256 @@ POLICY_VALIDATION_ERRORS = Counter(
     ['origin', 'error_type']
 )
 
+KEY_CACHE_REQUESTS = Counter(
+    'adfree_key_cache_requests_total',
+    'Búsquedas en la caché de claves públicas por resultado',
+    ['result']
+)
+
+POLICY_CACHE_REQUESTS = Counter(
+    'adfree_policy_cache_requests_total',
+    'Búsquedas en la caché de políticas verificadas por resultado',
+    ['result']
+)
+
+POLICY_CACHE_EVICTIONS = Counter(
+    'adfree_policy_cache_evictions_total',
+    'Políticas verificadas expulsadas de la caché por tamaño'
+)
+
+POLICY_STORE_SIZE = Gauge(
+    'adfree_policy_store_size',
+    'Orígenes con política activa en memoria',
+    multiprocess_mode='livesum'
+)
+
+POLICY_STORE_EVICTIONS = Counter(
+    'adfree_policy_store_evictions_total',
+    'Políticas activas expulsadas del almacén',
+    ['reason']
+)
+
+POLICY_STORE_REQUESTS = Counter(
+    'adfree_policy_store_requests_total',
+    'Búsquedas de política activa por origen',
+    ['result']
+)
+
+VERIFY_PENDING = Gauge(
+    'adfree_verify_pending',
+    'Verificaciones de firma encoladas o en curso en el pool',
+    multiprocess_mode='livesum'
+)
+
+VERIFY_BATCH_SIZE = Histogram(
+    'adfree_verify_batch_size',
+    'Firmas verificadas por lote (misma clave pública)',
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+
 REQUEST_LATENCY = Histogram(
     'adfree_request_latency_seconds',
     'Latencia de requests procesadas por el proxy',
-    ['method', 'path']
+    ['method', 'route', 'origin']
+)
+
+STAGE_LATENCY = Histogram(
+    'adfree_stage_latency_seconds',
+    'Latencia por etapa del procesamiento de una request',
+    ['stage'],
+    buckets=(.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+
+# Hijos precalculados: el camino caliente no llama a .labels()
+STAGES = ('upstream', 'key_fetch', 'verify', 'decompress', 'rewrite', 'compress', 'report_enqueue', 'report_scan')
+STAGE = {stage: STAGE_LATENCY.labels(stage=stage) for stage in STAGES}
+
+# Métricas para compression.py: qué codificación llega del upstream y cuál se
+# entrega al cliente (path: rewrite | passthrough), y bytes del cuerpo en cada
+# paso de la reescritura para medir ratio de compresión frente a CPU.
+CONTENT_ENCODING = Counter(
+    'adfree_content_encoding_total',
+    'Respuestas por codificación del upstream y codificación entregada al cliente',
+    ['path', 'upstream', 'client']
+)
+
+REWRITE_BYTES = Counter(
+    'adfree_rewrite_body_bytes_total',
+    'Bytes del cuerpo en el camino de reescritura por paso',
+    ['step']
+)
+
+REWRITE_BYTE_STEPS = ('upstream', 'decoded', 'rewritten', 'client')
+REWRITE_BYTE = {step: REWRITE_BYTES.labels(step=step) for step in REWRITE_BYTE_STEPS}
+
+# Métricas para response_cache.py
+# result: hit (fresca) | revalidated (304) | miss | refetch (política cambiada) | bypass
+REWRITE_CACHE_REQUESTS = Counter(
+    'adfree_rewrite_cache_requests_total',
+    'Búsquedas en la caché de HTML reescrito por resultado',
+    ['result']
+)
+
+# kind: rewrite (bytes servidos sin reescribir) | upstream (bytes no descargados)
+REWRITE_CACHE_SAVED_BYTES = Counter(
+    'adfree_rewrite_cache_saved_bytes_total',
+    'Bytes ahorrados por la caché de HTML reescrito',
+    ['kind']
+)
+
+REWRITE_CACHE_RESULTS = ('hit', 'revalidated', 'miss', 'refetch', 'bypass')
+REWRITE_CACHE_RESULT = {result: REWRITE_CACHE_REQUESTS.labels(result=result) for result in REWRITE_CACHE_RESULTS}
+REWRITE_CACHE_SAVED = {kind: REWRITE_CACHE_SAVED_BYTES.labels(kind=kind) for kind in ('rewrite', 'upstream')}
+
+# Métricas para rules.py
+RULES_RELOADS = Counter(
+    'adfree_rules_reloads_total',
+    'Recargas del fichero de reglas del operador por resultado',
+    ['result']
+)
+
+RULES_RELOAD_SECONDS = Histogram(
+    'adfree_rules_reload_seconds',
+    'Tiempo de lectura y compilación del fichero de reglas',
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+)
+
+# Igual en todos los workers: en modo multiproceso se publica el máximo
+RULES_SIZE = Gauge(
+    'adfree_rules_size',
+    'Tamaño del ruleset vigente (dominios bloqueados, reglas de origen)',
+    ['kind'],
+    multiprocess_mode='max'
+)
+
+# Métricas para coalesce.py
+# role: leader | follower (recibió el HTML del líder) | fallback (fue por su cuenta)
+COALESCE_REQUESTS = Counter(
+    'adfree_coalesce_requests_total',
+    'Peticiones Adfree-Want agrupadas por papel en el single-flight',
+    ['role']
+)
+COALESCE_RESULT = {role: COALESCE_REQUESTS.labels(role=role) for role in ('leader', 'follower', 'fallback')}
+
+COALESCE_INFLIGHT = Gauge(
+    'adfree_coalesce_inflight',
+    'Claves con una petición líder en curso',
+    multiprocess_mode='livesum'
+)
+
+# Métricas para report_only.py
+# result: scanned | not_sampled | over_budget (sin presupuesto de CPU) |
+#         too_large | aborted (presupuesto agotado a mitad) | failed
+REPORT_ONLY_SCANS = Counter(
+    'adfree_report_only_scans_total',
+    'Páginas report-only por resultado del muestreo y escaneo',
+    ['result']
+)
+REPORT_ONLY_SCAN = {result: REPORT_ONLY_SCANS.labels(result=result)
+                    for result in ('scanned', 'not_sampled', 'over_budget', 'too_large', 'aborted', 'failed')}
+
+REPORT_ONLY_VIOLATIONS = Counter(
+    'adfree_report_only_violations_total',
+    'Violaciones encontradas en modo report-only (reportadas o deduplicadas)',
+    ['result']
+)
+REPORT_ONLY_VIOLATION = {result: REPORT_ONLY_VIOLATIONS.labels(result=result)
+                         for result in ('reported', 'deduplicated')}
+
+# Métricas para ratelimit.py
+# result: allowed | limited (respondida con 402/429 sin ir al upstream)
+RATE_LIMIT_REQUESTS = Counter(
+    'adfree_rate_limit_requests_total',
+    'Peticiones a orígenes con bot_policy.rate_limit por resultado',
+    ['result']
+)
+RATE_LIMIT_RESULT = {result: RATE_LIMIT_REQUESTS.labels(result=result) for result in ('allowed', 'limited')}
+
+RATE_LIMIT_BUCKETS = Gauge(
+    'adfree_rate_limit_buckets',
+    'Token buckets (origen, cliente) en memoria',
+    multiprocess_mode='livesum'
+)
+
+# reason: idle (se habría rellenado del todo) | overflow (límite de buckets)
+RATE_LIMIT_EVICTIONS = Counter(
+    'adfree_rate_limit_evictions_total',
+    'Token buckets descartados',
+    ['reason']
+)
+RATE_LIMIT_EVICTION = {reason: RATE_LIMIT_EVICTIONS.labels(reason=reason) for reason in ('idle', 'overflow')}
+
+# Métricas para diagnostics.py
+LOOP_LAG = Gauge(
+    'adfree_event_loop_lag_seconds',
+    'Retraso del event loop en la última muestra (el peor worker)',
+    multiprocess_mode='livemax'
+)
+
+LOOP_STALLS = Counter(
+    'adfree_event_loop_stalls_total',
+    'Bloqueos del event loop más largos que --slow-callback'
+)
+
+# Métricas para shared_cache.py
+# result: hit | miss | expired | torn (slot en escritura o leído a medias)
+SHARED_CACHE_REQUESTS = Counter(
+    'adfree_shared_cache_requests_total',
+    'Búsquedas en la caché compartida entre procesos por resultado',
+    ['result']
+)
+SHARED_CACHE_RESULT = {result: SHARED_CACHE_REQUESTS.labels(result=result)
+                       for result in ('hit', 'miss', 'expired', 'torn')}
+
+SHARED_CACHE_EVICTIONS = Counter(
+    'adfree_shared_cache_evictions_total',
+    'Entradas vigentes reemplazadas por falta de sitio en su ventana de la caché compartida'
+)
+
+# Métricas para tls.py
+# result: full | resumed (ticket o caché de sesión)
+TLS_HANDSHAKES = Counter(
+    'adfree_tls_handshakes_total',
+    'Handshakes TLS del modo tls-terminator por tipo',
+    ['result']
+)
+TLS_HANDSHAKE = {result: TLS_HANDSHAKES.labels(result=result) for result in ('full', 'resumed')}
+
+TLS_HANDSHAKE_SECONDS = Histogram(
+    'adfree_tls_handshake_seconds',
+    'Duración del handshake TLS desde el ClientHello',
+    ['result'],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1)
+)
+TLS_HANDSHAKE_LATENCY = {result: TLS_HANDSHAKE_SECONDS.labels(result=result) for result in ('full', 'resumed')}
+
+# result: matched | unknown (nombre sin certificado: se usa el de por defecto) | none (sin SNI)
+TLS_SNI_REQUESTS = Counter(
+    'adfree_tls_sni_total',
+    'Selección de certificado por SNI',
+    ['result']
+)
+TLS_SNI = {result: TLS_SNI_REQUESTS.labels(result=result) for result in ('matched', 'unknown', 'none')}
+
+# result: built | reused
+TLS_UPSTREAM_CONTEXT_REQUESTS = Counter(
+    'adfree_tls_upstream_contexts_total',
+    'SSLContext hacia upstreams construidos o reutilizados de la caché por origen',
+    ['result']
+)
+TLS_UPSTREAM_CONTEXTS = {result: TLS_UPSTREAM_CONTEXT_REQUESTS.labels(result=result) for result in ('built', 'reused')}
+
+REWRITE_CACHE_SIZE = Gauge(
+    'adfree_rewrite_cache_bytes',
+    'Tamaño de la caché de HTML reescrito por nivel',
+    ['tier'],
+    multiprocess_mode='livesum'
+)
+
+REWRITE_CACHE_EVICTIONS = Counter(
+    'adfree_rewrite_cache_evictions_total',
+    'Entradas expulsadas de la caché de HTML reescrito por tamaño',
+    ['tier']
 )
 
 # Métricas para reporter.py
@@ -40,16 +290,93 @@ REPORT_FAILED = Counter(
     ['endpoint', 'reason']
 )
 
+REPORT_SPOOLED = Counter(
+    'adfree_reports_spooled_total',
+    'Reportes no entregados guardados en el spool en disco',
+    ['endpoint']
+)
+
+REPORT_SPOOL_BYTES = Gauge(
+    'adfree_report_spool_bytes',
+    'Bytes ocupados por el spool de reportes en disco',
+    multiprocess_mode='livesum'
+)
+
+REPORT_SPOOL_DROPPED = Counter(
+    'adfree_report_spool_segments_dropped_total',
+    'Segmentos del spool descartados por superar el tamaño máximo'
+)
+
+REPORT_DROPPED = Counter(
+    'adfree_reports_dropped_total',
+    'Reportes descartados por buffer lleno (se descarta el más antiguo)',
+    ['endpoint']
+)
+
+
+OVERFLOW_LABEL = '__other__'
+
+KNOWN_METHODS = frozenset({'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS', 'CONNECT', 'TRACE'})
+
+
+class LabelLimiter:
+    """
+    Limita los valores distintos de una etiqueta: los primeros max_values se
+    usan tal cual y el resto cae en OVERFLOW_LABEL.
+    """
+
+    def __init__(self, max_values: int):
+        self.max_values = max_values
+        self._seen = set()
+
+    def limit(self, value: str) -> str:
+        if value in self._seen:
+            return value
+        if len(self._seen) < self.max_values:
+            self._seen.add(value)
+            return value
+        return OVERFLOW_LABEL
+
+
+class RequestMetrics:
+    """
+    Hijos (contador, histograma) de las métricas de request, cacheados por
+    etiquetas ya normalizadas; la caché queda acotada por los limitadores.
+    """
+
+    def __init__(self, max_routes: int = 100, max_origins: int = 500):
+        self.routes = LabelLimiter(max_routes)
+        self.origins = LabelLimiter(max_origins)
+        self._children: Dict[Tuple[str, str, str], Tuple[object, object]] = {}
+
+    def children(self, method: str, route: str, origin: str):
+        key = (
+            method if method in KNOWN_METHODS else 'OTHER',
+            self.routes.limit(route),
+            self.origins.limit(origin),
+        )
+        pair = self._children.get(key)
+        if pair is None:
+            pair = self._children[key] = (REQUEST_COUNT.labels(*key), REQUEST_LATENCY.labels(*key))
+        return pair
+
+
+REQUEST_METRICS = RequestMetrics()
+
+# Dominios bloqueados y endpoints de reporte vienen de políticas de terceros
+BLOCKED_DOMAIN_LABELS = LabelLimiter(500)
+ENDPOINT_LABELS = LabelLimiter(100)
+
 
 class MetricsCollector:
     """Pequeño wrapper para exponer operaciones simples en tests.
     En producción, los contadores de prometheus se usan directamente.
     """
-    def inc_requests(self, method: str = 'GET', path: str = '/'):
-        REQUEST_COUNT.labels(method=method, path=path).inc()
+    def inc_requests(self, method: str = 'GET', path: str = '/', origin: str = 'local'):
+        REQUEST_METRICS.children(method, path, origin)[0].inc()
 
     def inc_blocked(self, domain: str, reason: str = 'iframe_blocked'):
-        BLOCKED_REQUESTS.labels(reason=reason, domain=domain).inc()
+        BLOCKED_REQUESTS.labels(reason=reason, domain=BLOCKED_DOMAIN_LABELS.limit(domain)).inc()
 
-    def observe_latency(self, method: str, path: str, value: float):
-        REQUEST_LATENCY.labels(method=method, path=path).observe(value)
\ No newline at end of file
+    def observe_latency(self, method: str, path: str, value: float, origin: str = 'local'):
+        REQUEST_METRICS.children(method, path, origin)[1].observe(value)
\ No newline at end of file
@@ -1,53 +1,42 @@
 # adfree_proxy/policy.py
 
-import json
-from typing import Dict, Any, Optional, Literal
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.serialization import load_pem_public_key
-from cryptography.exceptions import InvalidSignature
-from pydantic import BaseModel, Field, validator
+import base64
+import functools
+import time
+from typing import TYPE_CHECKING, Dict, Any, Optional
 import aiohttp
 import logging
 
+from . import jcs
+from .keys import PublicKeyCache
+from .metrics import STAGE
+from .policy_cache import VerifiedPolicyCache
+
+if TYPE_CHECKING:
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from .schema import AdfreePolicy
+    from .verify_pool import SignatureVerifier
+
+# pydantic y cryptography se cargan la primera vez que se valida o verifica
+# una política: importar el proxy (arranque de cada worker) no los paga.
+
 logger = logging.getLogger(__name__)
 
-class BotPolicy(BaseModel):
-    allowed: bool = False
-    payment_required: bool = True
-    payment_url: str
-    rate_limit: Optional[Dict[str, Any]] = None
-
-class AdfreePolicy(BaseModel):
-    version: Literal["1"] = "1"
-    mode: str  # "strict" | "relaxed" | "report-only"
-    max_ads_per_page: int = 3
-    allow_redirects: bool = False
-    allow_iframes: list[str] = Field(default_factory=lambda: ["self"])
-    blocked_domains: list[str] = Field(default_factory=list)
-    report_to: Optional[str] = None
-    bot_policy: Optional[BotPolicy] = None
-
-    @validator('mode')
-    def validate_mode(cls, v):
-        if v not in {"strict", "relaxed", "report-only"}:
-            raise ValueError('mode must be "strict", "relaxed", or "report-only"')
-        return v
+
+def __getattr__(name: str):
+    # AdfreePolicy y BotPolicy viven en schema.py; se siguen importando desde aquí
+    if name in ('AdfreePolicy', 'BotPolicy'):
+        from . import schema
+        return getattr(schema, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def canonicalize_json(data: Dict[str, Any]) -> bytes:
     """
-    Canonicaliza JSON ordenando recursivamente las claves.
-    NOTA: Esto es una simplificación. Para producción, usar JSON Canonicalization Scheme (JCS).
+    Canonicaliza JSON según JCS (RFC 8785); ver jcs.py. Los objetos que vienen
+    de jcs.loads ya están ordenados y no se vuelven a ordenar.
     """
-    def _sorted_dict(d):
-        if isinstance(d, dict):
-            return {k: _sorted_dict(v) for k, v in sorted(d.items())}
-        elif isinstance(d, list):
-            return [_sorted_dict(i) for i in d]
-        else:
-            return d
-    sorted_data = _sorted_dict(data)
-    return json.dumps(sorted_data, separators=(',', ':'), sort_keys=True).encode('utf-8')
+    return jcs.canonicalize(data)
 
 
 class PolicyEvaluator:
@@ -61,61 +50,83 @@ class PolicyEvaluator:
         # Minimal behaviour: always allow
         return {"action": "allow"}
 
-async def fetch_public_key(origin: str) -> bytes:
+async def fetch_public_key(origin: str,
+                           session: Optional[aiohttp.ClientSession] = None,
+                           key_cache: Optional[PublicKeyCache] = None) -> Optional[bytes]:
     """
-    Obtiene la clave pública JWK desde .well-known
+    Obtiene la clave pública JWK desde .well-known y la devuelve en PEM.
+    Con key_cache se sirve desde la caché por origen (TTL, ETag, backoff y
+    coalescencia); sin ella se hace una petición puntual con session.
     """
-    url = f"https://{origin}/.well-known/adfree-policy-key"
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    jwk_data = await resp.json()
-                    # Convertir JWK a PEM (simplificado, solo para clave EC P-256)
-                    # En producción, usar python-jose o similar
-                    from python_jose import jwk
-                    key = jwk.construct(jwk_data)
-                    return key.to_pem()
-                else:
-                    logger.error(f"Failed to fetch key from {url}: {resp.status}")
-                    return None
-        except Exception as e:
-            logger.error(f"Error fetching public key: {e}")
-            return None
+    if key_cache is None:
+        key_cache = PublicKeyCache(session, max_entries=1)
+    return await key_cache.get(origin)
+
+@functools.lru_cache(maxsize=1024)
+def _load_public_key(public_key_pem: bytes) -> 'ec.EllipticCurvePublicKey':
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+    public_key = load_pem_public_key(public_key_pem)
+    if not isinstance(public_key, ec.EllipticCurvePublicKey):
+        raise ValueError("Public key is not an EC key")
+    return public_key
+
+@functools.lru_cache(maxsize=None)
+def _es256() -> 'ec.ECDSA':
+    """Algoritmo de firma ES256 (ECDSA con SHA-256); se construye una vez."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+
+    return ec.ECDSA(hashes.SHA256())
+
+def preload() -> None:
+    """
+    Importa pydantic, los esquemas y cryptography. serve() lo lanza en un
+    hilo cuando ya escucha: así la primera política que llega no paga esos
+    imports dentro del event loop.
+    """
+    from .schema import AdfreePolicy
+
+    AdfreePolicy.model_validate({'mode': 'strict'})
+    _es256()
 
 def verify_policy_signature(policy_json: Dict[str, Any], signature_b64: str, public_key_pem: bytes) -> bool:
     """
     Verifica la firma ES256 sobre el JSON canonicalizado.
     """
+    # Fuera del try: si falta cryptography debe fallar, no pasar por firma inválida
+    algorithm = _es256()
     try:
         canonical_data = canonicalize_json(policy_json)
         signature = base64.urlsafe_b64decode(signature_b64 + '==')  # padding
 
-        public_key = load_pem_public_key(public_key_pem)
-        if not isinstance(public_key, ec.EllipticCurvePublicKey):
-            raise ValueError("Public key is not an EC key")
+        public_key = _load_public_key(public_key_pem)
 
         public_key.verify(
             signature,
             canonical_data,
-            ec.ECDSA(hashes.SHA256())
+            algorithm
         )
         return True
-    except (InvalidSignature, Exception) as e:
+    except Exception as e:
         logger.warning(f"Signature verification failed: {e}")
         return False
 
-async def validate_policy(policy_json: Dict[str, Any], signature_b64: str, origin: str) -> Optional[AdfreePolicy]:
+async def validate_policy(policy_json: Dict[str, Any], signature_b64: str, origin: str,
+                          key_cache: Optional[PublicKeyCache] = None) -> Optional['AdfreePolicy']:
     """
     Valida esquema y firma de la política.
     Retorna objeto AdfreePolicy si es válida, None si no.
     """
+    from .schema import AdfreePolicy
+
     try:
         # Validar esquema
-        policy_obj = AdfreePolicy.parse_obj(policy_json)
+        policy_obj = AdfreePolicy.model_validate(policy_json)
 
         # Obtener clave pública
-        public_key_pem = await fetch_public_key(origin)
+        public_key_pem = await fetch_public_key(origin, key_cache=key_cache)
         if not public_key_pem:
             return None
 
@@ -127,4 +138,52 @@ async def validate_policy(policy_json: Dict[str, Any], signature_b64: str, origi
 
     except Exception as e:
         logger.error(f"Policy validation error: {e}")
-        return None
\ No newline at end of file
+        return None
+
+async def validate_policy_header(raw_policy: str, signature_b64: str, origin: str,
+                                 key_cache: PublicKeyCache,
+                                 policy_cache: Optional[VerifiedPolicyCache] = None,
+                                 verifier: Optional['SignatureVerifier'] = None) -> Optional['AdfreePolicy']:
+    """
+    Valida la cabecera Adfree-Policy cruda tal como llega del upstream.
+    Si el mismo par política/firma ya se verificó con la clave vigente del
+    origen, se devuelve la política cacheada sin parsear ni verificar.
+    Con verifier, la verificación ECDSA sale del event loop. Si otro proceso
+    ya la verificó (caché compartida de policy_cache), no se repite.
+    """
+    started = time.perf_counter()
+    key = await key_cache.lookup(origin)
+    STAGE['key_fetch'].observe(time.perf_counter() - started)
+    if key is None:
+        return None
+
+    if policy_cache is not None:
+        cached = policy_cache.get(origin, key.fingerprint, raw_policy, signature_b64)
+        if cached is not None:
+            return cached
+
+    from .schema import AdfreePolicy
+
+    try:
+        # Una sola pasada: objetos ya en orden canónico para verificar la firma
+        policy_json = jcs.loads(raw_policy)
+        policy_obj = AdfreePolicy.model_validate(policy_json)
+    except Exception as e:
+        logger.error(f"Policy validation error: {e}")
+        return None
+
+    if policy_cache is not None and policy_cache.verified_elsewhere(origin, key.pem, raw_policy, signature_b64):
+        valid = True
+    else:
+        started = time.perf_counter()
+        if verifier is not None:
+            valid = await verifier.verify(policy_json, signature_b64, key.pem)
+        else:
+            valid = verify_policy_signature(policy_json, signature_b64, key.pem)
+        STAGE['verify'].observe(time.perf_counter() - started)
+    if not valid:
+        return None
+
+    if policy_cache is not None:
+        policy_cache.put(origin, key.fingerprint, raw_policy, signature_b64, policy_obj, key.pem)
+    return policy_obj
@@ -0,0 +1,95 @@
+# adfree_proxy/policy_cache.py
+
+"""
+Memoización de políticas ya verificadas.
+
+Los orígenes envían el mismo par Adfree-Policy / Adfree-Signature en cada
+página; VerifiedPolicyCache asocia (origen, huella de la clave, digest de
+cabecera y firma) con el AdfreePolicy validado para que las repeticiones se
+salten el parseo y la verificación ECDSA. La huella es el sha256 de la clave
+pública (CachedKey.fingerprint), no su kid: un origen puede reutilizar el kid
+al rotar y la política verificada con la clave anterior no debe servirse.
+
+Con una SharedCache, el digest de cada política verificada se publica para
+los demás procesos del host: allí solo hay que parsearla, sin repetir la
+verificación. También se indexa por la clave pública completa.
+"""
+
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Tuple, Union
+
+from .metrics import POLICY_CACHE_REQUESTS, POLICY_CACHE_EVICTIONS
+from .shared_cache import KIND_POLICY, SharedCache, entry_hash
+
+
+def _as_bytes(value: Union[str, bytes]) -> bytes:
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+def policy_digest(raw_policy: Union[str, bytes], signature_b64: Union[str, bytes]) -> bytes:
+    """Digest de la cabecera de política cruda y su firma."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(_as_bytes(raw_policy))
+    h.update(b'\0')
+    h.update(_as_bytes(signature_b64))
+    return h.digest()
+
+
+class VerifiedPolicyCache:
+    """Caché LRU acotada de políticas verificadas."""
+
+    def __init__(self, max_entries: int = 4096, shared: Optional[SharedCache] = None,
+                 shared_ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.shared = shared
+        self.shared_ttl = shared_ttl
+        self._entries: 'OrderedDict[Tuple[str, bytes, bytes], object]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, origin: str, key_fingerprint: bytes, raw_policy, signature_b64):
+        key = (origin, key_fingerprint, policy_digest(raw_policy, signature_b64))
+        policy = self._entries.get(key)
+        if policy is None:
+            POLICY_CACHE_REQUESTS.labels(result='miss').inc()
+            return None
+        self._entries.move_to_end(key)
+        POLICY_CACHE_REQUESTS.labels(result='hit').inc()
+        return policy
+
+    def put(self, origin: str, key_fingerprint: bytes, raw_policy, signature_b64, policy,
+            public_key_pem: Optional[bytes] = None) -> None:
+        digest = policy_digest(raw_policy, signature_b64)
+        key = (origin, key_fingerprint, digest)
+        self._entries[key] = policy
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            POLICY_CACHE_EVICTIONS.inc()
+        if self.shared is not None and public_key_pem:
+            self.shared.put(KIND_POLICY, self._shared_key(origin, public_key_pem, digest), b'',
+                            self.shared.clock() + self.shared_ttl)
+
+    @staticmethod
+    def _shared_key(origin: str, public_key_pem: bytes, digest: bytes) -> bytes:
+        return entry_hash(KIND_POLICY, origin.encode('utf-8'), public_key_pem, digest)
+
+    def verified_elsewhere(self, origin: str, public_key_pem: bytes, raw_policy, signature_b64) -> bool:
+        """True si otro proceso ya verificó esta política con esta clave."""
+        if self.shared is None:
+            return False
+        digest = policy_digest(raw_policy, signature_b64)
+        if self.shared.get(KIND_POLICY, self._shared_key(origin, public_key_pem, digest)) is None:
+            return False
+        POLICY_CACHE_REQUESTS.labels(result='shared_hit').inc()
+        return True
+
+    def invalidate_origin(self, origin: str) -> None:
+        """Descarta las políticas de un origen (p. ej. al rotar su clave)."""
+        for key in [k for k in self._entries if k[0] == origin]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
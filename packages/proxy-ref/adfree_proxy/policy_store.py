@@ -0,0 +1,99 @@
+# adfree_proxy/policy_store.py
+
+"""
+Almacén acotado de políticas activas por origen.
+
+Sustituye al dict sin límite de AdfreeInterceptor.active_policies: LRU con
+un máximo de entradas y caducidad propia de la política (ttl_for), que no
+depende de la frescura de la página que la trajo. Cada entrada guarda el digest de la cabecera
+Adfree-Policy + firma, de modo que un origen conocido que repite la misma
+política se resuelve sin pedir la clave ni verificar.
+"""
+
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from .keys import parse_cache_lifetime
+from .metrics import POLICY_STORE_SIZE, POLICY_STORE_EVICTIONS, POLICY_STORE_REQUESTS
+
+
+class PolicyEntry:
+    __slots__ = ('policy', 'digest', 'expires_at', 'key_fingerprint')
+
+    def __init__(self, policy, digest: bytes, expires_at: float, key_fingerprint: Optional[bytes] = None):
+        self.policy = policy
+        self.digest = digest
+        self.expires_at = expires_at
+        self.key_fingerprint = key_fingerprint
+
+
+class PolicyStore:
+    def __init__(self, max_entries: int = 10000, default_ttl: float = 300.0, max_ttl: float = 86400.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.clock = clock
+        self._entries: 'OrderedDict[str, PolicyEntry]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, origin: str) -> bool:
+        return self.get(origin, count=False) is not None
+
+    def get(self, origin: str, count: bool = True) -> Optional[PolicyEntry]:
+        """Entrada vigente del origen, o None (las caducadas se eliminan al leerlas)."""
+        entry = self._entries.get(origin)
+        if entry is not None and entry.expires_at <= self.clock():
+            del self._entries[origin]
+            POLICY_STORE_EVICTIONS.labels(reason='expired').inc()
+            POLICY_STORE_SIZE.set(len(self._entries))
+            entry = None
+        if count:
+            POLICY_STORE_REQUESTS.labels(result='hit' if entry is not None else 'miss').inc()
+        if entry is not None:
+            self._entries.move_to_end(origin)
+        return entry
+
+    def lookup(self, origin: str, digest: bytes, key_fingerprint: Optional[bytes] = None):
+        """
+        Política activa del origen si la cabecera recibida es la misma que se
+        validó y la clave vigente del origen (key_fingerprint) es con la que
+        se verificó.
+        """
+        entry = self.get(origin)
+        if entry is not None and entry.digest == digest and entry.key_fingerprint == key_fingerprint:
+            return entry.policy
+        return None
+
+    def ttl_for(self, cache_control: Optional[str]) -> float:
+        """
+        Vida de una política recibida con esta Cache-Control: default_ttl, o
+        más si la respuesta declara un max-age mayor (hasta max_ttl). Una
+        página no-cache o max-age=0 no la acorta; con no-store (0) no se
+        guarda, pero tampoco se quita la que hubiera.
+        """
+        if cache_control and 'no-store' in cache_control.lower():
+            return 0.0
+        lifetime = parse_cache_lifetime(cache_control) or 0
+        return min(max(float(lifetime), self.default_ttl), self.max_ttl)
+
+    def put(self, origin: str, policy, digest: bytes, ttl: Optional[float] = None,
+            key_fingerprint: Optional[bytes] = None) -> None:
+        ttl = min(self.default_ttl if ttl is None else ttl, self.max_ttl)
+        if ttl <= 0:
+            # La respuesta es no-store: esta política no se guarda, pero la
+            # activa del origen (límites de bot_policy, fast path) se mantiene
+            return
+        self._entries[origin] = PolicyEntry(policy, digest, self.clock() + ttl, key_fingerprint)
+        self._entries.move_to_end(origin)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            POLICY_STORE_EVICTIONS.labels(reason='lru').inc()
+        POLICY_STORE_SIZE.set(len(self._entries))
+
+    def pop(self, origin: str) -> None:
+        if self._entries.pop(origin, None) is not None:
+            POLICY_STORE_SIZE.set(len(self._entries))
@@ -0,0 +1,94 @@
+# adfree_proxy/ratelimit.py
+
+"""
+Límite de peticiones por origen y cliente (bot_policy.rate_limit).
+
+Cada par (origen, cliente) tiene un token bucket de capacidad burst que se
+rellena a requests/window tokens por segundo. En lugar de guardar tokens y
+marca de tiempo se guarda un único float: el instante en que el bucket
+volvería a estar lleno (GCRA, equivalente al token bucket). Un bucket cuyo
+instante ya pasó está lleno y es indistinguible de uno que no existe, así
+que el barrido periódico lo elimina sin cambiar ningún resultado.
+
+El número de buckets está acotado: un escaneo con IPs de cliente aleatorias
+expulsa los buckets usados hace más tiempo (esos clientes vuelven a empezar
+con el bucket lleno) en lugar de hacer crecer la memoria sin límite.
+
+El cliente es la dirección del par. Detrás de un balanceador todos los
+clientes compartirían un bucket; con forwarded_hops (el número de proxies de
+confianza delante, que añaden su entrada a X-Forwarded-For) se usa la
+dirección que vio el más externo. Las entradas anteriores las escribe el
+cliente y no se usan nunca.
+"""
+
+import time
+from typing import Callable, Dict, Hashable, Optional, Sequence
+
+from .metrics import RATE_LIMIT_BUCKETS, RATE_LIMIT_EVICTION, RATE_LIMIT_RESULT
+
+
+class RateLimiter:
+    def __init__(self, max_buckets: int = 100000, sweep_interval: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic, forwarded_hops: int = 0):
+        self.max_buckets = max_buckets
+        self.forwarded_hops = forwarded_hops
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        # clave -> instante en que el bucket vuelve a estar lleno; en orden de último uso
+        self._buckets: Dict[Hashable, float] = {}
+        self._next_sweep = clock() + sweep_interval
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def client(self, remote: Optional[str], forwarded_for: Sequence[str] = ()) -> Optional[str]:
+        """Dirección a la que se cuentan las peticiones (ver forwarded_hops)."""
+        if self.forwarded_hops and forwarded_for:
+            hops = [hop.strip() for header in forwarded_for for hop in header.split(',')]
+            if len(hops) >= self.forwarded_hops:
+                return hops[-self.forwarded_hops]
+        return remote
+
+    def take(self, key: Hashable, capacity: float, rate: float) -> float:
+        """
+        Consume un token del bucket de key. Devuelve 0 si la petición pasa o
+        los segundos que faltan para que haya un token si se rechaza.
+        """
+        now = self.clock()
+        if now >= self._next_sweep:
+            self.sweep(now)
+        buckets = self._buckets
+        full_at = buckets.pop(key, None)
+        if full_at is None:
+            full_at = now
+            if len(buckets) >= self.max_buckets:
+                del buckets[next(iter(buckets))]
+                RATE_LIMIT_EVICTION['overflow'].inc()
+            else:
+                RATE_LIMIT_BUCKETS.set(len(buckets) + 1)
+        elif full_at < now:
+            full_at = now
+
+        # Con el token consumido, el bucket tardaría (capacity - tokens + 1) / rate en llenarse
+        after = full_at + 1.0 / rate
+        wait = after - now - capacity / rate
+        if wait > 0:
+            buckets[key] = full_at
+            RATE_LIMIT_RESULT['limited'].inc()
+            return wait
+        buckets[key] = after
+        RATE_LIMIT_RESULT['allowed'].inc()
+        return 0.0
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Elimina los buckets ya llenos; devuelve cuántos."""
+        now = self.clock() if now is None else now
+        self._next_sweep = now + self.sweep_interval
+        buckets = self._buckets
+        idle = [key for key, full_at in buckets.items() if full_at <= now]
+        for key in idle:
+            del buckets[key]
+        if idle:
+            RATE_LIMIT_EVICTION['idle'].inc(len(idle))
+        RATE_LIMIT_BUCKETS.set(len(buckets))
+        return len(idle)
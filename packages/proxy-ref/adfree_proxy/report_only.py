@@ -0,0 +1,191 @@
+# adfree_proxy/report_only.py
+
+"""
+Escaneo muestreado para las políticas en modo report-only.
+
+En report-only el cliente recibe los bytes del upstream tal cual: no hay
+reescritura ni recompresión. Una fracción de las páginas (sample_rate, que
+las reglas del operador pueden cambiar por origen) se copia mientras se
+envía y se analiza después, fuera del camino de la respuesta, con el mismo
+HtmlRewriter que el modo strict, descartando su salida.
+
+El escaneo tiene un presupuesto de CPU por segundo de reloj (token bucket):
+si se agota, las páginas nuevas no se muestrean y un escaneo en curso se
+abandona. Descomprimir la copia también se cobra del presupuesto, y el
+cuerpo descomprimido está acotado aparte (max_decoded_bytes): una página
+pequeña muy comprimida no se convierte en un escaneo enorme. Las
+violaciones se deduplican por (página, url, tipo) durante dedupe_window
+segundos antes de reportarse.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .compression import CompressionError, StreamDecoder
+from .metrics import REPORT_ONLY_SCAN, REPORT_ONLY_VIOLATION, STAGE
+from .rewriter import HtmlRewriter
+
+logger = logging.getLogger(__name__)
+
+# Trozo de HTML analizado entre cesiones del event loop
+SCAN_SLICE = 64 * 1024
+
+
+def _decoded(decoder: StreamDecoder, chunks: List[bytes]) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield from decoder.decompress(chunk)
+    yield decoder.flush()
+
+
+class ScanCapture:
+    """Copia acotada del cuerpo de una página muestreada."""
+
+    __slots__ = ('page_url', 'encoding', 'limit', 'chunks', 'size', 'truncated')
+
+    def __init__(self, page_url: str, encoding: str, limit: int):
+        self.page_url = page_url
+        self.encoding = encoding
+        self.limit = limit
+        self.chunks: List[bytes] = []
+        self.size = 0
+        self.truncated = False
+
+    def feed(self, chunk: bytes) -> None:
+        if self.truncated:
+            return
+        self.size += len(chunk)
+        if self.size > self.limit:
+            # Página demasiado grande para escanearla: se suelta lo copiado
+            self.truncated = True
+            self.chunks = []
+            return
+        self.chunks.append(chunk)
+
+
+class ReportOnlyScanner:
+    def __init__(self, sample_rate: float = 0.1, cpu_budget: float = 0.05,
+                 dedupe_window: float = 600.0, max_scan_bytes: int = 2 * 1024 * 1024,
+                 max_decoded_bytes: int = 16 * 1024 * 1024, max_dedupe: int = 50000,
+                 rng: Callable[[], float] = random.random,
+                 clock: Callable[[], float] = time.monotonic,
+                 cpu_clock: Callable[[], float] = time.thread_time):
+        self.sample_rate = sample_rate
+        self.cpu_budget = cpu_budget  # segundos de CPU por segundo
+        self.dedupe_window = dedupe_window
+        self.max_scan_bytes = max_scan_bytes
+        self.max_decoded_bytes = max_decoded_bytes
+        self.max_dedupe = max_dedupe
+        self.rng = rng
+        self.clock = clock
+        self.cpu_clock = cpu_clock
+        self._budget = cpu_budget
+        self._budget_at = clock()
+        # (página, url, tipo) -> caducidad; en orden de inserción = de caducidad
+        self._seen: 'OrderedDict[Tuple[str, str, str], float]' = OrderedDict()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _refill(self) -> float:
+        now = self.clock()
+        self._budget = min(self.cpu_budget, self._budget + (now - self._budget_at) * self.cpu_budget)
+        self._budget_at = now
+        return self._budget
+
+    def begin(self, page_url: str, encoding: str, sample_rate: Optional[float] = None) -> Optional[ScanCapture]:
+        """Captura para una página que se va a muestrear, o None."""
+        rate = self.sample_rate if sample_rate is None else sample_rate
+        if rate <= 0 or (rate < 1 and self.rng() >= rate):
+            REPORT_ONLY_SCAN['not_sampled'].inc()
+            return None
+        if self._refill() <= 0:
+            REPORT_ONLY_SCAN['over_budget'].inc()
+            return None
+        return ScanCapture(page_url, encoding, self.max_scan_bytes)
+
+    def submit(self, capture: ScanCapture, rewriter: HtmlRewriter,
+               report: Callable[[List[Tuple[str, str, str]]], None]) -> None:
+        """Escanea la captura en segundo plano; report recibe las violaciones nuevas."""
+        if capture.truncated:
+            REPORT_ONLY_SCAN['too_large'].inc()
+            return
+        task = asyncio.get_running_loop().create_task(self._scan(capture, rewriter, report))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _scan(self, capture: ScanCapture, rewriter: HtmlRewriter, report) -> None:
+        chunks, capture.chunks = capture.chunks, []
+        pieces = _decoded(StreamDecoder(capture.encoding), chunks)
+        spent = 0.0
+        decoded = 0
+        try:
+            while True:
+                if self._budget <= 0:
+                    REPORT_ONLY_SCAN['aborted'].inc()
+                    return
+                # Cada trozo descomprimido se cobra igual que su escaneo
+                piece, cost = self._charge(next, pieces, None)
+                spent += cost
+                if piece is None:
+                    break
+                decoded += len(piece)
+                if decoded > self.max_decoded_bytes:
+                    REPORT_ONLY_SCAN['too_large'].inc()
+                    return
+                for i in range(0, len(piece), SCAN_SLICE):
+                    spent += self._charge(rewriter.feed, piece[i:i + SCAN_SLICE])[1]
+                    if self._budget <= 0:
+                        REPORT_ONLY_SCAN['aborted'].inc()
+                        return
+                    # Cede el loop: las respuestas en curso no esperan al escaneo
+                    await asyncio.sleep(0)
+            rewriter.close()
+        except CompressionError as e:
+            REPORT_ONLY_SCAN['failed'].inc()
+            logger.debug(f"Could not scan {capture.page_url}: {e}")
+            return
+        finally:
+            STAGE['report_scan'].observe(spent)
+        REPORT_ONLY_SCAN['scanned'].inc()
+        fresh = self.deduplicate(capture.page_url, rewriter.violations)
+        if fresh:
+            report(fresh)
+
+    def _charge(self, fn, *args) -> Tuple[Any, float]:
+        """fn(*args) descontando su CPU del presupuesto: (resultado, segundos)."""
+        started = self.cpu_clock()
+        result = fn(*args)
+        spent = self.cpu_clock() - started
+        self._refill()
+        self._budget -= spent
+        return result, spent
+
+    def deduplicate(self, page_url: str, violations: Iterable[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
+        """Violaciones no vistas para esta página en la ventana de deduplicación."""
+        now = self.clock()
+        seen = self._seen
+        while seen:
+            key, expires_at = next(iter(seen.items()))
+            if expires_at > now:
+                break
+            del seen[key]
+
+        fresh = []
+        for violation in violations:
+            key = (page_url, violation[0], violation[2])
+            if key in seen:
+                REPORT_ONLY_VIOLATION['deduplicated'].inc()
+                continue
+            seen[key] = now + self.dedupe_window
+            if len(seen) > self.max_dedupe:
+                seen.popitem(last=False)
+            REPORT_ONLY_VIOLATION['reported'].inc()
+            fresh.append(violation)
+        return fresh
+
+    async def close(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
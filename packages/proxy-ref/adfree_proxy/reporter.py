@@ -1,62 +1,227 @@
 # adfree_proxy/reporter.py
 
 import asyncio
-import json
 import logging
 import time
-from typing import Dict, Any, Optional
-from aiohttp import ClientSession, ClientError
-from .metrics import REPORT_SENT, REPORT_FAILED
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, Deque, Dict, Any, List, Optional, Set
+from aiohttp import ClientSession, ClientError, ClientTimeout
+from .metrics import REPORT_SENT, REPORT_FAILED, REPORT_DROPPED, ENDPOINT_LABELS
+from .spool import ReportSpool
+
+if TYPE_CHECKING:
+    from .schema import AdfreePolicy
 
 logger = logging.getLogger(__name__)
 
+class _EndpointQueue:
+    """Buffer acotado de reportes pendientes para un report_to."""
+
+    def __init__(self, max_buffer: int, max_concurrency: int):
+        self.buffer: Deque[Dict[str, Any]] = deque(maxlen=max_buffer)
+        self.ready = asyncio.Event()
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.worker: Optional[asyncio.Task] = None
+
+
 class ReportClient:
-    def __init__(self, session: ClientSession):
+    """
+    Cliente de reportes con lotes por endpoint.
+
+    Los reportes se encolan por report_to y se envían como un único POST con
+    un array JSON cuando se alcanzan batch_size reportes o pasa
+    flush_interval. El buffer de cada endpoint está acotado (se descarta el
+    más antiguo y se cuenta en REPORT_DROPPED) y como mucho max_concurrency
+    envíos por endpoint están en vuelo. El número de endpoints con cola
+    también está acotado (max_endpoints, LRU): al expulsar uno se para su
+    worker y se envía lo que tuviera pendiente.
+
+    Con spool, los lotes que fallan van directamente a disco en lugar de
+    reintentarse en memoria; el drainer del spool se encarga de reenviarlos.
+    """
+
+    def __init__(self, session: ClientSession,
+                 batch_size: int = 50,
+                 flush_interval: float = 2.0,
+                 max_buffer: int = 1000,
+                 max_concurrency: int = 2,
+                 max_retries: int = 3,
+                 idle_timeout: float = 60.0,
+                 request_timeout: float = 10.0,
+                 max_endpoints: int = 256,
+                 spool: Optional[ReportSpool] = None):
         self.session = session
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.max_endpoints = max_endpoints
+        self.spool = spool
+        self._queues: 'OrderedDict[str, _EndpointQueue]' = OrderedDict()
+        self._sending: Set[asyncio.Task] = set()
+        self._closing = False
 
-    async def send_report(self, report_to: str, report_data: Dict[str, Any], max_retries: int = 3) -> bool:
+    def enqueue(self, report_to: str, report_data: Dict[str, Any]) -> bool:
         """
-        Envía un informe a la URL report_to de forma asíncrona y con reintentos.
-        Retorna True si se envió con éxito, False en caso contrario.
+        Encola un reporte para report_to sin bloquear.
+        Retorna False si no se encoló (sin URL o cliente cerrándose).
         """
-        if not report_to:
-            logger.warning("No report_to URL provided. Skipping report.")
+        if not report_to or self._closing:
             return False
 
+        queue = self._queues.get(report_to)
+        if queue is None:
+            queue = self._queues[report_to] = _EndpointQueue(self.max_buffer, self.max_concurrency)
+            while len(self._queues) > self.max_endpoints:
+                self._retire(*self._queues.popitem(last=False))
+        else:
+            self._queues.move_to_end(report_to)
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.get_running_loop().create_task(self._run(report_to, queue))
+
+        if len(queue.buffer) == queue.buffer.maxlen:
+            REPORT_DROPPED.labels(endpoint=ENDPOINT_LABELS.limit(report_to)).inc()
+        queue.buffer.append(self._payload(report_data))
+        if len(queue.buffer) >= self.batch_size:
+            queue.ready.set()
+        return True
+
+    @staticmethod
+    def _payload(report_data: Dict[str, Any]) -> Dict[str, Any]:
         # Añadir timestamp y versión al reporte
-        payload = {
+        return {
             "version": "1.0",
             "generated_at": time.time(),
             **report_data
         }
 
+    async def _run(self, report_to: str, queue: _EndpointQueue):
+        """Worker por endpoint: vacía el buffer por tamaño o por intervalo."""
+        idle_since = time.monotonic()
+        while not self._closing:
+            try:
+                await asyncio.wait_for(queue.ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            queue.ready.clear()
+
+            if queue.buffer:
+                idle_since = time.monotonic()
+                await self._drain(report_to, queue)
+            elif time.monotonic() - idle_since > self.idle_timeout:
+                # Endpoint inactivo: liberar su cola
+                if self._queues.get(report_to) is queue:
+                    del self._queues[report_to]
+                return
+
+    def _retire(self, report_to: str, queue: _EndpointQueue) -> None:
+        if queue.worker is not None:
+            queue.worker.cancel()
+        task = asyncio.get_running_loop().create_task(self._drain(report_to, queue))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _drain(self, report_to: str, queue: _EndpointQueue, max_retries: Optional[int] = None):
+        while queue.buffer:
+            await queue.slots.acquire()
+            batch = [queue.buffer.popleft() for _ in range(min(self.batch_size, len(queue.buffer)))]
+            if not batch:
+                queue.slots.release()
+                return
+            task = asyncio.get_running_loop().create_task(
+                self._send_batch(report_to, batch, queue, max_retries))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send_batch(self, report_to: str, batch: List[Dict[str, Any]], queue: _EndpointQueue,
+                          max_retries: Optional[int]):
+        try:
+            if self.spool is not None:
+                max_retries = 0
+            retries = self.max_retries if max_retries is None else max_retries
+            if not await self._post(report_to, batch, retries) and self.spool is not None:
+                await self.spool.append(report_to, batch)
+        finally:
+            queue.slots.release()
+
+    def start(self):
+        """Arranca el reenvío de lo que haya en el spool (también de ejecuciones previas)."""
+        if self.spool is not None:
+            self.spool.start(self._deliver_spooled)
+
+    async def _deliver_spooled(self, report_to: str, reports: List[Dict[str, Any]]) -> bool:
+        return await self._post(report_to, reports, 0)
+
+    async def flush(self):
+        """Envía todo lo pendiente y espera a los envíos en vuelo."""
+        for report_to, queue in list(self._queues.items()):
+            await self._drain(report_to, queue, max_retries=0 if self._closing else None)
+        while self._sending:
+            # Un endpoint expulsado puede lanzar envíos nuevos mientras se espera
+            await asyncio.gather(*list(self._sending), return_exceptions=True)
+
+    async def close(self, timeout: float = 5.0):
+        """Parada ordenada: deja de aceptar reportes y vacía los buffers."""
+        self._closing = True
+        for queue in self._queues.values():
+            queue.ready.set()
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Timed out flushing pending reports on shutdown")
+        workers = [q.worker for q in self._queues.values() if q.worker is not None]
+        for task in workers + list(self._sending):
+            task.cancel()
+        await asyncio.gather(*workers, *list(self._sending), return_exceptions=True)
+        self._queues.clear()
+        if self.spool is not None:
+            await self.spool.close()
+
+    async def send_report(self, report_to: str, report_data: Dict[str, Any], max_retries: int = 3) -> bool:
+        """
+        Envía un informe a la URL report_to de forma asíncrona y con reintentos.
+        Retorna True si se envió con éxito, False en caso contrario.
+        """
+        if not report_to:
+            logger.warning("No report_to URL provided. Skipping report.")
+            return False
+
+        return await self._post(report_to, self._payload(report_data), max_retries)
+
+    async def _post(self, report_to: str, payload: Any, max_retries: int) -> bool:
+        """POST con reintentos y backoff exponencial; payload es un reporte o un lote."""
         headers = {
             "Content-Type": "application/json",
             "User-Agent": "Adfree-Proxy/0.1"
         }
+        timeout = ClientTimeout(total=self.request_timeout)
+        endpoint = ENDPOINT_LABELS.limit(report_to)
 
         for attempt in range(max_retries + 1):
             try:
-                async with self.session.post(report_to, json=payload, headers=headers, timeout=10) as resp:
+                async with self.session.post(report_to, json=payload, headers=headers, timeout=timeout) as resp:
                     if resp.status in (200, 201, 202, 204):
                         logger.info(f"Report sent successfully to {report_to}")
-                        REPORT_SENT.labels(endpoint=report_to, status=str(resp.status)).inc()
+                        REPORT_SENT.labels(endpoint=endpoint, status=str(resp.status)).inc()
                         return True
                     else:
                         logger.warning(f"Report failed with status {resp.status} on attempt {attempt + 1}")
-                        REPORT_FAILED.labels(endpoint=report_to, reason=f"HTTP_{resp.status}").inc()
+                        REPORT_FAILED.labels(endpoint=endpoint, reason=f"HTTP_{resp.status}").inc()
 
             except asyncio.TimeoutError:
                 logger.warning(f"Timeout sending report to {report_to} (attempt {attempt + 1})")
-                REPORT_FAILED.labels(endpoint=report_to, reason="timeout").inc()
+                REPORT_FAILED.labels(endpoint=endpoint, reason="timeout").inc()
 
             except ClientError as e:
                 logger.error(f"Network error sending report to {report_to}: {e} (attempt {attempt + 1})")
-                REPORT_FAILED.labels(endpoint=report_to, reason="network_error").inc()
+                REPORT_FAILED.labels(endpoint=endpoint, reason="network_error").inc()
 
             except Exception as e:
                 logger.error(f"Unexpected error sending report to {report_to}: {e} (attempt {attempt + 1})")
-                REPORT_FAILED.labels(endpoint=report_to, reason="unexpected_error").inc()
+                REPORT_FAILED.labels(endpoint=endpoint, reason="unexpected_error").inc()
 
             # Si no es el último intento, esperar con backoff exponencial
             if attempt < max_retries:
@@ -72,8 +237,12 @@ class ReportClient:
         Reporta una violación de política (ej: anuncio extra, iframe bloqueado, redirección bloqueada).
         Solo si policy.mode == "report-only" o si se quiere reportar en modo strict (opcional).
         """
+        self.enqueue_violation(policy, violation)
+
+    def enqueue_violation(self, policy: 'AdfreePolicy', violation: Dict[str, Any]) -> bool:
+        """Versión síncrona de report_policy_violation: encola en el lote de report_to."""
         if not policy.report_to:
-            return
+            return False
 
         report_data = {
             "type": "policy_violation",
@@ -86,8 +255,8 @@ class ReportClient:
             }
         }
 
-        # Enviar de forma fire-and-forget
-        asyncio.create_task(self.send_report(policy.report_to, report_data))
+        # Se envía en el siguiente lote del endpoint
+        return self.enqueue(policy.report_to, report_data)
 
     async def report_invalid_policy(self, origin: str, error: str, raw_policy: Optional[str] = None):
         """
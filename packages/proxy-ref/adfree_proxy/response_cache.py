@@ -0,0 +1,384 @@
+# adfree_proxy/response_cache.py
+
+"""
+Caché de HTML ya reescrito.
+
+Una página cacheable que el upstream sirve igual una y otra vez no necesita
+pasar de nuevo por HtmlRewriter: se guarda la salida reescrita (sin
+comprimir) junto con los validadores del upstream (ETag / Last-Modified),
+el digest de la política con la que se reescribió, la versión de las reglas
+del operador y las violaciones encontradas. Mientras la entrada esté fresca según el Cache-Control del
+upstream y la política activa del origen sea la misma, se sirve sin
+contactar al upstream; al caducar se revalida con una petición condicional
+y un 304 la renueva.
+
+Dos niveles: memoria (LRU acotado en bytes) y, opcionalmente, disco (un
+fichero por URL, acotado en bytes). Las variantes comprimidas de cada
+entrada se generan al primer uso y cuentan en el tamaño en memoria.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from multidict import CIMultiDict
+
+from .compression import CompressionConfig, StreamEncoder
+from .metrics import REWRITE_CACHE_EVICTIONS, REWRITE_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Cabeceras que un 304 no puede cambiar en la entrada guardada
+_NOT_UPDATED_BY_304 = frozenset({'content-length', 'content-encoding', 'transfer-encoding', 'content-type'})
+
+# Coste fijo aproximado de una entrada (cabeceras, objeto, claves)
+_ENTRY_OVERHEAD = 512
+
+# Versión del formato en disco; las entradas de otro formato se descartan al leerlas
+CACHE_FORMAT = 2
+
+
+def parse_cache_control(header: Optional[str]) -> Dict[str, Optional[str]]:
+    """Cache-Control como {directiva: valor o None}, directivas en minúsculas."""
+    directives = {}
+    for item in (header or '').split(','):
+        name, _, value = item.strip().partition('=')
+        if name:
+            directives[name.strip().lower()] = value.strip().strip('"') or None
+    return directives
+
+
+def _seconds(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness_lifetime(directives: Dict[str, Optional[str]]) -> float:
+    """Segundos de frescura para una caché compartida (s-maxage > max-age)."""
+    if 'no-cache' in directives:
+        return 0.0
+    for name in ('s-maxage', 'max-age'):
+        seconds = _seconds(directives.get(name))
+        if seconds is not None:
+            return seconds
+    return 0.0
+
+
+def request_bypasses_cache(headers) -> bool:
+    """La petición no puede usar ni llenar la caché (no-store, credenciales)."""
+    if 'Authorization' in headers:
+        return True
+    return 'no-store' in parse_cache_control(headers.get('Cache-Control'))
+
+
+def request_forces_revalidation(headers) -> bool:
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-cache' in directives or _seconds(directives.get('max-age')) == 0:
+        return True
+    return 'no-cache' in headers.get('Pragma', '')
+
+
+def response_is_storable(status: int, headers) -> bool:
+    """Respuesta 200 que una caché compartida puede guardar y reutilizar."""
+    if status != 200 or 'Set-Cookie' in headers:
+        return False
+    directives = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in directives or 'private' in directives:
+        return False
+    vary = {v.strip().lower() for v in ','.join(headers.getall('Vary', [])).split(',') if v.strip()}
+    if vary - {'accept-encoding'}:
+        return False
+    # Sin frescura ni validadores la entrada nunca se podría reutilizar
+    return freshness_lifetime(directives) > 0 or 'ETag' in headers or 'Last-Modified' in headers
+
+
+def merge_304_headers(stored: List[Tuple[str, str]], headers) -> CIMultiDict:
+    """Cabeceras guardadas actualizadas con las de un 304 (RFC 9111 §4.3.4)."""
+    merged = CIMultiDict(stored)
+    for name in set(headers.keys()):
+        if name.lower() not in _NOT_UPDATED_BY_304:
+            merged.popall(name, None)
+            for value in headers.getall(name):
+                merged.add(name, value)
+    return merged
+
+
+class CachedResponse:
+    __slots__ = ('status', 'headers', 'body', 'policy_digest', 'violations', 'upstream_size',
+                 'stored_at', 'expires_at', 'rules_version', '_encoded')
+
+    def __init__(self, status: int, headers: List[Tuple[str, str]], body: bytes, policy_digest: Optional[bytes],
+                 violations: List[Tuple[str, str, str]], upstream_size: int, stored_at: float, expires_at: float,
+                 rules_version: str = ''):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.policy_digest = policy_digest
+        self.violations = violations
+        self.upstream_size = upstream_size
+        self.stored_at = stored_at
+        self.expires_at = expires_at
+        # Versión de las reglas del operador con la que se reescribió
+        self.rules_version = rules_version
+        self._encoded: Dict[str, bytes] = {}
+
+    def header(self, name: str) -> Optional[str]:
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    @property
+    def size(self) -> int:
+        return (_ENTRY_OVERHEAD + len(self.body) + sum(len(v) for v in self._encoded.values())
+                + sum(len(k) + len(v) for k, v in self.headers))
+
+    def encoded(self, encoding: str, config: Optional[CompressionConfig] = None) -> bytes:
+        """Cuerpo en la codificación pedida; cada variante se comprime una vez."""
+        if encoding == 'identity':
+            return self.body
+        body = self._encoded.get(encoding)
+        if body is None:
+            encoder = StreamEncoder(encoding, config)
+            body = self._encoded[encoding] = encoder.compress(self.body) + encoder.finish()
+        return body
+
+    def validators(self) -> Dict[str, str]:
+        """Cabeceras condicionales para revalidar la entrada contra el upstream."""
+        conditional = {}
+        etag = self.header('ETag')
+        if etag:
+            conditional['If-None-Match'] = etag
+        last_modified = self.header('Last-Modified')
+        if last_modified:
+            conditional['If-Modified-Since'] = last_modified
+        return conditional
+
+    def _metadata(self) -> Dict:
+        return {
+            'status': self.status,
+            'headers': self.headers,
+            'policy_digest': self.policy_digest.hex(),
+            'violations': self.violations,
+            'upstream_size': self.upstream_size,
+            'stored_at': self.stored_at,
+            'expires_at': self.expires_at,
+            'rules_version': self.rules_version,
+            'format': CACHE_FORMAT,
+        }
+
+    @classmethod
+    def _from_metadata(cls, meta: Dict, body: bytes) -> 'CachedResponse':
+        if meta.get('format') != CACHE_FORMAT:
+            raise ValueError(f"cache format {meta.get('format')}, expected {CACHE_FORMAT}")
+        return cls(meta['status'], [tuple(h) for h in meta['headers']], body,
+                   bytes.fromhex(meta['policy_digest']), [tuple(v) for v in meta['violations']],
+                   meta['upstream_size'], meta['stored_at'], meta['expires_at'], meta.get('rules_version', ''))
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024,
+                 max_entry_bytes: int = 4 * 1024 * 1024,
+                 directory: Optional[str] = None,
+                 max_disk_bytes: int = 1024 * 1024 * 1024,
+                 clock: Callable[[], float] = time.time):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        # Reloj de pared: las entradas en disco sobreviven a reinicios
+        self.clock = clock
+        self._entries: 'OrderedDict[str, CachedResponse]' = OrderedDict()
+        self._bytes = 0
+        self._disk: 'OrderedDict[str, int]' = OrderedDict()  # nombre de fichero -> tamaño
+        self._disk_bytes = 0
+        # Un solo hilo de E/S: escrituras, lecturas y borrados del mismo fichero van en orden
+        self._io: Optional[ThreadPoolExecutor] = None
+        self._pending_io = set()
+        # Nombre de fichero -> versión de la última escritura pedida; una escritura
+        # pendiente que ya no es la última (o cuya entrada se invalidó) no se hace
+        self._write_versions: Dict[str, int] = {}
+        self._last_version = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        return entry.expires_at > self.clock()
+
+    def age(self, entry: CachedResponse) -> int:
+        return max(0, int(self.clock() - entry.stored_at))
+
+    # --- memoria -----------------------------------------------------------
+
+    async def get(self, url: str) -> Optional[CachedResponse]:
+        """Entrada para la URL (fresca o no); None si no hay ninguna."""
+        entry = self._entries.get(url)
+        if entry is not None:
+            self._entries.move_to_end(url)
+            return entry
+        if not self.directory:
+            return None
+        name = self._file_name(url)
+        if name not in self._disk:
+            return None
+        entry = await self._run(self._disk_read, name)
+        if entry is not None:
+            self._remember(url, entry)
+        return entry
+
+    def put(self, url: str, entry: CachedResponse) -> None:
+        if len(entry.body) > self.max_entry_bytes:
+            return
+        self._remember(url, entry)
+        if self.directory:
+            self._schedule_disk_write(self._file_name(url), entry)
+
+    def refresh(self, url: str, entry: CachedResponse, headers, ttl: float) -> None:
+        """Renueva una entrada tras un 304: cabeceras nuevas y nueva caducidad."""
+        before = entry.size
+        entry.headers = list(merge_304_headers(entry.headers, headers).items())
+        entry.stored_at = self.clock()
+        entry.expires_at = entry.stored_at + ttl
+        if self._entries.get(url) is entry:
+            self._bytes += entry.size - before
+            self._evict()
+        if self.directory:
+            self._schedule_disk_write(self._file_name(url), entry)
+
+    def invalidate(self, url: str) -> None:
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            self._bytes -= entry.size
+            REWRITE_CACHE_SIZE.labels(tier='memory').set(self._bytes)
+        if self.directory:
+            name = self._file_name(url)
+            if name in self._disk:
+                self._disk_bytes -= self._disk.pop(name)
+                self._schedule_remove(name)
+                REWRITE_CACHE_SIZE.labels(tier='disk').set(self._disk_bytes)
+
+    def encoded(self, url: str, entry: CachedResponse, encoding: str,
+                config: Optional[CompressionConfig] = None) -> bytes:
+        """Como CachedResponse.encoded, contando la variante nueva en el tamaño."""
+        before = entry.size
+        body = entry.encoded(encoding, config)
+        if self._entries.get(url) is entry and entry.size != before:
+            self._bytes += entry.size - before
+            self._evict()
+        return body
+
+    def _remember(self, url: str, entry: CachedResponse) -> None:
+        old = self._entries.pop(url, None)
+        if old is not None:
+            self._bytes -= old.size
+        self._entries[url] = entry
+        self._bytes += entry.size
+        self._evict()
+
+    def _evict(self) -> None:
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            REWRITE_CACHE_EVICTIONS.labels(tier='memory').inc()
+        REWRITE_CACHE_SIZE.labels(tier='memory').set(self._bytes)
+
+    # --- disco -------------------------------------------------------------
+
+    @staticmethod
+    def _file_name(url: str) -> str:
+        return hashlib.sha256(url.encode('utf-8')).hexdigest() + '.cache'
+
+    def _load_disk_index(self) -> None:
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.cache'):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+            elif name.endswith('.tmp'):
+                self._remove_file(name)
+        for _, name, size in sorted(files):
+            self._disk[name] = size
+            self._disk_bytes += size
+        REWRITE_CACHE_SIZE.labels(tier='disk').set(self._disk_bytes)
+
+    def _disk_read(self, name: str) -> Optional[CachedResponse]:
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                meta = json.loads(f.readline())
+                return CachedResponse._from_metadata(meta, f.read())
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Discarding unreadable cache file {name}: {e}")
+            return None
+
+    def _schedule_disk_write(self, name: str, entry: CachedResponse) -> None:
+        data = json.dumps(entry._metadata(), separators=(',', ':')).encode('utf-8') + b'\n' + entry.body
+        self._disk_bytes += len(data) - self._disk.pop(name, 0)
+        self._disk[name] = len(data)
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+            oldest, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._schedule_remove(oldest)
+            REWRITE_CACHE_EVICTIONS.labels(tier='disk').inc()
+        REWRITE_CACHE_SIZE.labels(tier='disk').set(self._disk_bytes)
+
+        self._last_version += 1
+        version = self._write_versions[name] = self._last_version
+        future = self._run(self._disk_write, name, data, version)
+        future.add_done_callback(lambda _: self._write_done(name, version))
+
+    def _write_done(self, name: str, version: int) -> None:
+        if self._write_versions.get(name) == version:
+            del self._write_versions[name]
+
+    def _schedule_remove(self, name: str) -> None:
+        # Anula la escritura pendiente y borra detrás de ella, en el mismo hilo
+        self._write_versions.pop(name, None)
+        self._run(self._remove_file, name)
+
+    def _run(self, fn, *args) -> Awaitable:
+        """Ejecuta fn en el hilo de E/S de la caché, registrándolo para close()."""
+        if self._io is None:
+            self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='adfree-cache')
+        future = asyncio.get_running_loop().run_in_executor(self._io, fn, *args)
+        self._pending_io.add(future)
+        future.add_done_callback(self._pending_io.discard)
+        return future
+
+    def _disk_write(self, name: str, data: bytes, version: int) -> None:
+        if self._write_versions.get(name) != version:
+            return
+        path = os.path.join(self.directory, name)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Could not write cache file {name}: {e}")
+
+    def _remove_file(self, name: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+    async def close(self) -> None:
+        """Espera a las operaciones en disco pendientes y para el hilo de E/S."""
+        if self._pending_io:
+            await asyncio.gather(*self._pending_io, return_exceptions=True)
+        if self._io is not None:
+            self._io.shutdown(wait=False)
+            self._io = None
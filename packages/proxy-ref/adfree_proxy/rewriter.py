@@ -0,0 +1,277 @@
+# adfree_proxy/rewriter.py
+
+"""
+Reescritura incremental de HTML.
+
+HtmlRewriter procesa el cuerpo por trozos a medida que llega del upstream y
+aplica toda la política en una sola pasada: una única expresión regular
+localiza las etiquetas que importan y cada una se clasifica al encontrarla.
+
+- <iframe>: se elimina si su src apunta a un dominio bloqueado o a un host
+  que allow_iframes no permite.
+- <script src>: se elimina si apunta a un dominio bloqueado. El contenido de
+  los scripts que se conservan se copia sin analizar (un "</body>" dentro de
+  una cadena JavaScript no es el cierre del documento).
+- Huecos de anuncio (etiquetas con data-ad-slot/data-ad-client/data-ad-unit
+  o clase adsbygoogle, incluidos iframes; en minúsculas): se cuentan y a
+  partir de max_ads_per_page se eliminan con su contenido.
+- El script anti-redirecciones se inyecta antes de </head> (o </body>).
+
+Trabaja sobre bytes (los delimitadores HTML son ASCII, compatibles con
+UTF-8) y solo retiene entre trozos una etiqueta partida, así que la memoria
+no depende del tamaño de la página y el coste es lineal en su tamaño.
+"""
+
+import re
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+from .matcher import DomainMatcher, IframeAllowlist
+
+REDIRECT_BLOCKER_SCRIPT = (
+    b'<script>'
+    b'(function(){var originalOpen=window.open; window.open=function(){return null;};})();'
+    b'</script>'
+)
+
+# Tipos de violación: (url, regla, tipo) en HtmlRewriter.violations
+IFRAME_BLOCKED = 'iframe_blocked'
+SCRIPT_BLOCKED = 'script_blocked'
+IFRAME_NOT_ALLOWED = 'iframe_not_allowed'
+AD_LIMIT = 'ad_limit'
+
+_AD_MARKER = (
+    rb'''\s(?:data-ad-(?:slot|client|unit)\b|class\s*=\s*["']?[^"'>]*?\badsbygoogle\b)'''
+)
+# Literales que delatan un posible hueco de anuncio. Se buscan con bytes.find
+# (mucho más rápido que añadir a la regex una alternativa que mire los
+# atributos de cada etiqueta) y se confirman con _AD_MARKER_RE.
+_AD_LITERALS = (b'data-ad-', b'adsbygoogle')
+
+# Etiquetas relevantes: apertura de iframe/script y cierre de head/body
+_INTERESTING_RE = re.compile(rb'<(?:(iframe|script)(?=[\s/>])|/(head|body)\s*>)', re.IGNORECASE)
+_TAG_NAME_RE = re.compile(rb'<([a-zA-Z][a-zA-Z0-9-]*)(?=[\s/])')
+_AD_MARKER_RE = re.compile(_AD_MARKER, re.IGNORECASE)
+_END_RE = {
+    b'iframe': re.compile(rb'</iframe\s*>', re.IGNORECASE),
+    b'script': re.compile(rb'</script\s*>', re.IGNORECASE),
+}
+_SRC_ATTR_RE = re.compile(
+    rb'''\ssrc\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''',
+    re.IGNORECASE,
+)
+
+# Elementos sin contenido: quitar el hueco de anuncio es quitar la etiqueta
+_VOID_TAGS = frozenset({b'img', b'input', b'embed', b'source', b'br', b'hr', b'link', b'meta'})
+_nesting_res: Dict[bytes, 're.Pattern'] = {}
+
+# Tamaño máximo de una etiqueta partida retenida entre trozos
+MAX_PENDING_TAG = 64 * 1024
+
+
+def iframe_src(tag: bytes) -> Optional[str]:
+    """URL http(s) (o relativa al protocolo) del atributo src de una etiqueta, si la hay."""
+    m = _SRC_ATTR_RE.search(tag)
+    if not m:
+        return None
+    src = (m.group(1) or m.group(2) or m.group(3) or b'').decode('utf-8', errors='ignore').strip()
+    if src.startswith('//'):
+        return src
+    if not src.lower().startswith(('http://', 'https://')):
+        return None
+    return src
+
+
+def _nesting_re(name: bytes):
+    """Aperturas y cierres de un nombre de etiqueta (para quitar un elemento con anidados)."""
+    pattern = _nesting_res.get(name)
+    if pattern is None:
+        pattern = re.compile(rb'<(/?)' + re.escape(name) + rb'(?=[\s/>])', re.IGNORECASE)
+        if len(_nesting_res) < 64:
+            _nesting_res[name] = pattern
+    return pattern
+
+
+class HtmlRewriter:
+    """
+    Reescritor HTML orientado a trozos.
+
+    feed() devuelve la salida lista para enviar; close() vacía lo retenido.
+    Las violaciones (url, regla, tipo) quedan en self.violations y el número
+    de huecos de anuncio vistos en self.ads.
+
+    allow_iframes None no restringe iframes; origin_host es el host de la
+    página (para 'self'). max_ads None no limita los anuncios.
+    """
+
+    def __init__(self, blocked: Union[DomainMatcher, Iterable[str]] = (), inject_script: Optional[bytes] = None,
+                 allow_iframes: Optional[IframeAllowlist] = None, origin_host: Optional[str] = None,
+                 max_ads: Optional[int] = None):
+        self.matcher = blocked if isinstance(blocked, DomainMatcher) else DomainMatcher(blocked)
+        self.inject_script = inject_script
+        self.allow_iframes = allow_iframes if allow_iframes is None or not allow_iframes.allow_all else None
+        self.origin_host = origin_host
+        self.max_ads = max_ads
+        self.violations: List[Tuple[str, str, str]] = []
+        self.ads = 0
+        self._pending = b''
+        # Contenido que se está saltando: (regex de cierre, se emite, profundidad o None)
+        self._skip: Optional[Tuple[object, bool, Optional[int]]] = None
+        self._injected = inject_script is None
+
+    def _classify(self, name: bytes, tag: bytes) -> Optional[Tuple[str, str, str]]:
+        """Violación por la que se elimina la etiqueta, o None si se conserva."""
+        src = iframe_src(tag) if name in _END_RE else None
+        host = (urlsplit(src).hostname or '') if src else None
+        if host and self.matcher:
+            rule = self.matcher.match(host)
+            if rule:
+                return (src, rule, SCRIPT_BLOCKED if name == b'script' else IFRAME_BLOCKED)
+        if name == b'script':
+            return None
+        if name == b'iframe' and self.allow_iframes is not None \
+                and not self.allow_iframes.allows(host, self.origin_host):
+            return (src or '', host or 'self', IFRAME_NOT_ALLOWED)
+        if _AD_MARKER_RE.search(tag) is None:
+            return None
+        self.ads += 1
+        if self.max_ads is not None and self.ads > self.max_ads:
+            return (src or '', 'max_ads_per_page', AD_LIMIT)
+        return None
+
+    def _skip_content(self, buf: bytes, pos: int, out: list) -> int:
+        """
+        Avanza sobre el contenido de un elemento eliminado (o de un script que
+        se conserva). Devuelve la posición tras su cierre, o -1 si el cierre
+        no ha llegado todavía.
+        """
+        end_re, emit, depth = self._skip
+        size = len(buf)
+        while True:
+            m = end_re.search(buf, pos)
+            if m is None:
+                break
+            if depth is None:
+                if emit:
+                    out.append(buf[pos:m.end()])
+                self._skip = None
+                return m.end()
+            gt = buf.find(b'>', m.end())
+            if gt == -1:
+                if size - m.start() <= MAX_PENDING_TAG:
+                    self._pending = buf[m.start():]
+                self._skip = (end_re, emit, depth)
+                return -1
+            depth += -1 if m.group(1) else (0 if buf[gt - 1:gt] == b'/' else 1)
+            pos = gt + 1
+            if depth == 0:
+                self._skip = None
+                return pos
+        self._skip = (end_re, emit, depth)
+        # Guarda un posible cierre partido
+        lt = buf.rfind(b'<', pos)
+        if lt != -1 and size - lt < 32:
+            self._pending = buf[lt:]
+        else:
+            lt = size
+        if emit:
+            out.append(buf[pos:lt])
+        return -1
+
+    def feed(self, chunk: bytes) -> bytes:
+        buf = self._pending + chunk if self._pending else chunk
+        self._pending = b''
+        out = []
+        pos = 0
+        size = len(buf)
+        # Siguiente aparición de cada literal de anuncio (-2: sin buscar, -1: no hay).
+        # Cada find continúa donde acabó el anterior: el coste total es lineal.
+        literals = [-2] * len(_AD_LITERALS)
+
+        while pos < size:
+            if self._skip is not None:
+                pos = self._skip_content(buf, pos, out)
+                if pos < 0:
+                    return b''.join(out)
+                continue
+
+            ad_at = size
+            for i, at in enumerate(literals):
+                if -1 != at < pos:
+                    at = literals[i] = buf.find(_AD_LITERALS[i], pos)
+                if at != -1 and at < ad_at:
+                    ad_at = at
+
+            m = _INTERESTING_RE.search(buf, pos, ad_at)
+            if m is not None:
+                start = m.start()
+                if m.group(2):
+                    out.append(buf[pos:start])
+                    if not self._injected:
+                        out.append(self.inject_script)
+                        self._injected = True
+                    out.append(m.group(0))
+                    pos = m.end()
+                    continue
+                name = m.group(1)
+                name_end = m.end()
+            elif ad_at < size:
+                # ¿El literal está dentro de una etiqueta de apertura?
+                start = buf.rfind(b'<', pos, ad_at)
+                t = _TAG_NAME_RE.match(buf, start) if start != -1 and buf.find(b'>', start, ad_at) == -1 else None
+                if t is None:
+                    out.append(buf[pos:ad_at + 1])
+                    pos = ad_at + 1
+                    continue
+                name = t.group(1)
+                name_end = ad_at
+            else:
+                break
+
+            end = buf.find(b'>', name_end)
+            if end == -1:
+                if size - start > MAX_PENDING_TAG:
+                    # No es una etiqueta razonable: se emite tal cual
+                    out.append(buf[pos:])
+                    return b''.join(out)
+                out.append(buf[pos:start])
+                self._pending = buf[start:]
+                return b''.join(out)
+            tag = buf[start:end + 1]
+            name = name.lower()
+            out.append(buf[pos:start])
+            pos = end + 1
+            hit = self._classify(name, tag)
+            if hit:
+                self.violations.append(hit)
+                if name in _END_RE:
+                    self._skip = (_END_RE[name], False, None)
+                elif name not in _VOID_TAGS and not tag.endswith(b'/>'):
+                    self._skip = (_nesting_re(name), False, 1)
+            else:
+                out.append(tag)
+                if name == b'script':
+                    self._skip = (_END_RE[name], True, None)
+
+        rest = buf[pos:]
+        lt = rest.rfind(b'<')
+        if lt != -1 and b'>' not in rest[lt:] and len(rest) - lt <= MAX_PENDING_TAG:
+            out.append(rest[:lt])
+            self._pending = rest[lt:]
+        else:
+            out.append(rest)
+        return b''.join(out)
+
+    def close(self) -> bytes:
+        # Lo retenido de un elemento eliminado se descarta
+        out = [self._pending] if self._skip is None or self._skip[1] else []
+        self._pending = b''
+        self._skip = None
+        if not self._injected:
+            out.append(self.inject_script)
+            self._injected = True
+        return b''.join(out)
+
+    def rewrite(self, body: bytes) -> bytes:
+        """Atajo para reescribir un cuerpo completo de una vez."""
+        return self.feed(body) + self.close()
@@ -0,0 +1,243 @@
+# adfree_proxy/rules.py
+
+"""
+Reglas locales del operador del proxy.
+
+El fichero de reglas (policy.rules_path en config.yaml; JSON, o YAML si la
+extensión es .yaml/.yml) añade dominios bloqueados a todas las políticas y
+permite sobrescribir campos de la política de orígenes concretos:
+
+    {
+      "blocked_domains": ["*.doubleclick.net"],
+      "origins": {
+        "news.example.com": {"blocked_domains": ["ads.partner.com"], "allow_redirects": false},
+        "*.example.org": {"mode": "report-only", "report_sample_rate": 1.0}
+      }
+    }
+
+Las reglas se compilan una vez (DomainMatcher) en un RuleSet inmutable. La
+política efectiva de un origen no fusiona listas: consulta en cadena el
+matcher de la política y los del operador, ya compilados. Al
+recargar, el RuleSet nuevo se construye entero fuera del event loop y se
+publica con una sola asignación: una request en curso usa el RuleSet que
+tomó al empezar, nunca uno a medio construir. Si el fichero nuevo no es
+válido se conserva el anterior.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
+
+from .matcher import DomainMatcher, MatcherChain
+from .metrics import RULES_RELOADS, RULES_RELOAD_SECONDS, RULES_SIZE
+from .utils import strip_port
+
+if TYPE_CHECKING:
+    from .schema import AdfreePolicy, OriginRules, RulesFile
+
+logger = logging.getLogger(__name__)
+
+# Campos de AdfreePolicy que una regla de origen puede sobrescribir
+OVERRIDE_FIELDS = ('mode', 'max_ads_per_page', 'allow_redirects', 'allow_iframes', 'report_to')
+
+# Coste aproximado en memoria de una entrada del memo y de cada dominio de la
+# política del origen que retiene (cadena, slot de la lista y del matcher)
+_MEMO_OVERHEAD = 1024
+_DOMAIN_OVERHEAD = 160
+
+
+def _memo_size(policy: 'AdfreePolicy') -> int:
+    return _MEMO_OVERHEAD + sum(len(d) + _DOMAIN_OVERHEAD for d in policy.blocked_domains)
+
+
+def __getattr__(name: str):
+    # Los esquemas (pydantic) se cargan al leer el primer fichero de reglas
+    if name in ('OriginRules', 'RulesFile'):
+        from . import schema
+        return getattr(schema, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class RuleSet:
+    """Reglas compiladas; inmutable una vez publicado."""
+
+    def __init__(self, rules: Optional['RulesFile'] = None, version: str = '',
+                 max_memo_bytes: int = 32 * 1024 * 1024):
+        self.version = version
+        self.blocked_domains = tuple(dict.fromkeys(rules.blocked_domains)) if rules is not None else ()
+        self.blocked_matcher = DomainMatcher(self.blocked_domains)
+        self.origins: Dict[str, 'OriginRules'] = dict(rules.origins) if rules is not None else {}
+        # Los patrones de origen se resuelven con el mismo matcher que los dominios
+        self._origin_matcher = DomainMatcher(self.origins)
+        self._origin_blocked = {pattern: DomainMatcher(r.blocked_domains) for pattern, r in self.origins.items()}
+        self.max_memo_bytes = max_memo_bytes
+        # origin -> (política del origen, política efectiva, tamaño estimado)
+        self._memo: 'OrderedDict[str, Tuple[AdfreePolicy, AdfreePolicy, int]]' = OrderedDict()
+        self._memo_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self.blocked_domains) + sum(len(r.blocked_domains) for r in self.origins.values())
+
+    @property
+    def empty(self) -> bool:
+        return not self.blocked_domains and not self.origins
+
+    @property
+    def memo_bytes(self) -> int:
+        return self._memo_bytes
+
+    def _pattern_for(self, origin: str) -> Optional[str]:
+        return self._origin_matcher.match(strip_port(origin))
+
+    def rules_for(self, origin: str) -> Optional['OriginRules']:
+        pattern = self._pattern_for(origin)
+        return self.origins[pattern] if pattern is not None else None
+
+    def apply(self, origin: str, policy: 'AdfreePolicy') -> 'AdfreePolicy':
+        """
+        Política efectiva: la del origen con sus campos sobrescritos y un
+        blocked_matcher que consulta también los dominios del operador
+        (blocked_domains sigue siendo la lista del origen). Es una copia
+        superficial: los matchers compilados se comparten, no se copian.
+        """
+        if self.empty:
+            return policy
+        memo = self._memo.get(origin)
+        if memo is not None and memo[0] is policy:
+            self._memo.move_to_end(origin)
+            return memo[1]
+
+        pattern = self._pattern_for(origin)
+        rules = self.origins[pattern] if pattern is not None else None
+        overrides = {}
+        if rules is not None:
+            for field in OVERRIDE_FIELDS:
+                value = getattr(rules, field)
+                if value is not None:
+                    overrides[field] = value
+        # Los valores de OriginRules ya se validaron al cargar el fichero
+        effective = policy.model_copy(update=overrides)
+        effective._blocked_matcher = MatcherChain(
+            policy.blocked_matcher, self.blocked_matcher,
+            self._origin_blocked[pattern] if pattern is not None else DomainMatcher())
+        effective._iframe_allowlist = None if 'allow_iframes' in overrides else policy.iframe_allowlist
+
+        if memo is not None:
+            self._memo_bytes -= memo[2]
+        size = _memo_size(policy)
+        self._memo[origin] = (policy, effective, size)
+        self._memo.move_to_end(origin)
+        self._memo_bytes += size
+        while self._memo_bytes > self.max_memo_bytes and len(self._memo) > 1:
+            self._memo_bytes -= self._memo.popitem(last=False)[1][2]
+        return effective
+
+
+def load_rules_file(path: str) -> RuleSet:
+    """Lee, valida y compila el fichero de reglas (lanza excepción si no es válido)."""
+    from .schema import RulesFile
+
+    with open(path, 'rb') as f:
+        raw = f.read()
+    if path.endswith(('.yaml', '.yml')):
+        import yaml
+        data = yaml.safe_load(raw) or {}
+    else:
+        data = json.loads(raw) if raw.strip() else {}
+    rules = RulesFile.model_validate(data)
+    return RuleSet(rules, version=hashlib.sha256(raw).hexdigest()[:16])
+
+
+class RuleStore:
+    """
+    RuleSet vigente del proxy, recargado al cambiar el fichero (sondeo de
+    mtime/tamaño cada poll_interval) o con reload() (SIGHUP).
+    """
+
+    def __init__(self, path: Optional[str] = None, poll_interval: float = 2.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.current = RuleSet()
+        self._stamp = None
+        self._watcher: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self.on_reload = []  # callbacks(ruleset) tras cada recarga correcta
+
+    def _file_stamp(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def load(self) -> bool:
+        """Carga síncrona (arranque)."""
+        if not self.path:
+            return False
+        stamp = self._file_stamp()
+        started = time.perf_counter()
+        try:
+            ruleset = load_rules_file(self.path)
+        except Exception as e:
+            return self._failed(e)
+        return self._publish(ruleset, stamp, time.perf_counter() - started)
+
+    async def reload(self) -> bool:
+        """Recarga fuera del event loop y publica el RuleSet nuevo de una vez."""
+        if not self.path:
+            return False
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            stamp = self._file_stamp()
+            started = time.perf_counter()
+            try:
+                ruleset = await asyncio.get_running_loop().run_in_executor(None, load_rules_file, self.path)
+            except Exception as e:
+                return self._failed(e)
+            return self._publish(ruleset, stamp, time.perf_counter() - started)
+
+    def _publish(self, ruleset: RuleSet, stamp, seconds: float) -> bool:
+        self._stamp = stamp
+        changed = ruleset.version != self.current.version
+        if changed:
+            self.current = ruleset  # Swap atómico
+            for callback in self.on_reload:
+                callback(ruleset)
+        RULES_RELOADS.labels(result='success').inc()
+        RULES_RELOAD_SECONDS.observe(seconds)
+        RULES_SIZE.labels(kind='blocked_domains').set(len(ruleset))
+        RULES_SIZE.labels(kind='origins').set(len(ruleset.origins))
+        logger.info(f"Loaded {len(ruleset)} blocked domains and {len(ruleset.origins)} origin rules "
+                    f"from {self.path} in {seconds * 1000:.1f} ms (version {ruleset.version or 'empty'})")
+        return changed
+
+    def _failed(self, error: Exception) -> bool:
+        # Se conserva el RuleSet anterior
+        self._stamp = self._file_stamp()
+        RULES_RELOADS.labels(result='failure').inc()
+        logger.error(f"Could not load rules from {self.path}, keeping version "
+                     f"{self.current.version or 'empty'}: {error}")
+        return False
+
+    def start(self) -> None:
+        """Arranca el sondeo del fichero en el loop actual."""
+        if self.path and self.poll_interval > 0 and (self._watcher is None or self._watcher.done()):
+            self._watcher = asyncio.get_running_loop().create_task(self._watch())
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if self._file_stamp() != self._stamp:
+                await self.reload()
+
+    async def close(self) -> None:
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+            self._watcher = None
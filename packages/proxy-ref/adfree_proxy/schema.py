@@ -0,0 +1,126 @@
+# adfree_proxy/schema.py
+
+"""
+Esquemas pydantic de la política Adfree y del fichero de reglas locales.
+
+Están aparte para que importar el proxy no cargue pydantic ni construya los
+modelos: policy.py y rules.py los importan la primera vez que validan algo
+(y los siguen exponiendo como adfree_proxy.policy.AdfreePolicy, etc.).
+"""
+
+import re
+from typing import Any, Dict, List, Optional, Literal, Tuple
+from urllib.parse import urlsplit
+
+from pydantic import BaseModel, Field, PrivateAttr, field_validator
+
+from .matcher import DomainMatcher, IframeAllowlist
+
+MODES = frozenset({"strict", "relaxed", "report-only"})
+
+# Lo que no puede ir dentro de <...> en una cabecera Link
+_LINK_UNSAFE = re.compile(r'[^\x21-\x7e]|[<>"]')
+
+
+def _check_mode(v: Optional[str]) -> Optional[str]:
+    if v is not None and v not in MODES:
+        raise ValueError('mode must be "strict", "relaxed", or "report-only"')
+    return v
+
+
+class BotPolicy(BaseModel):
+    allowed: bool = False
+    payment_required: bool = True
+    payment_url: str
+    rate_limit: Optional[Dict[str, Any]] = None
+
+    _token_bucket: Optional[Tuple[float, float]] = PrivateAttr(default=None)
+
+    @property
+    def token_bucket(self) -> Optional[Tuple[float, float]]:
+        """
+        rate_limit ({"requests": N, "window": segundos, "burst": M opcional})
+        como (capacidad, tokens por segundo); None si no hay límite o no es
+        válido. Se calcula una vez por política.
+        """
+        if self._token_bucket is None and self.rate_limit:
+            try:
+                requests = float(self.rate_limit['requests'])
+                window = float(self.rate_limit.get('window', 60))
+                burst = float(self.rate_limit.get('burst', requests))
+            except (KeyError, TypeError, ValueError):
+                return None
+            if requests > 0 and window > 0 and burst >= 1:
+                self._token_bucket = (burst, requests / window)
+        return self._token_bucket
+
+    @property
+    def payment_link(self) -> Optional[str]:
+        """
+        Cabecera Link para payment_url; None si no es una URL http(s)
+        absoluta que se pueda poner tal cual en la cabecera.
+        """
+        if _LINK_UNSAFE.search(self.payment_url):
+            return None
+        try:
+            parts = urlsplit(self.payment_url)
+        except ValueError:
+            return None
+        if parts.scheme.lower() not in ('http', 'https') or not parts.hostname:
+            return None
+        return f'<{self.payment_url}>; rel="payment"'
+
+
+class AdfreePolicy(BaseModel):
+    version: Literal["1"] = "1"
+    mode: str  # "strict" | "relaxed" | "report-only"
+    max_ads_per_page: int = 3
+    allow_redirects: bool = False
+    allow_iframes: list[str] = Field(default_factory=lambda: ["self"])
+    blocked_domains: list[str] = Field(default_factory=list)
+    report_to: Optional[str] = None
+    bot_policy: Optional[BotPolicy] = None
+
+    _blocked_matcher: Optional[DomainMatcher] = PrivateAttr(default=None)
+    _iframe_allowlist: Optional[IframeAllowlist] = PrivateAttr(default=None)
+
+    @property
+    def blocked_matcher(self) -> DomainMatcher:
+        """blocked_domains compilado; se construye una vez por política."""
+        if self._blocked_matcher is None:
+            self._blocked_matcher = DomainMatcher(self.blocked_domains)
+        return self._blocked_matcher
+
+    @property
+    def iframe_allowlist(self) -> IframeAllowlist:
+        """allow_iframes compilado; se construye una vez por política."""
+        if self._iframe_allowlist is None:
+            self._iframe_allowlist = IframeAllowlist(self.allow_iframes)
+        return self._iframe_allowlist
+
+    validate_mode = field_validator('mode')(_check_mode)
+
+
+class OriginRules(BaseModel):
+    blocked_domains: List[str] = Field(default_factory=list)
+    mode: Optional[str] = None
+    max_ads_per_page: Optional[int] = None
+    allow_redirects: Optional[bool] = None
+    allow_iframes: Optional[List[str]] = None
+    report_to: Optional[str] = None
+    # Fracción de páginas report-only del origen que se escanean (no es un campo de la política)
+    report_sample_rate: Optional[float] = None
+
+    validate_mode = field_validator('mode')(_check_mode)
+
+    @field_validator('report_sample_rate')
+    @classmethod
+    def validate_sample_rate(cls, v):
+        if v is not None and not 0 <= v <= 1:
+            raise ValueError('report_sample_rate must be between 0 and 1')
+        return v
+
+
+class RulesFile(BaseModel):
+    blocked_domains: List[str] = Field(default_factory=list)
+    origins: Dict[str, OriginRules] = Field(default_factory=dict)
@@ -0,0 +1,204 @@
+# adfree_proxy/shared_cache.py
+
+"""
+Caché compartida entre los procesos del proxy de un mismo host.
+
+Con --workers (o varios proxies apuntando al mismo fichero) cada proceso
+pediría por su cuenta la clave de política de cada origen y verificaría de
+nuevo las mismas firmas. SharedCache es una tabla hash en un fichero
+mapeado en memoria: lo que publica un proceso (claves obtenidas, digests de
+políticas ya verificadas) lo ven los demás en la siguiente búsqueda.
+
+Formato: una cabecera y N slots de tamaño fijo. Cada entrada se indexa por
+un hash de 16 bytes de (tipo, clave) y vive en una ventana de PROBE slots
+contiguos a partir de hash % (N - PROBE + 1); si la ventana está llena se
+reemplaza la entrada que antes caduca.
+
+Cada slot lleva un contador de secuencia (seqlock): el escritor lo pone
+impar, escribe y lo vuelve a poner par. Los lectores no toman ningún lock:
+copian el slot y lo descartan si la secuencia cambió o era impar, o si el
+checksum del valor no cuadra (lectura a medias). Los escritores, poco
+frecuentes, se excluyen entre sí con un lock de fcntl sobre la ventana.
+
+La caducidad se guarda en tiempo de pared (time.time, común a todos los
+procesos) y se comprueba al leer.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import time
+from typing import Callable, Optional, Tuple
+
+from .metrics import SHARED_CACHE_EVICTIONS, SHARED_CACHE_RESULT
+
+MAGIC = b'ADFRSHC1'
+# magic, slots, tamaño de slot
+_HEADER = struct.Struct('<8sII')
+HEADER_SIZE = 64
+# secuencia, tipo, hash, caducidad, longitud del valor, checksum del valor
+_SLOT = struct.Struct('<IB3x16sdI8s')
+_SEQ = struct.Struct('<I')
+
+PROBE = 8
+READ_RETRIES = 3
+
+# Tipos de entrada (0: slot vacío)
+KIND_KEY = 1
+KIND_POLICY = 2
+
+# Resultado de _read para un slot que no se pudo leer estable
+_TORN = ('torn',)
+
+
+def _checksum(payload: bytes) -> bytes:
+    return hashlib.blake2b(payload, digest_size=8).digest()
+
+
+def entry_hash(kind: int, *parts: bytes) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    h.update(bytes((kind,)))
+    for part in parts:
+        h.update(len(part).to_bytes(4, 'little'))
+        h.update(part)
+    return h.digest()
+
+
+class SharedCache:
+    """
+    Tabla de slots en un mmap compartido. Sin path se usa un fichero temporal
+    ya borrado, que comparten los procesos creados con fork después. Si el
+    fichero ya existe se usan sus dimensiones, no las pedidas.
+
+    Lo que contiene evita pedir claves y verificar firmas, así que con path
+    solo se acepta un fichero (no un enlace simbólico) del usuario efectivo
+    en el que nadie más pueda escribir.
+    """
+
+    def __init__(self, path: Optional[str] = None, slots: int = 16384, slot_size: int = 1024,
+                 clock: Callable[[], float] = time.time):
+        self.path = path
+        self.clock = clock
+        size = HEADER_SIZE + slots * slot_size
+        if path is None:
+            self._file = tempfile.TemporaryFile()
+        else:
+            self._file = open(os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600), 'r+b')
+            st = os.fstat(self._file.fileno())
+            if st.st_uid != os.geteuid() or st.st_mode & 0o022:
+                self._file.close()
+                raise PermissionError(f'{path} must be owned by this user and not writable by group or others')
+        fd = self._file.fileno()
+        # El primer proceso inicializa el fichero; los demás lo validan
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                if slots < PROBE:
+                    raise ValueError(f'slots must be at least {PROBE}')
+                if slot_size <= _SLOT.size:
+                    raise ValueError(f'slot_size must be larger than {_SLOT.size}')
+                os.ftruncate(fd, size)
+                os.pwrite(fd, _HEADER.pack(MAGIC, slots, slot_size), 0)
+            magic, slots, slot_size = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+            if magic != MAGIC or os.fstat(fd).st_size != HEADER_SIZE + slots * slot_size:
+                raise ValueError(f'{path} is not a shared cache file')
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_value = slot_size - _SLOT.size
+        self._mm = mmap.mmap(fd, HEADER_SIZE + slots * slot_size)
+
+    def _window(self, key: bytes) -> int:
+        return int.from_bytes(key[:8], 'little') % (self.slots - PROBE + 1)
+
+    def _offset(self, index: int) -> int:
+        return HEADER_SIZE + index * self.slot_size
+
+    def _read(self, offset: int) -> Optional[Tuple]:
+        """(tipo, hash, caducidad, valor) de un slot; None si está vacío, _TORN si no es estable."""
+        mm = self._mm
+        for _ in range(READ_RETRIES):
+            seq = _SEQ.unpack_from(mm, offset)[0]
+            if seq & 1:
+                continue
+            _, kind, key, expires_at, length, check = _SLOT.unpack_from(mm, offset)
+            if kind == 0:
+                return None  # Slot vacío
+            if length > self.max_value:
+                continue
+            start = offset + _SLOT.size
+            value = mm[start:start + length]
+            if _SEQ.unpack_from(mm, offset)[0] != seq or _checksum(value) != check:
+                continue
+            return kind, key, expires_at, value
+        return _TORN
+
+    def get(self, kind: int, key: bytes) -> Optional[Tuple[bytes, float]]:
+        """(valor, caducidad en tiempo de pared) si hay una entrada vigente."""
+        start = self._window(key)
+        torn = False
+        for index in range(start, start + PROBE):
+            slot = self._read(self._offset(index))
+            if slot is None:
+                continue
+            if slot is _TORN:
+                torn = True
+                continue
+            slot_kind, slot_key, expires_at, value = slot
+            if slot_kind != kind or slot_key != key:
+                continue
+            if expires_at <= self.clock():
+                SHARED_CACHE_RESULT['expired'].inc()
+                return None
+            SHARED_CACHE_RESULT['hit'].inc()
+            return value, expires_at
+        SHARED_CACHE_RESULT['torn' if torn else 'miss'].inc()
+        return None
+
+    def put(self, kind: int, key: bytes, value: bytes, expires_at: float) -> bool:
+        """Publica una entrada; False si no cabe en un slot."""
+        if len(value) > self.max_value:
+            return False
+        start = self._window(key)
+        fd = self._file.fileno()
+        window = PROBE * self.slot_size
+        fcntl.lockf(fd, fcntl.LOCK_EX, window, self._offset(start))
+        try:
+            now = self.clock()
+            target = victim = None
+            victim_expires = float('inf')
+            for index in range(start, start + PROBE):
+                offset = self._offset(index)
+                # Con el lock de la ventana ningún otro escritor toca estos slots
+                _, slot_kind, slot_key, slot_expires, _, _ = _SLOT.unpack_from(self._mm, offset)
+                if slot_kind == kind and slot_key == key:
+                    target = offset
+                    break
+                if target is None and (slot_kind == 0 or slot_expires <= now):
+                    target = offset
+                elif slot_expires < victim_expires:
+                    victim, victim_expires = offset, slot_expires
+            if target is None:
+                target = victim
+                SHARED_CACHE_EVICTIONS.inc()
+            self._write(target, kind, key, value, expires_at)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, window, self._offset(start))
+        return True
+
+    def _write(self, offset: int, kind: int, key: bytes, value: bytes, expires_at: float) -> None:
+        mm = self._mm
+        seq = _SEQ.unpack_from(mm, offset)[0]
+        _SEQ.pack_into(mm, offset, seq + 1)
+        _SLOT.pack_into(mm, offset, seq + 1, kind, key, expires_at, len(value), _checksum(value))
+        start = offset + _SLOT.size
+        mm[start:start + len(value)] = value
+        _SEQ.pack_into(mm, offset, seq + 2)
+
+    def close(self) -> None:
+        self._mm.close()
+        self._file.close()
@@ -0,0 +1,237 @@
+# adfree_proxy/spool.py
+
+"""
+Spool en disco para reportes que no se pudieron entregar.
+
+Los lotes fallidos se añaden como líneas JSON ({"endpoint", "reports"}) al
+final del segmento activo; al superar segment_size, o segment_age segundos
+después de abrirlo, el segmento se sella y se abre otro. Un drainer en
+segundo plano reenvía los segmentos sellados, con backoff por endpoint;
+cada segmento se borra cuando ya no queda nada pendiente en él o se
+reescribe con solo lo pendiente (no se crean segmentos nuevos mientras un
+endpoint sigue caído). Los segmentos sobreviven a reinicios del proxy.
+
+Toda la E/S de ficheros (y el estado que la acompaña) pasa por un único
+hilo del spool: el event loop nunca escribe en disco y las escrituras
+quedan en orden.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from .metrics import ENDPOINT_LABELS, REPORT_SPOOLED, REPORT_SPOOL_BYTES, REPORT_SPOOL_DROPPED
+
+logger = logging.getLogger(__name__)
+
+_SEGMENT_RE = re.compile(r'^segment-(\d{12})\.ndjson$')
+
+# Firma del envío: (endpoint, reportes) -> True si se entregó
+Sender = Callable[[str, List[Dict[str, Any]]], Awaitable[bool]]
+
+
+class ReportSpool:
+    def __init__(self, directory: str,
+                 segment_size: int = 4 * 1024 * 1024,
+                 segment_age: float = 30.0,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 drain_interval: float = 5.0,
+                 min_backoff: float = 5.0,
+                 max_backoff: float = 300.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.max_bytes = max_bytes
+        self.drain_interval = drain_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        os.makedirs(directory, exist_ok=True)
+
+        self._sealed: List[Tuple[int, str]] = sorted(self._existing_segments())
+        self._seq = self._sealed[-1][0] + 1 if self._sealed else 0
+        self._active = None
+        self._active_path: Optional[str] = None
+        self._active_size = 0
+        self._active_opened = 0.0
+        self._bytes = sum(os.path.getsize(path) for _, path in self._sealed)
+        # endpoint -> (fallos consecutivos, no reintentar antes de)
+        self._backoff: Dict[str, Tuple[int, float]] = {}
+        self._drainer: Optional[asyncio.Task] = None
+        self._io: Optional[ThreadPoolExecutor] = None
+        REPORT_SPOOL_BYTES.set(self._bytes)
+
+    def _existing_segments(self):
+        for name in os.listdir(self.directory):
+            m = _SEGMENT_RE.match(name)
+            if m:
+                yield int(m.group(1)), os.path.join(self.directory, name)
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f'segment-{seq:012d}.ndjson')
+
+    @property
+    def size(self) -> int:
+        return self._bytes + self._active_size
+
+    def _run(self, fn, *args) -> Awaitable:
+        """Ejecuta fn en el hilo de E/S del spool (uno solo: las operaciones van en orden)."""
+        if self._io is None:
+            self._io = ThreadPoolExecutor(max_workers=1, thread_name_prefix='adfree-spool')
+        return asyncio.get_running_loop().run_in_executor(self._io, fn, *args)
+
+    async def append(self, endpoint: str, reports: List[Dict[str, Any]]) -> None:
+        """Añade un lote al segmento activo (escritura con buffer, sin fsync)."""
+        await self._run(self._append, endpoint, reports)
+
+    def _append(self, endpoint: str, reports: List[Dict[str, Any]]) -> None:
+        self._write({'endpoint': endpoint, 'reports': reports})
+        REPORT_SPOOLED.labels(endpoint=ENDPOINT_LABELS.limit(endpoint)).inc(len(reports))
+        self._enforce_limit()
+        REPORT_SPOOL_BYTES.set(self.size)
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry, separators=(',', ':')).encode('utf-8') + b'\n'
+        if self._active is None:
+            self._active_path = self._segment_path(self._seq)
+            self._seq += 1
+            self._active = open(self._active_path, 'ab')
+            self._active_opened = time.monotonic()
+        self._active.write(line)
+        self._active.flush()
+        self._active_size += len(line)
+        if self._active_size >= self.segment_size:
+            self._seal()
+
+    def _seal(self) -> None:
+        if self._active is None:
+            return
+        self._active.close()
+        self._sealed.append((self._seq - 1, self._active_path))
+        self._bytes += self._active_size
+        self._active = None
+        self._active_path = None
+        self._active_size = 0
+
+    def _enforce_limit(self) -> None:
+        # Sin espacio: se pierden los segmentos más antiguos
+        while self._sealed and self.size > self.max_bytes:
+            _, path = self._sealed.pop(0)
+            self._bytes -= self._remove(path)
+            REPORT_SPOOL_DROPPED.inc()
+            logger.warning(f"Report spool over {self.max_bytes} bytes, dropped {path}")
+
+    def _remove(self, path: str) -> int:
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except OSError:
+            return 0
+
+    def start(self, sender: Sender) -> None:
+        """Arranca el drainer en el loop actual."""
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.get_running_loop().create_task(self._drain_forever(sender))
+
+    async def close(self) -> None:
+        if self._drainer is not None:
+            self._drainer.cancel()
+            await asyncio.gather(self._drainer, return_exceptions=True)
+            self._drainer = None
+        await self._run(self._seal)
+        self._io.shutdown(wait=False)
+        self._io = None
+
+    async def _drain_forever(self, sender: Sender) -> None:
+        while True:
+            try:
+                await self.drain_once(sender)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Report spool drain failed: {e}")
+            await asyncio.sleep(self.drain_interval)
+
+    def _available(self, endpoint: str, now: float) -> bool:
+        state = self._backoff.get(endpoint)
+        return state is None or state[1] <= now
+
+    def _failed(self, endpoint: str, now: float) -> None:
+        failures = self._backoff.get(endpoint, (0, 0.0))[0] + 1
+        delay = min(self.min_backoff * 2 ** (failures - 1), self.max_backoff)
+        self._backoff[endpoint] = (failures, now + delay)
+
+    async def drain_once(self, sender: Sender) -> int:
+        """Una pasada por los segmentos sellados; devuelve los reportes entregados."""
+        if self._active_size and time.monotonic() - self._active_opened >= self.segment_age:
+            await self._run(self._seal)
+        delivered = 0
+
+        for seq, path in list(self._sealed):
+            try:
+                lines = await self._run(_read_lines, path)
+            except OSError as e:
+                logger.error(f"Cannot read spool segment {path}: {e}")
+                continue
+
+            now = time.monotonic()
+            entries = _parse_entries(lines, path)
+            if entries and not any(self._available(e['endpoint'], now) for e in entries):
+                continue  # todo en backoff: no reescribir el segmento
+
+            pending = []
+            for entry in entries:
+                endpoint = entry['endpoint']
+                if not self._available(endpoint, time.monotonic()):
+                    pending.append(entry)
+                    continue
+                if await sender(endpoint, entry['reports']):
+                    self._backoff.pop(endpoint, None)
+                    delivered += len(entry['reports'])
+                else:
+                    self._failed(endpoint, time.monotonic())
+                    pending.append(entry)
+
+            await self._run(self._settle, seq, path, pending)
+
+        REPORT_SPOOL_BYTES.set(self.size)
+        return delivered
+
+    def _settle(self, seq: int, path: str, pending: List[Dict[str, Any]]) -> None:
+        """Borra un segmento ya reenviado o lo reescribe con lo que sigue pendiente."""
+        if (seq, path) not in self._sealed:
+            return  # descartado por tamaño mientras se enviaba
+        if not pending:
+            self._sealed.remove((seq, path))
+            self._bytes -= self._remove(path)
+            return
+        data = b''.join(json.dumps(entry, separators=(',', ':')).encode('utf-8') + b'\n' for entry in pending)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        old = os.path.getsize(path)
+        os.replace(tmp, path)  # Atómico: nunca queda un segmento a medias
+        self._bytes += len(data) - old
+
+
+def _read_lines(path: str) -> List[bytes]:
+    with open(path, 'rb') as f:
+        return f.read().splitlines()
+
+
+def _parse_entries(lines: List[bytes], path: str) -> List[Dict[str, Any]]:
+    entries = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            # Línea truncada por una parada brusca
+            logger.warning(f"Skipping corrupt line in spool segment {path}")
+    return entries
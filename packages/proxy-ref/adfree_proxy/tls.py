@@ -0,0 +1,233 @@
+# adfree_proxy/tls.py
+
+"""
+Terminación TLS (--mode tls-terminator) y contextos TLS hacia los upstreams.
+
+CertificateStore precarga los certificados al arrancar: cada uno tiene su
+SSLContext construido una vez e indexado por sus nombres DNS (SAN, o CN si
+no tiene SAN). El callback SNI solo hace una búsqueda en un dict y cambia el
+contexto de la conexión; no se lee ni se parsea nada durante el handshake.
+
+La reanudación de sesión (tickets de TLS 1.3 y caché de sesiones de TLS 1.2)
+evita el handshake completo, que es el mayor coste de CPU al terminar TLS.
+OpenSSL cifra los tickets con las claves del contexto del listener, así que
+un ticket vale para cualquier certificado del almacén. Las claves de ticket
+son de cada proceso: con --workers, un cliente solo reanuda si vuelve al
+mismo worker.
+
+UpstreamTLS reutiliza un SSLContext por origen hacia los upstreams en lugar
+de construirlo en cada conexión; además aiohttp agrupa el pool keep-alive por
+contexto, de modo que un contexto estable conserva las conexiones abiertas.
+"""
+
+import asyncio
+import logging
+import os
+import ssl
+import time
+import weakref
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from .metrics import TLS_HANDSHAKE, TLS_HANDSHAKE_LATENCY, TLS_SNI, TLS_UPSTREAM_CONTEXTS
+
+logger = logging.getLogger(__name__)
+
+
+def certificate_names(cert_file: str) -> List[str]:
+    """Nombres DNS del primer certificado de un PEM (SAN; CN si no hay SAN)."""
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+
+    with open(cert_file, 'rb') as f:
+        cert = x509.load_pem_x509_certificate(f.read())
+    try:
+        san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+        names = san.value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        names = []
+    if not names:
+        names = [attr.value for attr in cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)]
+    return [name.lower().rstrip('.') for name in names]
+
+
+class CertificateStore:
+    def __init__(self, session_tickets: int = 2):
+        self.session_tickets = session_tickets
+        self.default: Optional[ssl.SSLContext] = None
+        self._exact: Dict[str, ssl.SSLContext] = {}
+        self._wildcards: Dict[str, ssl.SSLContext] = {}  # "*.example.com" -> clave "example.com"
+        self._handshakes: 'weakref.WeakKeyDictionary' = weakref.WeakKeyDictionary()
+
+    def __len__(self) -> int:
+        return len(self._exact) + len(self._wildcards)
+
+    def _context(self, cert_file: str, key_file: Optional[str]) -> ssl.SSLContext:
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+        ctx.load_cert_chain(cert_file, key_file)
+        ctx.set_alpn_protocols(['http/1.1'])
+        if self.session_tickets > 0:
+            ctx.num_tickets = self.session_tickets
+        else:
+            ctx.options |= ssl.OP_NO_TICKET
+        return ctx
+
+    def add(self, cert_file: str, key_file: Optional[str] = None, default: bool = False) -> List[str]:
+        """Carga un certificado (y su clave, si no va en el mismo PEM); devuelve sus nombres."""
+        ctx = self._context(cert_file, key_file)
+        names = certificate_names(cert_file)
+        for name in names:
+            if name.startswith('*.'):
+                self._wildcards.setdefault(name[2:], ctx)
+            else:
+                self._exact.setdefault(name, ctx)
+        if default or self.default is None:
+            self.default = ctx
+        return names
+
+    def load_directory(self, path: str) -> int:
+        """
+        Carga todos los certificados de un directorio: name.pem con
+        certificado y clave, o name.crt + name.key.
+        """
+        loaded = 0
+        for entry in sorted(os.listdir(path)):
+            base, ext = os.path.splitext(entry)
+            if ext not in ('.pem', '.crt'):
+                continue
+            cert_file = os.path.join(path, entry)
+            key_file = os.path.join(path, base + '.key')
+            try:
+                names = self.add(cert_file, key_file if os.path.exists(key_file) else None)
+            except (OSError, ssl.SSLError, ValueError) as e:
+                logger.error(f"Skipping certificate {cert_file}: {e}")
+                continue
+            logger.info(f"Loaded certificate {entry} for {', '.join(names)}")
+            loaded += 1
+        return loaded
+
+    def context_for(self, server_name: Optional[str]) -> Optional[ssl.SSLContext]:
+        if not server_name:
+            return None
+        name = server_name.lower().rstrip('.')
+        ctx = self._exact.get(name)
+        if ctx is None:
+            # El comodín cubre exactamente una etiqueta
+            dot = name.find('.')
+            if dot != -1:
+                ctx = self._wildcards.get(name[dot + 1:])
+        return ctx
+
+    def _sni_callback(self, ssl_object, server_name, listener_ctx):
+        self._handshakes[ssl_object] = time.perf_counter()
+        ctx = self.context_for(server_name)
+        if ctx is not None:
+            TLS_SNI['matched'].inc()
+            if ctx is not listener_ctx:
+                ssl_object.context = ctx
+        elif server_name:
+            TLS_SNI['unknown'].inc()  # Se sirve el certificado por defecto
+        else:
+            TLS_SNI['none'].inc()
+        return None
+
+    def server_context(self) -> ssl.SSLContext:
+        """Contexto del listener: el certificado por defecto con el callback SNI."""
+        if self.default is None:
+            raise ValueError('No TLS certificates loaded')
+        self.default.sni_callback = self._sni_callback
+        return self.default
+
+    def handshake_done(self, ssl_object) -> None:
+        if ssl_object is None:
+            return
+        result = 'resumed' if ssl_object.session_reused else 'full'
+        TLS_HANDSHAKE[result].inc()
+        started = self._handshakes.pop(ssl_object, None)
+        if started is not None:
+            TLS_HANDSHAKE_LATENCY[result].observe(time.perf_counter() - started)
+
+
+class _ObservedProtocol(asyncio.Protocol):
+    """Protocolo de aiohttp precedido de la medición del handshake ya terminado."""
+
+    __slots__ = ('_protocol', '_store')
+
+    def __init__(self, protocol: asyncio.Protocol, store: CertificateStore):
+        self._protocol = protocol
+        self._store = store
+
+    def connection_made(self, transport):
+        self._store.handshake_done(transport.get_extra_info('ssl_object'))
+        self._protocol.connection_made(transport)
+
+    def connection_lost(self, exc):
+        self._protocol.connection_lost(exc)
+
+    def data_received(self, data):
+        self._protocol.data_received(data)
+
+    def eof_received(self):
+        return self._protocol.eof_received()
+
+    def pause_writing(self):
+        self._protocol.pause_writing()
+
+    def resume_writing(self):
+        self._protocol.resume_writing()
+
+
+class TLSSite(web.SockSite):
+    """SockSite con TLS que registra cada handshake (completo o reanudado)."""
+
+    def __init__(self, runner: web.BaseRunner, sock, store: CertificateStore, **kwargs):
+        super().__init__(runner, sock, ssl_context=store.server_context(), **kwargs)
+        self._store = store
+
+    async def start(self) -> None:
+        self._runner._reg_site(self)
+        server = self._runner.server
+        store = self._store
+        self._server = await asyncio.get_running_loop().create_server(
+            lambda: _ObservedProtocol(server(), store),
+            sock=self._sock, ssl=self._ssl_context, backlog=self._backlog)
+
+
+class UpstreamTLS:
+    """
+    SSLContext cliente hacia los upstreams: uno por defecto (con ca_file si se
+    indica) y uno por origen que tenga su propia CA en ca_dir (host.pem).
+    Cada contexto se construye una vez.
+    """
+
+    def __init__(self, ca_file: Optional[str] = None, ca_dir: Optional[str] = None,
+                 max_contexts: int = 1024):
+        self.ca_file = ca_file
+        self.ca_dir = ca_dir
+        self.max_contexts = max_contexts
+        self.default = self._build(ca_file)
+        self._contexts: 'OrderedDict[str, ssl.SSLContext]' = OrderedDict()
+
+    @staticmethod
+    def _build(cafile: Optional[str]) -> ssl.SSLContext:
+        TLS_UPSTREAM_CONTEXTS['built'].inc()
+        return ssl.create_default_context(cafile=cafile)
+
+    def context_for(self, host: Optional[str]) -> ssl.SSLContext:
+        if not self.ca_dir or not host:
+            return self.default
+        ctx = self._contexts.get(host)
+        if ctx is not None:
+            self._contexts.move_to_end(host)
+            TLS_UPSTREAM_CONTEXTS['reused'].inc()
+            return ctx
+        ca_file = os.path.join(self.ca_dir, f'{host}.pem')
+        # Los orígenes sin CA propia también se recuerdan: no se mira el disco otra vez
+        ctx = self._build(ca_file) if os.path.isfile(ca_file) else self.default
+        self._contexts[host] = ctx
+        if len(self._contexts) > self.max_contexts:
+            self._contexts.popitem(last=False)
+        return ctx
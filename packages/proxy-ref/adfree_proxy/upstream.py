@@ -0,0 +1,205 @@
+# adfree_proxy/upstream.py
+
+"""
+Reenvío de peticiones al upstream real.
+
+Contiene la creación de la ClientSession compartida (pool de conexiones
+keep-alive por upstream, caché DNS y timeouts de conexión/lectura) y los
+helpers para reenviar una petición y devolver la respuesta en streaming.
+"""
+
+import ipaddress
+import logging
+import ssl
+from typing import Callable, Optional
+from urllib.parse import urlsplit
+
+from aiohttp import web, ClientSession, ClientResponse, ClientTimeout, TCPConnector
+from multidict import CIMultiDict
+
+logger = logging.getLogger(__name__)
+
+# Cabeceras hop-by-hop (RFC 7230 §6.1): nunca se reenvían entre saltos.
+HOP_BY_HOP_HEADERS = frozenset({
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'proxy-connection',
+    'te',
+    'trailer',
+    'transfer-encoding',
+    'upgrade',
+})
+
+VIA_TOKEN = '1.1 adfree-proxy'
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class UpstreamConfig:
+    """Parámetros del pool de conexiones hacia los upstreams."""
+
+    def __init__(self,
+                 limit: int = 256,
+                 limit_per_host: int = 32,
+                 keepalive_timeout: float = 30.0,
+                 ttl_dns_cache: int = 300,
+                 connect_timeout: float = 5.0,
+                 read_timeout: float = 30.0,
+                 ssl_context: Optional[ssl.SSLContext] = None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Contexto TLS por defecto hacia los upstreams (None: el de aiohttp)
+        self.ssl_context = ssl_context
+
+
+def create_upstream_session(config: Optional[UpstreamConfig] = None) -> ClientSession:
+    """
+    Crea la ClientSession compartida por el proxy.
+
+    La descompresión automática se desactiva para poder reenviar los cuerpos
+    comprimidos tal cual cuando no hay que reescribirlos.
+    """
+    config = config or UpstreamConfig()
+    connector = TCPConnector(
+        limit=config.limit,
+        limit_per_host=config.limit_per_host,
+        keepalive_timeout=config.keepalive_timeout,
+        use_dns_cache=True,
+        ttl_dns_cache=config.ttl_dns_cache,
+        ssl=config.ssl_context if config.ssl_context is not None else True,
+    )
+    timeout = ClientTimeout(
+        total=None,
+        sock_connect=config.connect_timeout,
+        sock_read=config.read_timeout,
+    )
+    return ClientSession(connector=connector, timeout=timeout, auto_decompress=False)
+
+
+def _connection_tokens(headers) -> set:
+    tokens = set()
+    for value in headers.getall('Connection', []):
+        tokens.update(t.strip().lower() for t in value.split(',') if t.strip())
+    return tokens
+
+
+def filter_headers(headers) -> CIMultiDict:
+    """Copia las cabeceras quitando las hop-by-hop y las listadas en Connection."""
+    drop = HOP_BY_HOP_HEADERS | _connection_tokens(headers)
+    return CIMultiDict((k, v) for k, v in headers.items() if k.lower() not in drop)
+
+
+def _split_target(request: web.Request):
+    """
+    (origen, path con query) de la petición: los de la request line si viene
+    en absolute-form ("GET http://example.com/foo HTTP/1.1", como hacen los
+    clientes con proxy), si no el Host de la petición.
+    """
+    path = request.raw_path
+    origin = f"{request.scheme}://{request.host}"
+    scheme, sep, rest = path.partition('://')
+    if sep and not path.startswith('/'):
+        # Path y query se copian tal cual, sin renormalizar el escapado
+        end = min((i for i in (rest.find('/'), rest.find('?')) if i >= 0), default=len(rest))
+        origin = f"{scheme.lower()}://{rest[:end]}"
+        path = rest[end:]
+        if not path.startswith('/'):
+            path = '/' + path
+    return origin, path
+
+
+def build_upstream_url(request: web.Request, base_url: Optional[str] = None) -> str:
+    """
+    URL a la que se reenvía la petición.
+
+    Con base_url (modo reverse proxy) se conserva path y query de la petición;
+    sin ella se usa el Host de la propia petición (modo forward/transparente),
+    o la URL entera si el cliente la manda en la request line (absolute-form).
+    """
+    origin, path = _split_target(request)
+    if base_url:
+        return base_url.rstrip('/') + path
+    return origin + path
+
+
+def targets_proxy(request: web.Request) -> bool:
+    """
+    True si la petición va dirigida al propio proxy: su destino (authority
+    de la absolute-form, o Host) es la dirección y puerto en que se recibió
+    la conexión. Una petición a cualquier otro host se reenvía aunque su
+    path coincida con una ruta local (/metrics, ...).
+    """
+    sockname = request.transport.get_extra_info('sockname') if request.transport is not None else None
+    if not sockname or len(sockname) < 2:
+        return False
+    origin, _ = _split_target(request)
+    target = urlsplit(origin)
+    try:
+        port = target.port
+    except ValueError:
+        return False
+    if port is None:
+        port = 443 if target.scheme == 'https' else 80
+    if port != sockname[1] or not target.hostname:
+        return False
+    local_ip = sockname[0]
+    if target.hostname == 'localhost':
+        try:
+            return ipaddress.ip_address(local_ip).is_loopback
+        except ValueError:
+            return False
+    return target.hostname == local_ip.lower()
+
+
+def forward_request_headers(request: web.Request) -> CIMultiDict:
+    headers = filter_headers(request.headers)
+    # aiohttp calcula Host a partir de la URL de destino
+    headers.popall('Host', None)
+    headers.add('Via', VIA_TOKEN)
+    return headers
+
+
+def is_forwarding_loop(request: web.Request) -> bool:
+    """True si la petición ya pasó por este proxy (cabecera Via propia)."""
+    return any(VIA_TOKEN in v for v in request.headers.getall('Via', []))
+
+
+async def open_upstream(session: ClientSession, request: web.Request, url: str,
+                        headers: CIMultiDict, ssl_context: Optional[ssl.SSLContext] = None) -> ClientResponse:
+    """
+    Envía la petición al upstream; el cuerpo del cliente se reenvía en streaming.
+    ssl_context sustituye al contexto TLS del conector para este origen.
+    """
+    data = request.content.iter_chunked(STREAM_CHUNK_SIZE) if request.body_exists else None
+    return await session.request(
+        request.method,
+        url,
+        headers=headers,
+        data=data,
+        allow_redirects=False,
+        ssl=ssl_context if ssl_context is not None else True,
+    )
+
+
+async def stream_upstream_response(request: web.Request, upstream: ClientResponse,
+                                   chunk_size: int = STREAM_CHUNK_SIZE,
+                                   tap: Optional[Callable[[bytes], None]] = None) -> web.StreamResponse:
+    """
+    Devuelve la respuesta del upstream al cliente sin bufferizar el cuerpo.
+    tap recibe cada trozo tal como se envía (p. ej. para escanearlo después).
+    """
+    response = web.StreamResponse(status=upstream.status, reason=upstream.reason,
+                                  headers=filter_headers(upstream.headers))
+    await response.prepare(request)
+    async for chunk in upstream.content.iter_chunked(chunk_size):
+        await response.write(chunk)
+        if tap is not None:
+            tap(chunk)
+    await response.write_eof()
+    return response
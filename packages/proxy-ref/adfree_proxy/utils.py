@@ -9,4 +9,10 @@ def normalize_header_name(name: str) -> str:
 def safe_b64decode(b64_str: str) -> bytes:
     """Decodifica base64url con padding seguro."""
     padding = '=' * (4 - len(b64_str) % 4)
-    return base64.urlsafe_b64decode(b64_str + padding)
\ No newline at end of file
+    return base64.urlsafe_b64decode(b64_str + padding)
+
+def strip_port(host: str) -> str:
+    """Host sin puerto ('example.com:8080' -> 'example.com', '[::1]:80' -> '::1')."""
+    if host.startswith('['):
+        return host[1:host.find(']')] if ']' in host else host
+    return host.rsplit(':', 1)[0] if host.count(':') == 1 else host
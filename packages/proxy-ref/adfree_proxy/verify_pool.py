@@ -0,0 +1,106 @@
+# adfree_proxy/verify_pool.py
+
+"""
+Verificación de firmas fuera del event loop.
+
+SignatureVerifier ejecuta canonicalización + verificación ECDSA en línea
+(comportamiento clásico), en un pool de hilos o en un pool de procesos. Las
+verificaciones pendientes están acotadas (los solicitantes esperan cuando la
+cola está llena) y las que comparten clave pública se agrupan en un único
+trabajo para cargar la clave una sola vez.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from .metrics import VERIFY_PENDING, VERIFY_BATCH_SIZE
+from .policy import verify_policy_signature
+
+logger = logging.getLogger(__name__)
+
+VERIFY_MODES = ('inline', 'thread', 'process')
+
+
+def _verify_batch(public_key_pem: bytes, items: List[Tuple[Dict[str, Any], str]]) -> List[bool]:
+    """Trabajo del pool: verifica varias políticas con la misma clave."""
+    return [verify_policy_signature(policy_json, signature_b64, public_key_pem)
+            for policy_json, signature_b64 in items]
+
+
+class SignatureVerifier:
+    """
+    Verificador de firmas con modo configurable.
+
+    batch_window es el tiempo (s) que se esperan más firmas de la misma clave
+    antes de enviar el lote; 0 agrupa solo las que llegan en la misma vuelta
+    del loop.
+    """
+
+    def __init__(self, mode: str = 'inline', max_workers: Optional[int] = None,
+                 max_pending: int = 1024, max_batch: int = 64, batch_window: float = 0.0):
+        if mode not in VERIFY_MODES:
+            raise ValueError(f'mode must be one of {VERIFY_MODES}')
+        self.mode = mode
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._executor: Optional[Executor] = None
+        if mode == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='adfree-verify')
+        elif mode == 'process':
+            # Carga multiprocessing solo si se usa
+            from concurrent.futures import ProcessPoolExecutor
+            self._executor = ProcessPoolExecutor(max_workers=max_workers)
+        self._slots = asyncio.Semaphore(max_pending)
+        self._batches: Dict[bytes, List[Tuple[Dict[str, Any], str, asyncio.Future]]] = {}
+
+    async def verify(self, policy_json: Dict[str, Any], signature_b64: str, public_key_pem: bytes) -> bool:
+        if self._executor is None:
+            return verify_policy_signature(policy_json, signature_b64, public_key_pem)
+
+        # Backpressure: no más de max_pending verificaciones en vuelo
+        async with self._slots:
+            VERIFY_PENDING.inc()
+            try:
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                batch = self._batches.get(public_key_pem)
+                if batch is None:
+                    batch = self._batches[public_key_pem] = []
+                    if self.batch_window > 0:
+                        loop.call_later(self.batch_window, self._flush, public_key_pem)
+                    else:
+                        loop.call_soon(self._flush, public_key_pem)
+                batch.append((policy_json, signature_b64, future))
+                if len(batch) >= self.max_batch:
+                    self._flush(public_key_pem)
+                return await future
+            finally:
+                VERIFY_PENDING.dec()
+
+    def _flush(self, public_key_pem: bytes) -> None:
+        batch = self._batches.pop(public_key_pem, None)
+        if not batch:
+            return
+        VERIFY_BATCH_SIZE.observe(len(batch))
+        items = [(policy_json, signature_b64) for policy_json, signature_b64, _ in batch]
+        futures = [future for _, _, future in batch]
+        job = asyncio.get_running_loop().run_in_executor(self._executor, _verify_batch, public_key_pem, items)
+        job.add_done_callback(lambda done: self._resolve(done, futures))
+
+    @staticmethod
+    def _resolve(job: asyncio.Future, futures: List[asyncio.Future]) -> None:
+        if job.cancelled() or job.exception() is not None:
+            if not job.cancelled():
+                logger.error(f"Signature verification job failed: {job.exception()}")
+            results = [False] * len(futures)
+        else:
+            results = job.result()
+        for future, ok in zip(futures, results):
+            if not future.done():
+                future.set_result(ok)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
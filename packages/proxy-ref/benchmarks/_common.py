@@ -0,0 +1,49 @@
+# benchmarks/_common.py
+
+"""Utilidades compartidas por los benchmarks (percentiles, RSS, salida JSON)."""
+
+import json
+import os
+import platform
+import sys
+import time
+from typing import Dict, List, Optional
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Percentil q (0-100) por rango más cercano sobre una lista ya ordenada."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def rss_bytes(pid: Optional[int] = None) -> Optional[int]:
+    """RSS actual de un proceso (Linux, /proc); None si no está disponible."""
+    try:
+        with open(f"/proc/{pid or os.getpid()}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def environment() -> Dict[str, str]:
+    return {
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def emit(result: Dict, output: Optional[str] = None) -> None:
+    """Imprime el resultado como JSON y, si se pide, lo guarda en output."""
+    result = {'environment': environment(), **result}
+    text = json.dumps(result, indent=2, sort_keys=True)
+    print(text)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
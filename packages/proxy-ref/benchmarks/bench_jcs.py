@@ -0,0 +1,64 @@
+# benchmarks/bench_jcs.py
+
+"""
+Microbenchmark: canonicalización JCS (jcs.py) frente al canonicalize_json
+anterior, que reconstruía cada dict con sorted() y después llamaba a
+json.dumps(sort_keys=True).
+
+Se mide el camino de la cabecera cruda (texto -> bytes canónicos) y la
+canonicalización de un dict ya parseado.
+
+    python -m benchmarks.bench_jcs --blocked-domains 200 --number 2000
+"""
+
+import argparse
+import json
+
+from adfree_proxy import jcs
+
+from ._common import emit
+from .bench_micro import _policy_dict, _time_per_call
+
+
+def legacy_canonicalize(data):
+    def _sorted_dict(d):
+        if isinstance(d, dict):
+            return {k: _sorted_dict(v) for k, v in sorted(d.items())}
+        elif isinstance(d, list):
+            return [_sorted_dict(i) for i in d]
+        else:
+            return d
+    return json.dumps(_sorted_dict(data), separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--blocked-domains', type=int, default=50, help='Rules in the benchmark policy')
+    parser.add_argument('--number', type=int, default=2000, help='Calls per sample')
+    parser.add_argument('--repeat', type=int, default=5, help='Samples per case')
+    parser.add_argument('--output', default=None, help='Write the JSON result to this file')
+    args = parser.parse_args()
+
+    policy = _policy_dict(args.blocked_domains)
+    raw = json.dumps(policy)
+    parsed = jcs.loads(raw)
+    # Las políticas ASCII con enteros tienen la misma forma en ambos esquemas
+    assert jcs.canonicalize(parsed) == legacy_canonicalize(policy)
+
+    cases = {
+        'legacy_from_header': _time_per_call(lambda: legacy_canonicalize(json.loads(raw)), args.number, args.repeat),
+        'jcs_from_header': _time_per_call(lambda: jcs.canonicalize_raw(raw), args.number, args.repeat),
+        'legacy_from_dict': _time_per_call(lambda: legacy_canonicalize(policy), args.number, args.repeat),
+        'jcs_from_dict': _time_per_call(lambda: jcs.canonicalize(policy), args.number, args.repeat),
+        'jcs_from_loaded': _time_per_call(lambda: jcs.canonicalize(parsed), args.number, args.repeat),
+    }
+    emit({
+        'benchmark': 'jcs',
+        'config': {'blocked_domains': len(policy['blocked_domains']), 'header_bytes': len(raw)},
+        'cases': cases,
+        'speedup_from_header': cases['legacy_from_header']['median_us'] / cases['jcs_from_header']['median_us'],
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
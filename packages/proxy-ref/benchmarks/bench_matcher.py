@@ -0,0 +1,84 @@
+# benchmarks/bench_matcher.py
+
+"""
+Microbenchmark: DomainMatcher frente al bucle lineal sobre blocked_domains
+que usaba _remove_blocked_iframes.
+
+    python -m benchmarks.bench_matcher --domains 5000 --lookups 20000
+"""
+
+import argparse
+import random
+import time
+
+from adfree_proxy.matcher import DomainMatcher
+
+from ._common import emit
+
+
+def legacy_match(domain, blocked_domains):
+    for blocked in blocked_domains:
+        if blocked.startswith('*.'):
+            if domain.endswith(blocked[2:]):
+                return blocked
+        elif domain == blocked:
+            return blocked
+    return None
+
+
+def make_rules(n, rng):
+    rules = []
+    for i in range(n):
+        name = f"ads{i}-{rng.randrange(10**6)}.example{i % 97}.com"
+        rules.append(f"*.{name}" if i % 2 else name)
+    return rules
+
+
+def make_lookups(rules, n, rng):
+    lookups = []
+    for _ in range(n):
+        if rng.random() < 0.2:
+            rule = rng.choice(rules)
+            lookups.append('cdn.' + rule[2:] if rule.startswith('*.') else rule)
+        else:
+            lookups.append(f"www.site{rng.randrange(10**6)}.org")
+    return lookups
+
+
+def bench(fn, lookups):
+    start = time.perf_counter()
+    for domain in lookups:
+        fn(domain)
+    return (time.perf_counter() - start) / len(lookups)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--domains', type=int, default=5000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='Write the JSON result to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rules = make_rules(args.domains, rng)
+    lookups = make_lookups(rules, args.lookups, rng)
+
+    start = time.perf_counter()
+    matcher = DomainMatcher(rules)
+    compile_s = time.perf_counter() - start
+
+    legacy_lookups = lookups[:max(1, args.lookups // 20)]
+    result = {
+        'benchmark': 'domain_matcher',
+        'domains': args.domains,
+        'compile_ms': compile_s * 1000,
+        'matcher_ns_per_lookup': bench(matcher.match, lookups) * 1e9,
+        'legacy_ns_per_lookup': bench(lambda d: legacy_match(d, rules), legacy_lookups) * 1e9,
+    }
+    result['speedup'] = result['legacy_ns_per_lookup'] / result['matcher_ns_per_lookup']
+    emit(result, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# benchmarks/bench_micro.py
+
+"""
+Microbenchmarks de las piezas del camino caliente: canonicalize_json,
+verify_policy_signature, _remove_blocked_iframes, _inject_redirect_blocker y
+la pasada completa de HtmlRewriter con toda la política (dominios,
+allow_iframes, límite de anuncios e inyección).
+
+Cada caso se repite --repeat veces y se informa la mediana y el mínimo por
+llamada, en JSON.
+
+    python -m benchmarks.bench_micro --page-kb 256 --iframes 50 --output micro.json
+"""
+
+import argparse
+import asyncio
+import base64
+import statistics
+import time
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from adfree_proxy.interceptor import AdfreeInterceptor
+from adfree_proxy.policy import AdfreePolicy, canonicalize_json, verify_policy_signature
+from adfree_proxy.rewriter import HtmlRewriter, REDIRECT_BLOCKER_SCRIPT
+
+from ._common import emit
+from .upstream import make_page
+
+
+def _time_per_call(fn, number: int, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return {
+        'calls': number * repeat,
+        'median_us': statistics.median(samples) * 1e6,
+        'min_us': min(samples) * 1e6,
+    }
+
+
+def _policy_dict(blocked: int):
+    return {
+        'version': '1',
+        'mode': 'strict',
+        'max_ads_per_page': 3,
+        'allow_redirects': False,
+        'allow_iframes': ['self', 'https://cdn.example.org'],
+        'blocked_domains': ['ads.example.com'] + [f'*.tracker{i}.net' for i in range(blocked)],
+        'report_to': 'https://example.com/adfree',
+        'bot_policy': {'payment_url': 'https://example.com/pay', 'rate_limit': {'requests': 100, 'window': 3600}},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page-kb', type=int, default=64)
+    parser.add_argument('--iframes', type=int, default=10)
+    parser.add_argument('--blocked-domains', type=int, default=50, help='Rules in the benchmark policy')
+    parser.add_argument('--number', type=int, default=200, help='Calls per sample')
+    parser.add_argument('--repeat', type=int, default=5, help='Samples per case')
+    parser.add_argument('--output', default=None, help='Write the JSON result to this file')
+    args = parser.parse_args()
+
+    policy_json = _policy_dict(args.blocked_domains)
+    policy = AdfreePolicy.model_validate(policy_json)
+
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    pem = private_key.public_key().public_bytes(serialization.Encoding.PEM,
+                                                serialization.PublicFormat.SubjectPublicKeyInfo)
+    signature = private_key.sign(canonicalize_json(policy_json), ec.ECDSA(hashes.SHA256()))
+    signature_b64 = base64.urlsafe_b64encode(signature).rstrip(b'=').decode()
+    assert verify_policy_signature(policy_json, signature_b64, pem)
+
+    page = make_page(args.page_kb, args.iframes)
+    html = page.decode()
+    interceptor = AdfreeInterceptor(None)
+    loop = asyncio.new_event_loop()
+    remove = interceptor._remove_blocked_iframes
+    # Las páginas grandes son caras: menos llamadas por muestra
+    html_number = max(1, args.number // max(1, args.page_kb // 16))
+
+    cases = {
+        'canonicalize_json': _time_per_call(lambda: canonicalize_json(policy_json), args.number, args.repeat),
+        'verify_policy_signature': _time_per_call(
+            lambda: verify_policy_signature(policy_json, signature_b64, pem), args.number, args.repeat),
+        '_remove_blocked_iframes': _time_per_call(
+            lambda: loop.run_until_complete(remove(html, policy)), html_number, args.repeat),
+        '_inject_redirect_blocker': _time_per_call(
+            lambda: interceptor._inject_redirect_blocker(html), html_number, args.repeat),
+        'rewrite_full_policy': _time_per_call(
+            lambda: HtmlRewriter(policy.blocked_matcher, REDIRECT_BLOCKER_SCRIPT, policy.iframe_allowlist,
+                                 'example.com', policy.max_ads_per_page).rewrite(page),
+            html_number, args.repeat),
+    }
+    loop.close()
+
+    for name in ('_remove_blocked_iframes', '_inject_redirect_blocker', 'rewrite_full_policy'):
+        cases[name]['mb_per_s'] = len(html) / (cases[name]['median_us'] / 1e6) / 2 ** 20
+
+    emit({
+        'benchmark': 'micro',
+        'config': {
+            'page_kb': args.page_kb,
+            'iframes': args.iframes,
+            'blocked_domains': len(policy_json['blocked_domains']),
+        },
+        'cases': cases,
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+# benchmarks/bench_proxy.py
+
+"""
+Benchmark de carga y latencia del proxy.
+
+Arranca el upstream local (benchmarks.upstream), lanza el proxy en otro
+proceso apuntando a él y lo carga con concurrencia fija durante un tiempo.
+Informa requests/s, latencias p50/p99/p999, RSS del proxy y el retardo del
+event loop del proxy, en JSON.
+
+    python -m benchmarks.bench_proxy --concurrency 64 --duration 10 --page-kb 128 --iframes 20
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+import aiohttp
+from aiohttp import web
+
+from ._common import emit, percentile, rss_bytes
+from .upstream import BenchUpstream
+
+
+def _proxy_process(upstream_url: str, key_url: str, verify_mode: str, conn) -> None:
+    asyncio.run(_proxy_main(upstream_url, key_url, verify_mode, conn))
+
+
+async def _proxy_main(upstream_url: str, key_url: str, verify_mode: str, conn) -> None:
+    from adfree_proxy.interceptor import AdfreeInterceptor
+    from adfree_proxy.keys import PublicKeyCache
+    from adfree_proxy.upstream import create_upstream_session
+    from adfree_proxy.verify_pool import SignatureVerifier
+
+    session = create_upstream_session()
+    verifier = SignatureVerifier(verify_mode)
+    interceptor = AdfreeInterceptor(session, upstream_url=upstream_url,
+                                    key_cache=PublicKeyCache(session, url_template=key_url),
+                                    verifier=verifier)
+    app = web.Application(middlewares=[interceptor.intercept_request])
+    app.router.add_get('/metrics', interceptor.metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    conn.send(site._server.sockets[0].getsockname()[1])
+
+    # Muestreo del retardo del loop: cuánto se pasa de hora un sleep corto
+    lags = []
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_reader(conn.fileno(), stop.set)
+    interval = 0.01
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - start - interval))
+    loop.remove_reader(conn.fileno())
+    conn.recv()
+
+    lags.sort()
+    conn.send({
+        'rss_bytes': rss_bytes(),
+        'loop_lag_ms': {
+            'p50': percentile(lags, 50) * 1000,
+            'p99': percentile(lags, 99) * 1000,
+            'max': lags[-1] * 1000,
+        },
+    })
+    await runner.cleanup()
+    await interceptor.reporter.close()
+    await session.close()
+    verifier.close()
+
+
+async def _load(url: str, concurrency: int, duration: float, warmup: int, accept_encoding: str):
+    latencies = []
+    errors = 0
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    # Se mide el proxy, no la descompresión en el cliente
+    async with aiohttp.ClientSession(connector=connector, auto_decompress=False) as session:
+        headers = {'Adfree-Want': '1', 'Accept-Encoding': accept_encoding}
+        for _ in range(warmup):
+            async with session.get(url, headers=headers) as resp:
+                await resp.read()
+
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    async with session.get(url, headers=headers) as resp:
+                        await resp.read()
+                        if resp.status != 200:
+                            errors += 1
+                            continue
+                except aiohttp.ClientError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return latencies, errors, elapsed
+
+
+async def run(args):
+    upstream = BenchUpstream(args.page_kb, args.iframes, mode=args.mode,
+                             policy_headers=not args.no_policy, compress=args.upstream_gzip)
+    runner = web.AppRunner(upstream.app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    upstream_port = site._server.sockets[0].getsockname()[1]
+    upstream_url = f'http://127.0.0.1:{upstream_port}'
+    upstream.policy['report_to'] = f'{upstream_url}/adfree'
+    upstream._headers = upstream._policy_headers()
+
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(
+        target=_proxy_process,
+        args=(upstream_url, f'{upstream_url}/.well-known/adfree-policy-key', args.verify_mode, child),
+    )
+    proc.start()
+    try:
+        proxy_port = await asyncio.get_running_loop().run_in_executor(None, parent.recv)
+        latencies, errors, elapsed = await _load(f'http://127.0.0.1:{proxy_port}/page',
+                                                 args.concurrency, args.duration, args.warmup,
+                                                 args.accept_encoding)
+        parent.send('stop')
+        proxy_stats = await asyncio.get_running_loop().run_in_executor(None, parent.recv)
+    finally:
+        proc.join(timeout=10)
+        if proc.is_alive():
+            proc.terminate()
+        await runner.cleanup()
+
+    latencies.sort()
+    return {
+        'benchmark': 'proxy_load',
+        'config': {
+            'concurrency': args.concurrency,
+            'duration_s': args.duration,
+            'page_kb': args.page_kb,
+            'iframes': args.iframes,
+            'mode': args.mode,
+            'policy': not args.no_policy,
+            'verify_mode': args.verify_mode,
+            'upstream_gzip': args.upstream_gzip,
+            'accept_encoding': args.accept_encoding,
+        },
+        'requests': len(latencies),
+        'errors': errors,
+        'requests_per_s': len(latencies) / elapsed,
+        'latency_ms': {
+            'p50': percentile(latencies, 50) * 1000 if latencies else None,
+            'p99': percentile(latencies, 99) * 1000 if latencies else None,
+            'p999': percentile(latencies, 99.9) * 1000 if latencies else None,
+        },
+        'proxy_rss_mb': proxy_stats['rss_bytes'] / 2 ** 20 if proxy_stats['rss_bytes'] else None,
+        'proxy_loop_lag_ms': proxy_stats['loop_lag_ms'],
+        'reports_received': upstream.reports_received,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--warmup', type=int, default=20, help='Requests before measuring')
+    parser.add_argument('--page-kb', type=int, default=64)
+    parser.add_argument('--iframes', type=int, default=10)
+    parser.add_argument('--mode', default='strict', choices=['strict', 'relaxed', 'report-only'])
+    parser.add_argument('--no-policy', action='store_true', help='Serve pages without Adfree headers')
+    parser.add_argument('--verify-mode', default='inline', choices=['inline', 'thread', 'process'])
+    parser.add_argument('--upstream-gzip', action='store_true', help='Upstream serves gzip-encoded pages')
+    parser.add_argument('--accept-encoding', default='identity', help='Accept-Encoding sent by the load clients')
+    parser.add_argument('--output', default=None, help='Write the JSON result to this file')
+    args = parser.parse_args()
+    emit(asyncio.run(run(args)), args.output)
+
+
+if __name__ == '__main__':
+    main()
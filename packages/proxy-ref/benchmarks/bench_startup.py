@@ -0,0 +1,92 @@
+# benchmarks/bench_startup.py
+
+"""
+Arranque en frío: cuánto cuesta importar el proxy en un proceso nuevo.
+
+Cada muestra es un intérprete nuevo con -X importtime. Se informa:
+
+- import_ms: import completo de --module (incluye aiohttp, asyncio, ...).
+- proxy_ms: lo que añade el proxy con asyncio y aiohttp ya cargados, que se
+  pagan en cualquier caso (el presupuesto de tests/test_startup.py).
+- process_ms: tiempo de pared del proceso menos el de un intérprete vacío.
+- packages_ms: tiempo propio por paquete de primer nivel (los más caros).
+- heavy_loaded: dependencias pesadas que el import cargó y no debería
+  (se cargan al validar o verificar la primera política).
+
+    python -m benchmarks.bench_startup --repeat 20 --output startup.json
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from ._common import emit
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PRELOADED = 'import asyncio, aiohttp, aiohttp.web'
+HEAVY_DEPENDENCIES = ('pydantic', 'cryptography', 'multiprocessing')
+
+_IMPORTTIME_RE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+
+def import_times(code: str) -> List[Tuple[str, int, int]]:
+    """(módulo, tiempo propio, acumulado) en µs de cada import que hace code."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=PACKAGE_ROOT,
+                            capture_output=True, text=True, check=True)
+    return [(m.group(4), int(m.group(1)), int(m.group(2)))
+            for m in map(_IMPORTTIME_RE.match, result.stderr.splitlines()) if m]
+
+
+def _wall(code: str) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=PACKAGE_ROOT, check=True)
+    return time.perf_counter() - started
+
+
+def _summary(samples: List[float]) -> Dict[str, float]:
+    return {'median_ms': statistics.median(samples), 'min_ms': min(samples)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='adfree_proxy.interceptor', help='Module to import')
+    parser.add_argument('--repeat', type=int, default=20, help='Fresh interpreters per measurement')
+    parser.add_argument('--top', type=int, default=10, help='Packages to list in packages_ms')
+    parser.add_argument('--output', default=None, help='Write the JSON result to this file')
+    args = parser.parse_args()
+
+    full, proxy, process, packages = [], [], [], {}
+    heavy = set()
+    for _ in range(args.repeat):
+        rows = import_times(f'import {args.module}')
+        full.append(rows[-1][2] / 1000)
+        by_package: Dict[str, float] = {}
+        for name, own, _ in rows:
+            root = name.split('.')[0]
+            by_package[root] = by_package.get(root, 0.0) + own / 1000
+            if root in HEAVY_DEPENDENCIES:
+                heavy.add(root)
+        for root, ms in by_package.items():
+            packages.setdefault(root, []).append(ms)
+        proxy.append(import_times(f'{PRELOADED}; import {args.module}')[-1][2] / 1000)
+        process.append((_wall(f'import {args.module}') - _wall('pass')) * 1000)
+
+    top = sorted(packages.items(), key=lambda item: -statistics.median(item[1]))[:args.top]
+    emit({
+        'benchmark': 'startup',
+        'config': {'module': args.module, 'repeat': args.repeat},
+        'import_ms': _summary(full),
+        'proxy_ms': _summary(proxy),
+        'process_ms': _summary(process),
+        'packages_ms': {root: statistics.median(samples) for root, samples in top},
+        'heavy_loaded': sorted(heavy),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# benchmarks/compare.py
+
+"""
+Compara dos resultados JSON de un mismo benchmark (base frente a candidato).
+
+Recorre las métricas numéricas de ambos ficheros e imprime el cambio
+relativo. Con --threshold sale con código 1 si alguna métrica de tiempo
+(…_ms, …_us, …_ns_per_lookup) empeora más de ese porcentaje.
+
+    python -m benchmarks.compare base.json new.json --threshold 10
+"""
+
+import argparse
+import json
+import sys
+from typing import Dict
+
+# Métricas donde más es mejor; el resto de las de tiempo, menos es mejor
+HIGHER_IS_BETTER = ('requests_per_s', 'mb_per_s', 'speedup')
+LOWER_IS_BETTER_SUFFIXES = ('_ms', '_us', '_ns_per_lookup')
+SKIP_KEYS = ('environment', 'config')
+
+
+def flatten(data, prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in data.items():
+        if not prefix and key in SKIP_KEYS:
+            continue
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+
+def _direction(name: str) -> int:
+    """+1 si subir es mejorar, -1 si subir es empeorar, 0 si es neutra."""
+    parts = name.split('.')
+    if any(part.endswith(HIGHER_IS_BETTER) for part in parts):
+        return 1
+    if any(part.endswith(LOWER_IS_BETTER_SUFFIXES) for part in parts):
+        return -1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='Fail if a metric regresses by more than this percentage')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = flatten(json.load(f))
+    with open(args.candidate) as f:
+        candidate = flatten(json.load(f))
+
+    regressions = []
+    width = max((len(name) for name in base), default=10)
+    for name in sorted(base.keys() & candidate.keys()):
+        old, new = base[name], candidate[name]
+        change = (new - old) / old * 100 if old else 0.0
+        direction = _direction(name)
+        marker = ''
+        if direction and args.threshold is not None and -direction * change > args.threshold:
+            marker = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<{width}}  {old:>14.3f}  {new:>14.3f}  {change:>+8.1f}%{marker}')
+
+    if regressions:
+        print(f'{len(regressions)} metric(s) regressed more than {args.threshold}%', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+# benchmarks/upstream.py
+
+"""
+Upstream local para benchmarks.
+
+Sirve páginas HTML de tamaño y densidad de iframes configurables con
+cabeceras Adfree-Policy / Adfree-Signature firmadas, la clave pública en
+/.well-known/adfree-policy-key y un sumidero de reportes en /adfree.
+
+    python -m benchmarks.upstream --port 8900 --page-kb 256 --iframes 20
+"""
+
+import argparse
+import base64
+import gzip
+import json
+
+from aiohttp import web
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from adfree_proxy.policy import canonicalize_json
+
+
+def _b64(n: int) -> str:
+    return base64.urlsafe_b64encode(n.to_bytes(32, 'big')).rstrip(b'=').decode()
+
+
+def make_page(page_kb: int, iframes: int, blocked_ratio: float = 0.5) -> bytes:
+    """Página de ~page_kb KB con iframes repartidos; blocked_ratio de ellos bloqueados."""
+    row = b'<div class="row"><p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p></div>\n'
+    rows = max(1, page_kb * 1024 // len(row))
+    blocked_every = int(1 / blocked_ratio) if blocked_ratio else 0
+    body = []
+    step = max(1, rows // max(1, iframes))
+    placed = 0
+    for i in range(rows):
+        body.append(row)
+        if iframes and i % step == 0 and placed < iframes:
+            host = 'ads.example.com' if blocked_every and placed % blocked_every == 0 else 'cdn.example.org'
+            body.append(f"<iframe src='https://{host}/slot/{placed}' width=300></iframe>\n".encode())
+            placed += 1
+    return (b'<html><head><title>bench</title></head><body>\n' + b''.join(body) + b'</body></html>')
+
+
+class BenchUpstream:
+    def __init__(self, page_kb: int = 64, iframes: int = 10, blocked_domains=None,
+                 mode: str = 'strict', report_to: str = None, policy_headers: bool = True,
+                 compress: bool = False):
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        numbers = self.private_key.public_key().public_numbers()
+        self.jwk = {'kty': 'EC', 'crv': 'P-256', 'x': _b64(numbers.x), 'y': _b64(numbers.y), 'kid': 'bench'}
+        self.page = make_page(page_kb, iframes)
+        # Con compress se sirve gzip a quien lo acepte, como haría un origen real
+        self.page_gzip = gzip.compress(self.page, 6) if compress else None
+        self.policy_headers = policy_headers
+        self.reports_received = 0
+        self.policy = {
+            'version': '1',
+            'mode': mode,
+            'max_ads_per_page': 3,
+            'allow_redirects': False,
+            'allow_iframes': ['self'],
+            'blocked_domains': blocked_domains or ['ads.example.com', '*.trackers.net'],
+            'report_to': report_to,
+        }
+        self._headers = self._policy_headers()
+
+    def _policy_headers(self):
+        if not self.policy_headers:
+            return {}
+        signature = self.private_key.sign(canonicalize_json(self.policy), ec.ECDSA(hashes.SHA256()))
+        return {
+            'Adfree-Policy': json.dumps(self.policy),
+            'Adfree-Signature': base64.urlsafe_b64encode(signature).rstrip(b'=').decode(),
+            'Cache-Control': 'max-age=300',
+        }
+
+    async def page_handler(self, request):
+        if self.page_gzip is not None and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers = dict(self._headers, **{'Content-Encoding': 'gzip'})
+            return web.Response(body=self.page_gzip, content_type='text/html', headers=headers)
+        return web.Response(body=self.page, content_type='text/html', headers=self._headers)
+
+    async def key_handler(self, request):
+        return web.json_response(self.jwk, headers={'Cache-Control': 'max-age=3600'})
+
+    async def report_handler(self, request):
+        data = await request.json()
+        self.reports_received += len(data) if isinstance(data, list) else 1
+        return web.Response(status=204)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/.well-known/adfree-policy-key', self.key_handler)
+        app.router.add_post('/adfree', self.report_handler)
+        app.router.add_get('/{tail:.*}', self.page_handler)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--page-kb', type=int, default=64)
+    parser.add_argument('--iframes', type=int, default=10)
+    parser.add_argument('--mode', default='strict', choices=['strict', 'relaxed', 'report-only'])
+    parser.add_argument('--gzip', action='store_true', help='Serve gzip to clients that accept it')
+    args = parser.parse_args()
+    upstream = BenchUpstream(args.page_kb, args.iframes, mode=args.mode,
+                             report_to=f'http://{args.host}:{args.port}/adfree', compress=args.gzip)
+    web.run_app(upstream.app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
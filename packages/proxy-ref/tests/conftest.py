@@ -0,0 +1,135 @@
+import base64
+import json
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+from adfree_proxy.keys import CachedKey, PublicKeyCache
+from adfree_proxy.policy import canonicalize_json
+
+# Plantilla de claves sin servidor: todo lo que no se siembre falla al pedirlo
+OFFLINE_KEY_URL = 'http://127.0.0.1:1/{origin}'
+
+
+class Clock:
+    """Reloj manual: los tests avanzan `now` a mano."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def make_clock():
+    return Clock
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def private_key():
+    return ec.generate_private_key(ec.SECP256R1())
+
+
+@pytest.fixture
+def make_key():
+    return lambda: ec.generate_private_key(ec.SECP256R1())
+
+
+@pytest.fixture
+def public_pem(private_key):
+    """PEM de la clave pública (por defecto, la de private_key)."""
+    def pem(key=None) -> bytes:
+        return (key or private_key).public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return pem
+
+
+@pytest.fixture
+def sign(private_key):
+    """Firma Adfree-Signature (base64url sin relleno) de la política canonicalizada."""
+    def signature(policy_data, key=None) -> str:
+        raw = (key or private_key).sign(canonicalize_json(policy_data), ec.ECDSA(hashes.SHA256()))
+        return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+    return signature
+
+
+@pytest.fixture
+def signed_headers(sign):
+    """Cabeceras Adfree-Policy / Adfree-Signature que pondría el upstream."""
+    def headers(policy_data, key=None) -> dict:
+        return {'Adfree-Policy': json.dumps(policy_data), 'Adfree-Signature': sign(policy_data, key)}
+    return headers
+
+
+@pytest.fixture
+def seed_key(public_pem):
+    """Deja en la caché de claves la clave vigente de un origen, sin servidor de claves."""
+    def seed(key_cache, origin, key=None, key_id='k1') -> None:
+        key_cache._store(origin, CachedKey(public_pem(key), key_id, None, float('inf')))
+    return seed
+
+
+@pytest.fixture
+def seeded_key_cache(seed_key):
+    def key_cache(origin, key=None, key_id='k1') -> PublicKeyCache:
+        cache = PublicKeyCache(url_template=OFFLINE_KEY_URL)
+        seed_key(cache, origin, key, key_id)
+        return cache
+    return key_cache
+
+
+@pytest.fixture
+def start_proxy(seed_key):
+    """
+    Arranca upstream_app y un proxy delante con la clave sembrada para su origen.
+    Corrutina: se espera dentro del bucle del test, que cierra lo que devuelve
+    (client, upstream, session, interceptor).
+    """
+    async def start(upstream_app, key=None, **interceptor_options):
+        from adfree_proxy.interceptor import AdfreeInterceptor
+        from adfree_proxy.upstream import create_upstream_session
+
+        upstream = TestServer(upstream_app)
+        await upstream.start_server()
+        session = create_upstream_session()
+        key_cache = PublicKeyCache(url_template=OFFLINE_KEY_URL)
+        interceptor = AdfreeInterceptor(session, upstream_url=str(upstream.make_url('')), key_cache=key_cache,
+                                        **interceptor_options)
+        client = TestClient(TestServer(web.Application(middlewares=[interceptor.intercept_request])))
+        await client.start_server()
+        seed_key(key_cache, f'{client.host}:{client.port}', key)
+        return client, upstream, session, interceptor
+    return start
+
+
+@pytest.fixture
+def make_jwk():
+    def jwk(kid='k1') -> dict:
+        numbers = ec.generate_private_key(ec.SECP256R1()).public_key().public_numbers()
+        return {'kty': 'EC', 'crv': 'P-256', 'x': _b64(numbers.x), 'y': _b64(numbers.y), 'kid': kid}
+    return jwk
+
+
+def _b64(n: int) -> str:
+    return base64.urlsafe_b64encode(n.to_bytes(32, 'big')).rstrip(b'=').decode()
+
+
+@pytest.fixture
+def key_server():
+    """Corrutina: sirve handler como /.well-known/adfree-policy-key; devuelve (server, url_template)."""
+    async def start(handler):
+        app = web.Application()
+        app.router.add_get('/.well-known/adfree-policy-key', handler)
+        server = TestServer(app)
+        await server.start_server()
+        return server, f'http://127.0.0.1:{server.port}/.well-known/adfree-policy-key'
+    return start
@@ -0,0 +1,83 @@
+import asyncio
+
+from adfree_proxy.coalesce import SingleFlight
+
+
+def _proxy(upstream_app, single_flight, policy):
+    async def start():
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer, TestClient
+        from adfree_proxy.interceptor import AdfreeInterceptor
+        from adfree_proxy.upstream import create_upstream_session
+
+        upstream = TestServer(upstream_app)
+        await upstream.start_server()
+        session = create_upstream_session()
+        interceptor = AdfreeInterceptor(session, upstream_url=str(upstream.make_url('')),
+                                        single_flight=single_flight)
+
+        async def fake_policy(upstream_resp, origin):
+            return policy
+        interceptor._policy_from_upstream = fake_policy
+        client = TestClient(TestServer(web.Application(middlewares=[interceptor.intercept_request])))
+        await client.start_server()
+        return client, upstream, session
+    return start()
+
+
+def _burst(cache_control, requests=20):
+    from aiohttp import web
+    from adfree_proxy.policy import AdfreePolicy
+
+    policy = AdfreePolicy.model_validate({'mode': 'strict', 'blocked_domains': ['ads.example.com']})
+    html = b"<html><body><p>viral</p><iframe src='https://ads.example.com/b'></iframe></body></html>"
+    fetches = []
+
+    async def page(request):
+        fetches.append(request.path)
+        await asyncio.sleep(0.2)
+        return web.Response(body=html, content_type='text/html', headers={'Cache-Control': cache_control})
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/', page)
+        client, upstream, session = await _proxy(upstream_app, SingleFlight(max_wait=5), policy)
+
+        async def get(encoding):
+            resp = await client.get('/', headers={'Adfree-Want': '1', 'Accept-Encoding': encoding})
+            assert resp.status == 200
+            return await resp.read()
+        try:
+            bodies = await asyncio.gather(*(get('gzip' if i % 2 else 'identity') for i in range(requests)))
+            assert len(set(bodies)) == 1
+            assert b'ads.example.com' not in bodies[0] and b'viral' in bodies[0]
+            return len(fetches)
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    return asyncio.run(run())
+
+
+def test_concurrent_identical_requests_share_one_fetch():
+    assert _burst('max-age=0') == 1
+
+
+def test_private_responses_are_not_shared():
+    assert _burst('private') == 20
+
+
+def test_followers_fall_back_when_leader_is_slow():
+    async def run():
+        flights = SingleFlight(max_wait=0.05)
+        flight, leader = flights.join(('GET', 'http://a/'), {})
+        follower_flight, follower_is_leader = flights.join(('GET', 'http://a/'), {})
+        assert leader and not follower_is_leader and follower_flight is flight
+        assert await flights.wait(flight) is None
+        flights.release(flight)
+        assert len(flights) == 0
+        _, leader = flights.join(('GET', 'http://a/'), {})
+        assert leader
+
+    asyncio.run(run())
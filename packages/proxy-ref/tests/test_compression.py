@@ -0,0 +1,78 @@
+import gzip
+import zlib
+
+import pytest
+
+from adfree_proxy.compression import (
+    MAX_DECODED_CHUNK,
+    CompressionConfig,
+    CompressionError,
+    StreamDecoder,
+    StreamEncoder,
+    negotiate_encoding,
+    upstream_accept_encoding,
+)
+
+
+def _decode_all(encoding, body, chunk=1000):
+    decoder = StreamDecoder(encoding)
+    pieces = []
+    for i in range(0, len(body), chunk):
+        pieces.extend(decoder.decompress(body[i:i + chunk]))
+    pieces.append(decoder.flush())
+    return pieces
+
+
+def test_negotiation_honours_q_values_and_proxy_preference():
+    offered = ('gzip', 'deflate')
+    assert negotiate_encoding('gzip, deflate', offered) == 'gzip'
+    assert negotiate_encoding('gzip;q=0.5, deflate', offered) == 'deflate'
+    assert negotiate_encoding('gzip;q=0, *', offered) == 'deflate'
+    assert negotiate_encoding('br', offered) == 'identity'
+    assert negotiate_encoding(None, offered) == 'identity'
+    assert negotiate_encoding('identity;q=0, deflate;q=0.1', offered) == 'deflate'
+    assert negotiate_encoding('identity, gzip;q=0.5', offered) == 'identity'
+    assert negotiate_encoding('identity, gzip', offered) == 'gzip'
+    assert negotiate_encoding('identity;q=0, br', offered) is None
+    assert negotiate_encoding('*;q=0', offered) is None
+    assert negotiate_encoding('identity;q=0', ()) is None
+    assert upstream_accept_encoding('identity') == 'identity'
+    assert 'gzip' in upstream_accept_encoding('gzip, zstd')
+    assert 'zstd' not in upstream_accept_encoding('gzip, zstd')
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'deflate'])
+def test_encoder_output_round_trips(encoding):
+    body = b'<p>hello</p>' * 5000
+    encoder = StreamEncoder(encoding, CompressionConfig(level=1))
+    compressed = b''.join(encoder.compress(body[i:i + 4096]) for i in range(0, len(body), 4096))
+    compressed += encoder.finish()
+    assert len(compressed) < len(body)
+    assert b''.join(_decode_all(encoding, compressed)) == body
+
+
+def test_decoder_handles_raw_deflate_and_multi_member_gzip():
+    body = b'<html>' + b'x' * 10000 + b'</html>'
+    raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    assert b''.join(_decode_all('deflate', raw.compress(body) + raw.flush())) == body
+    assert b''.join(_decode_all('gzip', gzip.compress(body) + gzip.compress(body))) == body * 2
+
+
+def test_decoder_bounds_output_per_piece():
+    bomb = gzip.compress(b'\0' * (8 * MAX_DECODED_CHUNK))
+    pieces = _decode_all('gzip', bomb, chunk=len(bomb))
+    assert max(len(p) for p in pieces) <= MAX_DECODED_CHUNK
+    assert sum(len(p) for p in pieces) == 8 * MAX_DECODED_CHUNK
+
+
+def test_decoder_rejects_corrupt_body():
+    with pytest.raises(CompressionError):
+        _decode_all('gzip', b'\x1f\x8b\x08\x00' + b'garbage' * 10)
+
+
+def test_brotli_round_trip_when_available():
+    pytest.importorskip('brotli')
+    body = b'<p>brotli</p>' * 1000
+    encoder = StreamEncoder('br')
+    compressed = encoder.compress(body) + encoder.finish()
+    assert b''.join(_decode_all('br', compressed)) == body
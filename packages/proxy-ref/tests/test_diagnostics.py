@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+
+from adfree_proxy.diagnostics import LoopMonitor, SamplingProfiler, profile_handler
+from adfree_proxy.metrics import LOOP_STALLS
+
+
+def test_blocking_coroutine_is_reported_with_its_stack(caplog):
+    def parse_everything():
+        time.sleep(0.3)  # Trabajo síncrono que bloquea el loop
+
+    async def handle_page():
+        parse_everything()
+
+    async def run():
+        monitor = LoopMonitor(interval=0.02, slow_callback=0.1)
+        monitor.start()
+        try:
+            await asyncio.sleep(0.05)
+            await asyncio.get_running_loop().create_task(handle_page(), name='page')
+            await asyncio.sleep(0.05)
+        finally:
+            await monitor.close()
+        return monitor.max_lag
+
+    stalls = LOOP_STALLS._value.get()
+    with caplog.at_level(logging.WARNING, logger='adfree_proxy.diagnostics'):
+        max_lag = asyncio.run(run())
+    assert max_lag >= 0.2
+    assert LOOP_STALLS._value.get() == stalls + 1
+    [record] = [r for r in caplog.records if 'Event loop blocked' in r.getMessage()]
+    message = record.getMessage()
+    assert 'by task page (' in message and 'handle_page' in message
+    assert 'parse_everything' in message
+
+
+def test_profile_endpoint_returns_collapsed_stacks():
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+
+    def busy_loop_work():
+        end = time.perf_counter() + 0.002
+        while time.perf_counter() < end:
+            pass
+
+    async def keep_busy(stop):
+        while not stop.is_set():
+            busy_loop_work()
+            await asyncio.sleep(0)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/debug/profile', profile_handler(SamplingProfiler(interval=0.001), 'secret'))
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        stop = asyncio.Event()
+        worker = asyncio.get_running_loop().create_task(keep_busy(stop))
+        try:
+            forbidden = await client.get('/debug/profile?seconds=0.1')
+            invalid = await client.get('/debug/profile?seconds=600', headers={'Authorization': 'Bearer secret'})
+            resp = await client.get('/debug/profile?seconds=0.3', headers={'Authorization': 'Bearer secret'})
+            return forbidden.status, invalid.status, resp.status, await resp.text()
+        finally:
+            stop.set()
+            await worker
+            await client.close()
+
+    forbidden, invalid, status, body = asyncio.run(run())
+    assert (forbidden, invalid, status) == (403, 400, 200)
+    lines = body.splitlines()
+    assert lines and all(line.rsplit(' ', 1)[1].isdigit() for line in lines)
+    assert any('keep_busy' in line and 'busy_loop_work' in line for line in lines)
+    assert all(line.startswith('MainThread;') for line in lines)
+
+
+def test_only_one_profile_at_a_time():
+    import threading
+
+    profiler = SamplingProfiler(interval=0.01)
+    started = threading.Thread(target=profiler.sample, args=(0.2,))
+    started.start()
+    time.sleep(0.05)
+    try:
+        profiler.sample(0.01)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('second profile was not rejected')
+    finally:
+        started.join()
+    assert not profiler.running
+
+
+def test_profile_requires_a_token():
+    from aiohttp import web
+    from aiohttp.test_utils import TestClient, TestServer
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/debug/profile', profile_handler(SamplingProfiler(interval=0.001)))
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            # Un cliente local sin token no es administrador
+            return (await client.get('/debug/profile?seconds=0.1')).status
+        finally:
+            await client.close()
+
+    assert asyncio.run(run()) == 403
@@ -13,5 +13,281 @@ def test_intercept_runs():
     evaluator = PolicyEvaluator({})
     interceptor = RequestInterceptor(evaluator)
     req = DummyRequest()
-    decision = asyncio.get_event_loop().run_until_complete(interceptor.intercept(req))
+    decision = asyncio.run(interceptor.intercept(req))
     assert 'action' in decision
+
+
+async def _proxy_client(upstream_app):
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer, TestClient
+    from adfree_proxy.interceptor import AdfreeInterceptor
+    from adfree_proxy.upstream import create_upstream_session
+
+    upstream = TestServer(upstream_app)
+    await upstream.start_server()
+    session = create_upstream_session()
+    interceptor = AdfreeInterceptor(session, upstream_url=str(upstream.make_url('')))
+    app = web.Application(middlewares=[interceptor.intercept_request])
+    app.router.add_get('/metrics', interceptor.metrics_handler)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    return client, upstream, session
+
+
+def test_forward_streams_untouched_response():
+    from aiohttp import web
+
+    async def page(request):
+        return web.Response(body=b'x' * 200000, content_type='application/octet-stream',
+                            headers={'X-Upstream': request.headers.get('Via', '')})
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/file', page)
+        client, upstream, session = await _proxy_client(upstream_app)
+        try:
+            resp = await client.get('/file?a=1', headers={'Adfree-Want': '1'})
+            body = await resp.read()
+            assert resp.status == 200
+            assert body == b'x' * 200000
+            assert 'adfree-proxy' in resp.headers['X-Upstream']
+
+            metrics = await client.get('/metrics')
+            assert metrics.status == 200
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    asyncio.run(run())
+
+
+def test_forward_mode_absolute_form_request_line():
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from adfree_proxy.interceptor import AdfreeInterceptor
+    from adfree_proxy.upstream import create_upstream_session
+
+    async def page(request):
+        return web.Response(text=f'{request.host} {request.raw_path}')
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/foo', page)
+        upstream = TestServer(upstream_app)
+        await upstream.start_server()
+        session = create_upstream_session()
+        # Sin upstream_url: proxy forward, el destino sale de la request line
+        interceptor = AdfreeInterceptor(session)
+        proxy = TestServer(web.Application(middlewares=[interceptor.intercept_request]))
+        await proxy.start_server()
+        try:
+            target = f'http://127.0.0.1:{upstream.port}'
+            reader, writer = await asyncio.open_connection('127.0.0.1', proxy.port)
+            writer.write(f'GET {target}/foo?x=1 HTTP/1.1\r\nHost: 127.0.0.1:{upstream.port}\r\n'
+                         f'Connection: close\r\n\r\n'.encode())
+            response = await reader.read()
+            writer.close()
+            head, _, body = response.partition(b'\r\n\r\n')
+            assert head.startswith(b'HTTP/1.1 200')
+            assert body == f'127.0.0.1:{upstream.port} /foo?x=1'.encode()
+        finally:
+            await proxy.close()
+            await session.close()
+            await upstream.close()
+
+    asyncio.run(run())
+
+
+def test_local_routes_only_answer_requests_for_the_proxy():
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer
+    from adfree_proxy.interceptor import AdfreeInterceptor
+    from adfree_proxy.upstream import create_upstream_session
+
+    async def page(request):
+        return web.Response(text=f'upstream {request.raw_path}')
+
+    async def get(port, target, host):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET {target} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n'.encode())
+        response = await reader.read()
+        writer.close()
+        return response.partition(b'\r\n\r\n')[2]
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/metrics', page)
+        upstream = TestServer(upstream_app)
+        await upstream.start_server()
+        session = create_upstream_session()
+        interceptor = AdfreeInterceptor(session)
+        app = web.Application(middlewares=[interceptor.intercept_request])
+        app.router.add_get('/metrics', interceptor.metrics_handler)
+        proxy = TestServer(app)
+        await proxy.start_server()
+        try:
+            other = f'127.0.0.1:{upstream.port}'
+            # La página /metrics de otro origen se reenvía, en absolute-form o por Host
+            assert await get(proxy.port, f'http://{other}/metrics', other) == b'upstream /metrics'
+            assert await get(proxy.port, '/metrics', other) == b'upstream /metrics'
+            # Solo lo dirigido al propio proxy lo responde el proxy
+            own = f'127.0.0.1:{proxy.port}'
+            assert b'adfree_' in await get(proxy.port, f'http://{own}/metrics', own)
+            assert b'adfree_' in await get(proxy.port, '/metrics', f'localhost:{proxy.port}')
+        finally:
+            await proxy.close()
+            await session.close()
+            await upstream.close()
+
+    asyncio.run(run())
+
+
+def test_forward_unreachable_upstream_returns_502():
+    from aiohttp import web
+    from aiohttp.test_utils import TestServer, TestClient
+    from adfree_proxy.interceptor import AdfreeInterceptor
+    from adfree_proxy.upstream import create_upstream_session
+
+    async def run():
+        session = create_upstream_session()
+        interceptor = AdfreeInterceptor(session, upstream_url='http://127.0.0.1:1')
+        app = web.Application(middlewares=[interceptor.intercept_request])
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            resp = await client.get('/')
+            assert resp.status == 502
+        finally:
+            await client.close()
+            await session.close()
+
+    asyncio.run(run())
+
+
+def test_rewrite_path_streams_chunked_html():
+    from aiohttp import web
+    from adfree_proxy.policy import AdfreePolicy
+
+    policy = AdfreePolicy.parse_obj({'mode': 'strict', 'blocked_domains': ['ads.example.com']})
+    html = (b"<html><head></head><body>" + b"<p>row</p>" * 20000 +
+            b"<iframe src='https://ads.example.com/banner'></iframe></body></html>")
+
+    async def page(request):
+        return web.Response(body=html, content_type='text/html')
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/', page)
+        client, upstream, session = await _proxy_client(upstream_app)
+        interceptor = client.server.app.middlewares[0].__self__
+
+        async def fake_policy(upstream_resp, origin):
+            return policy
+        interceptor._policy_from_upstream = fake_policy
+        try:
+            resp = await client.get('/', headers={'Adfree-Want': '1'})
+            body = await resp.read()
+            assert resp.headers.get('Transfer-Encoding') == 'chunked'
+            assert b'ads.example.com' not in body
+            assert b'window.open' in body
+            assert body.count(b'<p>row</p>') == 20000
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    asyncio.run(run())
+
+
+def test_injected_empty_caches_are_kept():
+    from adfree_proxy.interceptor import AdfreeInterceptor
+    from adfree_proxy.keys import PublicKeyCache
+    from adfree_proxy.policy_store import PolicyStore
+
+    key_cache = PublicKeyCache(url_template='http://127.0.0.1/key')
+    store = PolicyStore()
+    interceptor = AdfreeInterceptor(None, key_cache=key_cache, policy_store=store)
+    assert interceptor.key_cache is key_cache
+    assert interceptor.active_policies is store
+
+
+def test_rewrite_inflates_gzip_and_recompresses_for_client():
+    import gzip
+    import zlib
+    from aiohttp import web
+    from adfree_proxy.policy import AdfreePolicy
+
+    policy = AdfreePolicy.parse_obj({'mode': 'strict', 'blocked_domains': ['ads.example.com']})
+    html = (b"<html><head></head><body>" + b"<p>row</p>" * 20000 +
+            b"<iframe src='https://ads.example.com/banner'></iframe></body></html>")
+    seen = []
+
+    async def page(request):
+        seen.append(request.headers.get('Accept-Encoding'))
+        return web.Response(body=gzip.compress(html), content_type='text/html',
+                            headers={'Content-Encoding': 'gzip'})
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/', page)
+        client, upstream, session = await _proxy_client(upstream_app)
+        interceptor = client.server.app.middlewares[0].__self__
+
+        async def fake_policy(upstream_resp, origin):
+            return policy
+        interceptor._policy_from_upstream = fake_policy
+        try:
+            # Client prefers deflate: gzip from upstream is inflated, rewritten and re-encoded
+            resp = await client.get('/', headers={'Adfree-Want': '1', 'Accept-Encoding': 'gzip;q=0.5, deflate'},
+                                    auto_decompress=False)
+            assert resp.headers['Content-Encoding'] == 'deflate'
+            assert 'Accept-Encoding' in resp.headers['Vary']
+            body = zlib.decompress(await resp.read())
+            assert b'ads.example.com' not in body
+            assert body.count(b'<p>row</p>') == 20000
+
+            resp = await client.get('/', headers={'Adfree-Want': '1', 'Accept-Encoding': 'identity'},
+                                    auto_decompress=False)
+            assert 'Content-Encoding' not in resp.headers
+            body = await resp.read()
+            assert b'ads.example.com' not in body and body.count(b'<p>row</p>') == 20000
+            assert seen[-1] == 'identity'
+
+            # Nothing acceptable, not even identity: 406 instead of an unencoded body
+            resp = await client.get('/', headers={'Adfree-Want': '1', 'Accept-Encoding': 'identity;q=0, zstd'},
+                                    auto_decompress=False)
+            assert resp.status == 406
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    asyncio.run(run())
+
+
+def test_passthrough_keeps_compressed_bytes():
+    import gzip
+    from aiohttp import web
+
+    payload = gzip.compress(b'{"a": 1}' * 1000)
+
+    async def data(request):
+        return web.Response(body=payload, content_type='application/json',
+                            headers={'Content-Encoding': 'gzip'})
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/data', data)
+        client, upstream, session = await _proxy_client(upstream_app)
+        try:
+            resp = await client.get('/data', headers={'Adfree-Want': '1', 'Accept-Encoding': 'gzip'},
+                                    auto_decompress=False)
+            assert resp.headers['Content-Encoding'] == 'gzip'
+            assert await resp.read() == payload
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    asyncio.run(run())
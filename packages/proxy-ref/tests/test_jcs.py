@@ -0,0 +1,97 @@
+import struct
+
+import pytest
+
+from adfree_proxy.jcs import CanonicalDict, JCSError, canonicalize, canonicalize_raw, format_number, loads
+
+# RFC 8785, apéndice B: bits IEEE 754 -> forma canónica
+NUMBER_VECTORS = [
+    ('0000000000000000', '0'),
+    ('8000000000000000', '0'),
+    ('0000000000000001', '5e-324'),
+    ('8000000000000001', '-5e-324'),
+    ('7fefffffffffffff', '1.7976931348623157e+308'),
+    ('ffefffffffffffff', '-1.7976931348623157e+308'),
+    ('4340000000000000', '9007199254740992'),
+    ('c340000000000000', '-9007199254740992'),
+    ('4430000000000000', '295147905179352830000'),
+    ('44b52d02c7e14af5', '9.999999999999997e+22'),
+    ('44b52d02c7e14af6', '1e+23'),
+    ('44b52d02c7e14af7', '1.0000000000000001e+23'),
+    ('444b1ae4d6e2ef4e', '999999999999999700000'),
+    ('444b1ae4d6e2ef4f', '999999999999999900000'),
+    ('444b1ae4d6e2ef50', '1e+21'),
+    ('3eb0c6f7a0b5ed8c', '9.999999999999997e-7'),
+    ('3eb0c6f7a0b5ed8d', '0.000001'),
+    ('41b3de4355555553', '333333333.3333332'),
+    ('41b3de4355555554', '333333333.33333325'),
+    ('41b3de4355555555', '333333333.3333333'),
+    ('41b3de4355555556', '333333333.3333334'),
+    ('41b3de4355555557', '333333333.33333343'),
+    ('becbf647612f3696', '-0.0000033333333333333333'),
+    ('43143ff3c1cb0959', '1424953923781206.2'),
+]
+
+
+@pytest.mark.parametrize('bits,expected', NUMBER_VECTORS)
+def test_number_vectors(bits, expected):
+    value = struct.unpack('>d', bytes.fromhex(bits))[0]
+    assert format_number(value) == expected
+
+
+@pytest.mark.parametrize('bits', ['7fffffffffffffff', '7ff0000000000000', 'fff0000000000000'])
+def test_nan_and_infinity_are_rejected(bits):
+    with pytest.raises(JCSError):
+        format_number(struct.unpack('>d', bytes.fromhex(bits))[0])
+
+
+def test_integers_are_ieee_doubles():
+    assert format_number(2 ** 53) == '9007199254740992'
+    assert format_number(2 ** 60) == '1152921504606847000'
+    assert format_number(-10 ** 25) == '-1e+25'
+    assert format_number(1.0) == '1'
+    with pytest.raises(JCSError):
+        format_number(10 ** 400)
+
+
+def test_rfc_example():
+    # RFC 8785 §3.2.2
+    raw = ('{"numbers": [333333333.33333329, 1E30, 4.50, 2e-3, 0.000000000000000000000000001], '
+           '"string": "\\u20ac$\\u000F\\u000aA\'\\u0042\\u0022\\u005c\\\\\\"\\/", '
+           '"literals": [null, true, false]}')
+    expected = ('{"literals":[null,true,false],"numbers":[333333333.3333333,1e+30,4.5,0.002,1e-27],'
+                '"string":"€$\\u000f\\nA\'B\\"\\\\\\\\\\"/"}').encode()
+    assert canonicalize_raw(raw) == expected
+    assert canonicalize_raw(raw.encode()) == expected
+
+
+def test_keys_sorted_by_utf16_code_units():
+    # RFC 8785 §3.2.3
+    data = {'\u20ac': 'Euro Sign', '\r': 'Carriage Return', '\ufb33': 'Hebrew Letter Dalet With Dagesh',
+            '1': 'One', '\U0001f600': 'Emoji: Grinning Face', '\u0080': 'Control',
+            '\u00f6': 'Latin Small Letter O With Diaeresis'}
+    order = ['\r', '1', '\u0080', '\u00f6', '\u20ac', '\U0001f600', '\ufb33']
+    expected = ('{' + ','.join(f'"{k}":"{data[k]}"' for k in order) + '}').replace('\r', '\\r').encode()
+    assert canonicalize(data) == expected
+    assert canonicalize_raw(canonicalize(data)) == expected
+
+
+def test_loads_keeps_canonical_order_and_matches_dict_path():
+    raw = '{"b": {"y": [1, 2.0, {"d": 1, "c": 2}], "x": "é"}, "a": -0}'
+    parsed = loads(raw)
+    assert type(parsed) is CanonicalDict and list(parsed) == ['a', 'b']
+    assert list(parsed['b']['y'][2]) == ['c', 'd']
+    assert canonicalize(parsed) == canonicalize(dict(parsed)) == '{"a":0,"b":{"x":"é","y":[1,2,{"c":2,"d":1}]}}'.encode()
+
+
+@pytest.mark.parametrize('raw', [
+    '{"a": 1, "a": 2}',
+    '{"a": NaN}',
+    '[Infinity]',
+    '["\\ud800"]',
+    '{"a": ',
+    b'"\xff"',
+])
+def test_invalid_input(raw):
+    with pytest.raises(JCSError):
+        canonicalize_raw(raw)
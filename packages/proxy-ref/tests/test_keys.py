@@ -0,0 +1,152 @@
+import asyncio
+
+from aiohttp import web
+
+from adfree_proxy.keys import PublicKeyCache, parse_cache_lifetime
+
+
+def test_parse_cache_lifetime():
+    assert parse_cache_lifetime('public, max-age=60') == 60
+    assert parse_cache_lifetime('max-age=60, s-maxage=10') == 10
+    assert parse_cache_lifetime('no-store') == 0
+    assert parse_cache_lifetime(None) is None
+
+
+def test_concurrent_misses_are_coalesced_and_cached(make_jwk, key_server):
+    calls = []
+    jwk = make_jwk()
+
+    async def handler(request):
+        calls.append(request.headers.get('If-None-Match'))
+        await asyncio.sleep(0.05)
+        return web.json_response(jwk, headers={'Cache-Control': 'max-age=60', 'ETag': '"v1"'})
+
+    async def run():
+        server, template = await key_server(handler)
+        cache = PublicKeyCache(url_template=template)
+        try:
+            pems = await asyncio.gather(*(cache.get('example.com') for _ in range(20)))
+            assert len(set(pems)) == 1 and pems[0].startswith(b'-----BEGIN PUBLIC KEY-----')
+            assert await cache.get('example.com') == pems[0]
+            assert calls == [None]
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_expired_key_is_revalidated_with_etag(make_jwk, key_server, make_clock):
+    calls = []
+    jwk = make_jwk()
+    clock = make_clock(0.0)
+
+    async def handler(request):
+        calls.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers={'Cache-Control': 'max-age=60'})
+        return web.json_response(jwk, headers={'Cache-Control': 'max-age=60', 'ETag': '"v1"'})
+
+    async def run():
+        server, template = await key_server(handler)
+        cache = PublicKeyCache(url_template=template, clock=clock)
+        try:
+            first = await cache.get('example.com')
+            clock.now = 61.0
+            assert await cache.get('example.com') == first
+            assert calls == [None, '"v1"']
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_failures_are_negatively_cached_with_backoff(key_server, make_clock):
+    calls = []
+    clock = make_clock(0.0)
+
+    async def handler(request):
+        calls.append(1)
+        return web.Response(status=500)
+
+    async def run():
+        server, template = await key_server(handler)
+        cache = PublicKeyCache(url_template=template, negative_ttl=5.0, clock=clock)
+        try:
+            assert await cache.get('example.com') is None
+            assert await cache.get('example.com') is None
+            assert len(calls) == 1
+            clock.now = 6.0
+            assert await cache.get('example.com') is None
+            assert len(calls) == 2
+            # second failure doubles the backoff
+            clock.now = 12.0
+            assert await cache.get('example.com') is None
+            assert len(calls) == 2
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_rotation_is_detected_by_key_material_not_kid(make_jwk, key_server, make_clock):
+    jwks = [make_jwk('same'), make_jwk('same')]
+    clock = make_clock(0.0)
+
+    async def handler(request):
+        return web.json_response(jwks[0], headers={'Cache-Control': 'max-age=60'})
+
+    async def run():
+        server, template = await key_server(handler)
+        cache = PublicKeyCache(url_template=template, clock=clock)
+        rotated = []
+        cache.on_rotate.append(rotated.append)
+        try:
+            first = await cache.lookup('example.com')
+            clock.now = 61.0
+            assert (await cache.lookup('example.com')).fingerprint == first.fingerprint
+            assert rotated == []
+            jwks.pop(0)  # Clave nueva con el mismo kid
+            clock.now = 122.0
+            second = await cache.lookup('example.com')
+            assert second.key_id == first.key_id and second.fingerprint != first.fingerprint
+            assert rotated == ['example.com']
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_last_good_key_is_served_while_refreshes_fail(make_jwk, key_server, make_clock):
+    jwks = [make_jwk('k1'), make_jwk('k2')]
+    failing = [False]
+    clock = make_clock(0.0)
+
+    async def handler(request):
+        if failing[0]:
+            return web.Response(status=503)
+        return web.json_response(jwks[0], headers={'Cache-Control': 'max-age=60'})
+
+    async def run():
+        server, template = await key_server(handler)
+        cache = PublicKeyCache(url_template=template, negative_ttl=5.0, stale_if_error=10.0,
+                               clock=clock)
+        rotated = []
+        cache.on_rotate.append(rotated.append)
+        try:
+            good = await cache.get('example.com')
+            failing[0] = True
+            clock.now = 61.0
+            assert await cache.get('example.com') == good  # stale-if-error (5 s de backoff)
+            clock.now = 67.0
+            assert await cache.get('example.com') is None  # 15 s > stale_if_error: fallo cacheado
+
+            # El origen vuelve con otra clave: se compara con la última buena, no con el fallo
+            failing[0] = False
+            jwks.pop(0)
+            clock.now = 100.0
+            assert await cache.get('example.com') not in (None, good)
+            assert rotated == ['example.com']
+        finally:
+            await server.close()
+
+    asyncio.run(run())
@@ -0,0 +1,25 @@
+from adfree_proxy.matcher import DomainMatcher
+from adfree_proxy.policy import AdfreePolicy
+
+
+def test_exact_and_wildcard_rules():
+    matcher = DomainMatcher(['ads.example.com', '*.trackers.net', '*.ads.example.org'])
+    assert matcher.match('ads.example.com') == 'ads.example.com'
+    assert matcher.match('ADS.Example.com.') == 'ads.example.com'
+    assert matcher.match('www.ads.example.com') is None
+    assert matcher.match('trackers.net') == '*.trackers.net'
+    assert matcher.match('a.b.trackers.net') == '*.trackers.net'
+    assert matcher.match('x.ads.example.org') == '*.ads.example.org'
+
+
+def test_wildcards_match_on_label_boundaries():
+    matcher = DomainMatcher(['*.ads.example.com'])
+    assert matcher.match('evilads.example.com') is None
+    assert matcher.match('example.com') is None
+    assert matcher.match('x.ads.example.com') == '*.ads.example.com'
+
+
+def test_policy_compiles_matcher_once():
+    policy = AdfreePolicy.parse_obj({'mode': 'strict', 'blocked_domains': ['*.ads.example.com']})
+    assert policy.blocked_matcher is policy.blocked_matcher
+    assert policy.blocked_matcher.match('cdn.ads.example.com') == '*.ads.example.com'
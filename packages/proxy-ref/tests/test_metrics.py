@@ -5,3 +5,17 @@ def test_metrics_inc():
     m = MetricsCollector()
     m.inc_requests()
     # No assertion for prometheus counter, just ensure call doesn't raise
+
+
+def test_request_labels_are_bounded():
+    from adfree_proxy.metrics import RequestMetrics, OVERFLOW_LABEL, REQUEST_COUNT
+
+    metrics = RequestMetrics(max_routes=2, max_origins=3)
+    children = {metrics.children('GET', 'upstream', f'host{i}.example') for i in range(1000)}
+    assert len(children) == 4
+    assert metrics.children('GET', 'upstream', 'host0.example') is metrics.children('GET', 'upstream', 'host0.example')
+
+    metrics.children('BREW', 'upstream', 'host0.example')[0].inc()
+    labels = {s.labels['origin'] for s in REQUEST_COUNT.collect()[0].samples}
+    assert OVERFLOW_LABEL in labels
+    assert 'host999.example' not in labels
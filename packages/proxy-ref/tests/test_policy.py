@@ -20,4 +20,54 @@ def test_policy_validation():
     }
     policy = AdfreePolicy.parse_obj(policy_data)
     assert policy.mode == "strict"
-    assert policy.max_ads_per_page == 3
\ No newline at end of file
+    assert policy.max_ads_per_page == 3
+
+def test_validate_policy_header_memoizes_verified_policy(monkeypatch, sign, seeded_key_cache):
+    import asyncio
+    import json
+    from adfree_proxy import policy as policy_module
+    from adfree_proxy.policy_cache import VerifiedPolicyCache
+
+    policy_data = {"mode": "strict", "blocked_domains": ["ads.example.com"]}
+    raw, signature = json.dumps(policy_data), sign(policy_data)
+    key_cache = seeded_key_cache('example.com')
+    policy_cache = VerifiedPolicyCache()
+
+    calls = []
+    verify = policy_module.verify_policy_signature
+    monkeypatch.setattr(policy_module, 'verify_policy_signature', lambda *a: calls.append(1) or verify(*a))
+
+    async def run():
+        first = await policy_module.validate_policy_header(raw, signature, 'example.com', key_cache, policy_cache)
+        second = await policy_module.validate_policy_header(raw, signature, 'example.com', key_cache, policy_cache)
+        assert first is not None and second is first
+        assert len(calls) == 1
+
+        forged = await policy_module.validate_policy_header(raw.replace('strict', 'relaxed'), signature,
+                                                            'example.com', key_cache, policy_cache)
+        assert forged is None
+
+        policy_cache.invalidate_origin('example.com')
+        assert len(policy_cache) == 0
+
+    asyncio.run(run())
+
+
+def test_memoized_policy_is_not_served_after_rotation_that_keeps_the_kid(sign, seeded_key_cache, seed_key,
+                                                                          make_key):
+    import asyncio
+    import json
+    from adfree_proxy import policy as policy_module
+    from adfree_proxy.policy_cache import VerifiedPolicyCache
+
+    raw, signature = json.dumps({"mode": "strict"}), sign({"mode": "strict"})
+    key_cache = seeded_key_cache('example.com', key_id='k1')
+    policy_cache = VerifiedPolicyCache()
+
+    async def run():
+        assert await policy_module.validate_policy_header(raw, signature, 'example.com', key_cache, policy_cache)
+        # El origen rota a otra clave con el mismo kid (sin pasar por on_rotate)
+        seed_key(key_cache, 'example.com', make_key(), key_id='k1')
+        return await policy_module.validate_policy_header(raw, signature, 'example.com', key_cache, policy_cache)
+
+    assert asyncio.run(run()) is None
@@ -0,0 +1,86 @@
+from adfree_proxy.policy_store import PolicyStore
+
+
+def test_store_is_bounded_lru():
+    store = PolicyStore(max_entries=3)
+    for i in range(5):
+        store.put(f'o{i}.example', object(), b'd')
+    assert len(store) == 3
+    assert 'o0.example' not in store and 'o4.example' in store
+
+
+def test_entries_expire_with_cache_lifetime(make_clock):
+    clock = make_clock(0.0)
+    store = PolicyStore(default_ttl=300, clock=clock)
+    policy = object()
+    store.put('a.example', policy, b'd1', ttl=10)
+    store.put('b.example', policy, b'd1', ttl=0)
+    store.put('a.example', object(), b'd2', ttl=0)  # no-store: no sustituye ni quita la activa
+    assert store.lookup('a.example', b'd1') is policy
+    assert store.lookup('a.example', b'other') is None
+    assert 'b.example' not in store
+    clock.now = 11
+    assert store.lookup('a.example', b'd1') is None
+    assert len(store) == 0
+
+
+def test_lookup_requires_the_key_the_policy_was_verified_with():
+    store = PolicyStore()
+    policy = object()
+    store.put('a.example', policy, b'd1', key_fingerprint=b'key1')
+    assert store.lookup('a.example', b'd1', b'key1') is policy
+    assert store.lookup('a.example', b'd1', b'key2') is None
+
+
+def test_policy_lifetime_does_not_follow_page_freshness():
+    store = PolicyStore(default_ttl=300, max_ttl=3600)
+    assert store.ttl_for(None) == 300
+    assert store.ttl_for('no-cache') == 300
+    assert store.ttl_for('max-age=0, must-revalidate') == 300
+    assert store.ttl_for('max-age=600') == 600
+    assert store.ttl_for('max-age=86400') == 3600
+    assert store.ttl_for('private, no-store') == 0
+    assert PolicyStore(default_ttl=7200, max_ttl=3600).ttl_for(None) == 3600
+
+
+def test_policy_from_no_cache_page_stays_active(signed_headers, start_proxy, seed_key, make_key):
+    import asyncio
+    from aiohttp import web
+    from adfree_proxy.response_cache import ResponseCache
+
+    policy_headers = signed_headers({'mode': 'strict'})
+    other_headers = signed_headers({'mode': 'relaxed'})
+
+    def handler(headers, cache_control):
+        async def page(request):
+            return web.Response(text='<p>hi</p>', content_type='text/html',
+                                headers=dict(headers, **{'Cache-Control': cache_control}))
+        return page
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/fresh', handler(policy_headers, 'no-cache'))
+        upstream_app.router.add_get('/private', handler(other_headers, 'no-store'))
+        client, upstream, session, interceptor = await start_proxy(upstream_app, response_cache=ResponseCache())
+        origin = f'{client.host}:{client.port}'
+        try:
+            resp = await client.get('/fresh', headers={'Adfree-Want': '1'})
+            assert resp.status == 200
+            entry = interceptor.active_policies.get(origin, count=False)
+            assert entry is not None and entry.policy.mode == 'strict'
+            assert entry.expires_at - interceptor.active_policies.clock() > 290
+
+            # Una página no-store no guarda su política ni quita la activa
+            resp = await client.get('/private', headers={'Adfree-Want': '1'})
+            assert resp.status == 200
+            assert interceptor.active_policies.get(origin, count=False) is entry
+
+            # Con otra clave vigente (rotación sin on_rotate), el fast path ya no la da por buena
+            seed_key(interceptor.key_cache, origin, make_key(), key_id='k1')
+            assert await interceptor._policy_from_headers(policy_headers, origin) is None
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    asyncio.run(run())
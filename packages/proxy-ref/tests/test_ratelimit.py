@@ -0,0 +1,130 @@
+import asyncio
+
+from adfree_proxy.policy import BotPolicy
+from adfree_proxy.ratelimit import RateLimiter
+
+
+def test_bucket_allows_burst_then_refills(clock):
+    limiter = RateLimiter(clock=clock)
+    # 2 tokens, uno por segundo
+    assert limiter.take('a', 2, 1.0) == 0
+    assert limiter.take('a', 2, 1.0) == 0
+    assert limiter.take('a', 2, 1.0) == 1.0
+    assert limiter.take('b', 2, 1.0) == 0  # Otro cliente tiene su propio bucket
+    clock.now += 0.5
+    assert limiter.take('a', 2, 1.0) == 0.5
+    clock.now += 0.5
+    assert limiter.take('a', 2, 1.0) == 0
+    assert limiter.take('a', 2, 1.0) > 0
+
+
+def test_idle_buckets_are_swept_and_count_is_bounded(clock):
+    limiter = RateLimiter(max_buckets=100, sweep_interval=10, clock=clock)
+    for i in range(1000):
+        limiter.take(('origin', f'10.0.{i // 256}.{i % 256}'), 5, 1.0)
+    assert len(limiter) == 100
+    clock.now += 5
+    assert limiter.sweep() == 100  # Todos se habrían rellenado ya
+    assert len(limiter) == 0
+
+    limiter.take('a', 5, 0.01)
+    limiter.take('b', 5, 10.0)
+    clock.now += 11
+    limiter.take('c', 5, 10.0)  # Dispara el barrido periódico
+    assert len(limiter) == 2  # 'a' tarda 100 s en rellenarse; 'b' ya está lleno
+
+
+def test_bot_rate_limit_parsing():
+    bot = BotPolicy(payment_url='https://example.com/pay', rate_limit={'requests': 100, 'window': 3600})
+    assert bot.token_bucket == (100.0, 100 / 3600)
+    bot = BotPolicy(payment_url='https://example.com/pay', rate_limit={'requests': 10, 'window': 1, 'burst': 3})
+    assert bot.token_bucket == (3.0, 10.0)
+    assert BotPolicy(payment_url='https://example.com/pay').token_bucket is None
+    assert BotPolicy(payment_url='https://example.com/pay', rate_limit={'window': 'x'}).token_bucket is None
+
+
+def test_forwarded_for_is_only_trusted_when_configured():
+    limiter = RateLimiter()
+    assert limiter.client('10.0.0.1', ['203.0.113.7']) == '10.0.0.1'
+    limiter = RateLimiter(forwarded_hops=1)
+    assert limiter.client('10.0.0.1', ['203.0.113.7']) == '203.0.113.7'
+    # Lo que el cliente pone delante no cuenta: vale la entrada del balanceador
+    assert limiter.client('10.0.0.1', ['1.2.3.4, 203.0.113.7']) == '203.0.113.7'
+    assert limiter.client('10.0.0.1', ['1.2.3.4', '203.0.113.7']) == '203.0.113.7'
+    assert limiter.client('10.0.0.1', []) == '10.0.0.1'
+    limiter = RateLimiter(forwarded_hops=2)
+    assert limiter.client('10.0.0.1', ['1.2.3.4, 203.0.113.7, 10.0.0.9']) == '203.0.113.7'
+    assert limiter.client('10.0.0.1', ['203.0.113.7']) == '10.0.0.1'
+
+
+def _rate_limited_statuses(signed_headers, start_proxy, requests, forwarded_hops=0,
+                           client_headers=lambda i: {}, payment_url='https://example.com/pay'):
+    fetches = []
+
+    async def run():
+        from aiohttp import web
+
+        policy_headers = signed_headers({
+            'mode': 'strict',
+            'bot_policy': {'payment_url': payment_url,
+                           'rate_limit': {'requests': 1, 'window': 3600, 'burst': 2}},
+        })
+
+        async def page(request):
+            fetches.append(request.path)
+            # no-cache: la frescura de la página no limita la vida de la política
+            return web.Response(text='<p>ok</p>', content_type='text/html',
+                                headers=dict(policy_headers, **{'Cache-Control': 'no-cache'}))
+
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/{tail:.*}', page)
+        client, upstream, session, _ = await start_proxy(
+            upstream_app, rate_limiter=RateLimiter(forwarded_hops=forwarded_hops))
+        try:
+            statuses = []
+            for i in range(requests):
+                resp = await client.get(f'/{i}', headers=dict(client_headers(i), **{'Adfree-Want': '1'}))
+                statuses.append(resp.status)
+                if resp.status == 402:
+                    body = await resp.json()
+                    assert body['payment_url'] == payment_url
+                    assert int(resp.headers['Retry-After']) == body['retry_after'] > 0
+                    assert resp.headers.get('Link') == BotPolicy(payment_url=payment_url).payment_link
+            return statuses
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    return asyncio.run(run()), fetches
+
+
+def test_over_limit_requests_are_answered_without_upstream(signed_headers, start_proxy):
+    # La primera página trae la política firmada; desde ahí cuenta el límite (burst 2)
+    statuses, fetches = _rate_limited_statuses(signed_headers, start_proxy, 5)
+    assert statuses == [200, 200, 200, 402, 402]
+    assert fetches == ['/0', '/1', '/2']
+
+
+def test_clients_behind_trusted_proxy_get_their_own_bucket(signed_headers, start_proxy):
+    def behind_balancer(i):
+        return {'X-Forwarded-For': f'spoofed, 203.0.113.{i % 2}'}
+
+    statuses, _ = _rate_limited_statuses(signed_headers, start_proxy, 7, forwarded_hops=1,
+                                         client_headers=behind_balancer)
+    assert statuses == [200, 200, 200, 200, 200, 402, 402]
+    # Sin confiar en la cabecera, todos son el mismo cliente
+    statuses, _ = _rate_limited_statuses(signed_headers, start_proxy, 7, client_headers=behind_balancer)
+    assert statuses == [200, 200, 200, 402, 402, 402, 402]
+
+
+def test_payment_link_is_only_sent_for_clean_http_urls(signed_headers, start_proxy):
+    assert BotPolicy(payment_url='https://example.com/pay?a=1').payment_link == \
+        '<https://example.com/pay?a=1>; rel="payment"'
+    for url in ('https://example.com/pay\r\nSet-Cookie: a=b', 'https://example.com/pa y', 'javascript:alert(1)',
+                '/pay', 'https://', 'https://example.com/>; rel="x', 'https://[::1/pay', 'https://ejemplo.es/pagó'):
+        assert BotPolicy(payment_url=url).payment_link is None, url
+    # Sin Link, pero la respuesta sigue siendo el 402 (no un 500)
+    statuses, _ = _rate_limited_statuses(signed_headers, start_proxy, 4,
+                                         payment_url='https://example.com/pay\r\nSet-Cookie: a=b')
+    assert statuses == [200, 200, 200, 402]
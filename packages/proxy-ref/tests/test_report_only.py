@@ -0,0 +1,157 @@
+import asyncio
+import gzip
+
+from adfree_proxy.report_only import ReportOnlyScanner
+from adfree_proxy.rewriter import HtmlRewriter
+
+PAGE = (b"<html><body><p>story</p><iframe src='https://ads.example.com/a'></iframe>"
+        b"<iframe src='https://ads.example.com/a'></iframe></body></html>")
+
+
+class FakeReporter:
+    def __init__(self):
+        self.violations = []
+
+    def enqueue_violation(self, policy, violation):
+        self.violations.append(violation)
+
+    async def close(self):
+        pass
+
+
+def test_report_only_serves_original_bytes_and_reports_after_scan():
+    body = gzip.compress(PAGE)
+
+    async def run():
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer, TestClient
+        from adfree_proxy.interceptor import AdfreeInterceptor
+        from adfree_proxy.policy import AdfreePolicy
+        from adfree_proxy.upstream import create_upstream_session
+
+        async def page(request):
+            return web.Response(body=body, content_type='text/html', headers={'Content-Encoding': 'gzip'})
+
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/', page)
+        upstream = TestServer(upstream_app)
+        await upstream.start_server()
+        session = create_upstream_session()
+        reporter = FakeReporter()
+        interceptor = AdfreeInterceptor(session, upstream_url=str(upstream.make_url('')), reporter=reporter,
+                                        report_only=ReportOnlyScanner(sample_rate=1.0, cpu_budget=1.0))
+
+        async def fake_policy(upstream_resp, origin):
+            return AdfreePolicy.model_validate({'mode': 'report-only', 'blocked_domains': ['ads.example.com'],
+                                                'report_to': 'https://example.com/report'})
+        interceptor._policy_from_upstream = fake_policy
+        client = TestClient(TestServer(web.Application(middlewares=[interceptor.intercept_request])),
+                            auto_decompress=False)
+        await client.start_server()
+        try:
+            received = []
+            for _ in range(2):
+                resp = await client.get('/', headers={'Adfree-Want': '1', 'Accept-Encoding': 'gzip'})
+                received.append((resp.headers.get('Content-Encoding'), await resp.read()))
+                await asyncio.gather(*interceptor.report_only._tasks)
+            return received, reporter.violations
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    received, violations = asyncio.run(run())
+    assert received == [('gzip', body), ('gzip', body)]
+    # Dos iframes iguales en la página y dos visitas: un solo reporte
+    assert len(violations) == 1
+    assert violations[0]['url'] == 'https://ads.example.com/a'
+    assert violations[0]['type'] == 'blocked_iframe' and violations[0]['action'] == 'reported'
+
+
+def test_sampling_and_cpu_budget(clock, make_clock):
+    cpu = make_clock(0.0)
+    draws = iter([0.05, 0.5])
+    scanner = ReportOnlyScanner(sample_rate=0.1, cpu_budget=0.01, rng=lambda: next(draws),
+                                clock=clock, cpu_clock=cpu)
+    assert scanner.begin('http://a/', 'identity') is not None
+    assert scanner.begin('http://a/', 'identity') is None  # 0.5 >= 0.1
+    assert scanner.begin('http://a/', 'identity', sample_rate=0) is None
+
+    def expensive_feed(data):
+        cpu.now += 0.02
+        return b''
+
+    rewriter = HtmlRewriter(['ads.example.com'])
+    rewriter.feed = expensive_feed
+    rewriter.violations = [('https://ads.example.com/a', 'ads.example.com', 'iframe_blocked')]
+    capture = scanner.begin('http://a/', 'identity', sample_rate=1)
+    capture.feed(PAGE)
+    reports = []
+
+    async def run():
+        scanner.submit(capture, rewriter, reports.append)
+        await asyncio.gather(*scanner._tasks)
+    asyncio.run(run())
+    assert reports == []  # Presupuesto agotado: escaneo abandonado
+    assert scanner.begin('http://a/', 'identity', sample_rate=1) is None
+    clock.now += 2  # Se recupera con el tiempo
+    assert scanner.begin('http://a/', 'identity', sample_rate=1) is not None
+
+
+def test_large_pages_are_not_scanned():
+    scanner = ReportOnlyScanner(sample_rate=1, max_scan_bytes=16)
+    capture = scanner.begin('http://a/', 'identity')
+    capture.feed(PAGE)
+    assert capture.truncated and capture.chunks == []
+
+
+def test_deduplication_window(clock):
+    scanner = ReportOnlyScanner(dedupe_window=60, clock=clock)
+    violation = ('https://ads.example.com/a', 'ads.example.com', 'iframe_blocked')
+    assert scanner.deduplicate('http://a/', [violation, violation]) == [violation]
+    assert scanner.deduplicate('http://a/', [violation]) == []
+    assert scanner.deduplicate('http://a/other', [violation]) == [violation]
+    clock.now += 61
+    assert scanner.deduplicate('http://a/', [violation]) == [violation]
+
+
+def test_decompression_is_charged_and_decoded_size_is_capped(clock, make_clock, monkeypatch):
+    from adfree_proxy import report_only
+
+    def scan(scanner, capture):
+        reports = []
+
+        async def run():
+            scanner.submit(capture, HtmlRewriter(['ads.example.com']), reports.append)
+            await asyncio.gather(*scanner._tasks)
+        asyncio.run(run())
+        return reports
+
+    # Una bomba gzip: pocos bytes copiados, muchos al descomprimir
+    bomb = gzip.compress(PAGE + b' ' * (4 * 1024 * 1024))
+    scanner = ReportOnlyScanner(sample_rate=1, max_decoded_bytes=1024 * 1024, clock=clock)
+    capture = scanner.begin('http://a/', 'gzip')
+    capture.feed(bomb)
+    assert not capture.truncated
+    assert scan(scanner, capture) == []
+
+    # Lo que cuesta descomprimir se descuenta del presupuesto aunque el HTML sea barato
+    cpu = make_clock(0.0)
+
+    class SlowDecoder:
+        def __init__(self, encoding):
+            pass
+
+        def decompress(self, data):
+            cpu.now += 0.02
+            yield data
+
+        def flush(self):
+            return b''
+
+    monkeypatch.setattr(report_only, 'StreamDecoder', SlowDecoder)
+    scanner = ReportOnlyScanner(sample_rate=1, cpu_budget=0.01, clock=clock, cpu_clock=cpu)
+    capture = scanner.begin('http://a/', 'gzip')
+    capture.feed(PAGE)
+    assert scan(scanner, capture) == []
+    assert scanner.begin('http://a/', 'gzip') is None
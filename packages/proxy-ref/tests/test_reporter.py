@@ -0,0 +1,108 @@
+import asyncio
+
+from aiohttp import web, ClientSession
+from aiohttp.test_utils import TestServer
+
+from adfree_proxy.reporter import ReportClient
+
+
+async def _sink(received, status=200):
+    async def handler(request):
+        received.append(await request.json())
+        return web.Response(status=status)
+
+    app = web.Application()
+    app.router.add_post('/adfree', handler)
+    server = TestServer(app)
+    await server.start_server()
+    return server, str(server.make_url('/adfree'))
+
+
+def test_reports_are_batched_per_endpoint():
+    async def run():
+        received = []
+        server, url = await _sink(received)
+        session = ClientSession()
+        client = ReportClient(session, batch_size=50, flush_interval=0.05)
+        try:
+            for i in range(120):
+                assert client.enqueue(url, {'type': 'policy_violation', 'n': i})
+            await asyncio.sleep(0.2)
+            await client.close()
+            assert [len(batch) for batch in received] == [50, 50, 20]
+            assert [r['n'] for batch in received for r in batch] == list(range(120))
+        finally:
+            await session.close()
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_buffer_is_bounded_and_drops_oldest():
+    async def run():
+        received = []
+        server, url = await _sink(received)
+        session = ClientSession()
+        client = ReportClient(session, batch_size=1000, flush_interval=60, max_buffer=10)
+        try:
+            for i in range(25):
+                client.enqueue(url, {'n': i})
+            assert len(client._queues[url].buffer) == 10
+            await client.close()
+            assert [r['n'] for batch in received for r in batch] == list(range(15, 25))
+            assert not client.enqueue(url, {'n': 99})
+        finally:
+            await session.close()
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_failed_batches_go_to_spool_without_retrying(tmp_path):
+    from adfree_proxy.spool import ReportSpool
+
+    async def run():
+        received = []
+        server, url = await _sink(received, status=503)
+        session = ClientSession()
+        spool = ReportSpool(str(tmp_path))
+        client = ReportClient(session, batch_size=5, flush_interval=0.05, spool=spool)
+        try:
+            for i in range(5):
+                client.enqueue(url, {'n': i})
+            await asyncio.sleep(0.2)
+            assert len(received) == 1
+            assert spool.size > 0
+            await client.close()
+        finally:
+            await session.close()
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_endpoints_are_capped_and_evicted_ones_are_flushed():
+    async def run():
+        received = []
+        server, url = await _sink(received)
+        session = ClientSession()
+        client = ReportClient(session, batch_size=1000, flush_interval=60, max_endpoints=3)
+        try:
+            urls = [f'{url}?site={i}' for i in range(10)]
+            for i, report_to in enumerate(urls):
+                client.enqueue(report_to, {'n': i})
+                client.enqueue(urls[0], {'n': 0})  # el endpoint más usado se queda
+            assert list(client._queues) == [urls[8], urls[9], urls[0]]
+            # Los expulsados se envían sin esperar a flush_interval
+            for _ in range(100):
+                if len(received) >= 7:
+                    break
+                await asyncio.sleep(0.01)
+            assert sorted(r['n'] for batch in received for r in batch) == list(range(1, 8))
+            await client.close()
+            assert sorted(r['n'] for batch in received for r in batch) == [0] * 11 + list(range(1, 10))
+        finally:
+            await session.close()
+            await server.close()
+
+    asyncio.run(run())
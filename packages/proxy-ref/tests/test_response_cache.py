@@ -0,0 +1,124 @@
+import asyncio
+
+from multidict import CIMultiDict
+
+from adfree_proxy.response_cache import CachedResponse, ResponseCache, response_is_storable
+
+
+def _entry(body, expires_at=100.0):
+    return CachedResponse(200, [('Content-Type', 'text/html'), ('ETag', '"v1"')], body, b'\x01' * 16,
+                          [('https://ads.example.com/x', 'ads.example.com', 'iframe_blocked')], len(body), 0.0, expires_at)
+
+
+def test_storable_responses_follow_cache_control():
+    def storable(**headers):
+        return response_is_storable(200, CIMultiDict(headers))
+
+    assert storable(**{'Cache-Control': 'max-age=60'})
+    assert storable(ETag='"v1"')
+    assert not storable()
+    assert not storable(**{'Cache-Control': 'private, max-age=60'})
+    assert not storable(**{'Cache-Control': 'no-store', 'ETag': '"v1"'})
+    assert not storable(**{'Cache-Control': 'max-age=60', 'Set-Cookie': 'a=b'})
+    assert not storable(**{'Cache-Control': 'max-age=60', 'Vary': 'Cookie'})
+    assert storable(**{'Cache-Control': 'max-age=60', 'Vary': 'Accept-Encoding'})
+
+
+def test_memory_tier_is_bounded_by_bytes():
+    async def run():
+        cache = ResponseCache(max_bytes=3 * 1024 + 3 * 600, clock=lambda: 0.0)
+        for i in range(5):
+            cache.put(f'http://a/{i}', _entry(b'x' * 1024))
+        assert len(cache) <= 3
+        assert await cache.get('http://a/0') is None
+        assert (await cache.get('http://a/4')).body == b'x' * 1024
+
+    asyncio.run(run())
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    async def run():
+        cache = ResponseCache(directory=str(tmp_path), clock=lambda: 0.0)
+        cache.put('http://a/page', _entry(b'<p>cached</p>'))
+        await cache.close()
+
+        restarted = ResponseCache(directory=str(tmp_path), clock=lambda: 0.0)
+        entry = await restarted.get('http://a/page')
+        assert entry.body == b'<p>cached</p>'
+        assert entry.validators() == {'If-None-Match': '"v1"'}
+        assert entry.violations == [('https://ads.example.com/x', 'ads.example.com', 'iframe_blocked')]
+        assert restarted.is_fresh(entry)
+
+    asyncio.run(run())
+
+
+def test_disk_writes_are_ordered_and_invalidate_cancels_pending(tmp_path):
+    async def run():
+        cache = ResponseCache(directory=str(tmp_path), clock=lambda: 0.0)
+        for i in range(20):
+            cache.put('http://a/page', _entry(b'<p>%d</p>' % i))
+        cache.put('http://a/gone', _entry(b'<p>gone</p>'))
+        cache.invalidate('http://a/gone')
+        await cache.close()
+
+        restarted = ResponseCache(directory=str(tmp_path), clock=lambda: 0.0)
+        assert (await restarted.get('http://a/page')).body == b'<p>19</p>'
+        assert await restarted.get('http://a/gone') is None
+        assert sorted(p.name for p in tmp_path.iterdir()) == [ResponseCache._file_name('http://a/page')]
+        await restarted.close()
+
+    asyncio.run(run())
+
+
+def _run_cached_pages(cache_control, signed_headers, start_proxy):
+    from aiohttp import web
+
+    policy_headers = signed_headers({'mode': 'strict', 'blocked_domains': ['ads.example.com']})
+    html = b"<html><body><p>hi</p><iframe src='https://ads.example.com/b'></iframe></body></html>"
+    seen = []
+
+    async def page(request):
+        seen.append(request.headers.get('If-None-Match'))
+        headers = dict(policy_headers, **{'ETag': '"v1"', 'Cache-Control': cache_control})
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=html, content_type='text/html', headers=headers)
+
+    async def run():
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/', page)
+        client, upstream, session, interceptor = await start_proxy(upstream_app, response_cache=ResponseCache())
+        rewrites = []
+        make_rewriter = interceptor._make_rewriter
+
+        def counting_rewriter(policy, origin):
+            rewrites.append(policy)
+            return make_rewriter(policy, origin)
+        interceptor._make_rewriter = counting_rewriter
+        try:
+            bodies = []
+            for _ in range(3):
+                resp = await client.get('/', headers={'Adfree-Want': '1', 'Accept-Encoding': 'gzip'})
+                assert resp.status == 200
+                bodies.append(await resp.read())
+            assert bodies[0] == bodies[1] == bodies[2]
+            assert b'ads.example.com' not in bodies[0]
+            return seen, len(rewrites)
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+
+    return asyncio.run(run())
+
+
+def test_fresh_entry_skips_upstream_and_rewrite(signed_headers, start_proxy):
+    seen, rewrites = _run_cached_pages('max-age=60', signed_headers, start_proxy)
+    assert seen == [None]
+    assert rewrites == 1
+
+
+def test_stale_entry_is_revalidated_with_etag(signed_headers, start_proxy):
+    seen, rewrites = _run_cached_pages('max-age=0', signed_headers, start_proxy)
+    assert seen == [None, '"v1"', '"v1"']
+    assert rewrites == 1
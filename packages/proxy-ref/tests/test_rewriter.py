@@ -0,0 +1,104 @@
+from adfree_proxy.rewriter import HtmlRewriter, REDIRECT_BLOCKER_SCRIPT
+
+PAGE = (
+    b"<html><head><title>t</title></head><body><h1>Hello</h1>"
+    b"<iframe src='https://ads.example.com/banner'><p>ad</p></iframe>"
+    b"<IFRAME width=1 SRC=\"https://cdn.example.org/player\"></IFRAME>"
+    b"<iframe src=https://x.trackers.net/p></iframe>"
+    b"</body></html>"
+)
+
+EXPECTED = (
+    b"<html><head><title>t</title>" + REDIRECT_BLOCKER_SCRIPT + b"</head><body><h1>Hello</h1>"
+    b"<IFRAME width=1 SRC=\"https://cdn.example.org/player\"></IFRAME>"
+    b"</body></html>"
+)
+
+
+def _rewriter():
+    return HtmlRewriter(['ads.example.com', '*.trackers.net'], REDIRECT_BLOCKER_SCRIPT)
+
+
+def test_rewrite_whole_body():
+    rewriter = _rewriter()
+    assert rewriter.rewrite(PAGE) == EXPECTED
+    assert [rule for _, rule, _ in rewriter.violations] == ['ads.example.com', '*.trackers.net']
+
+
+def test_rewrite_tags_split_across_chunks():
+    for size in range(1, 40):
+        rewriter = _rewriter()
+        out = b''.join(rewriter.feed(PAGE[i:i + size]) for i in range(0, len(PAGE), size))
+        out += rewriter.close()
+        assert out == EXPECTED, size
+
+
+def test_inject_without_head_or_body():
+    rewriter = HtmlRewriter(inject_script=REDIRECT_BLOCKER_SCRIPT)
+    assert rewriter.rewrite(b'<p>x</p>') == b'<p>x</p>' + REDIRECT_BLOCKER_SCRIPT
+
+
+def test_pending_stays_bounded_on_large_pages():
+    rewriter = _rewriter()
+    filler = b'<div class="row">' + b'a < b ' * 2000 + b'</div>'
+    total = 0
+    for _ in range(300):
+        total += len(rewriter.feed(filler))
+        assert len(rewriter._pending) < 64 * 1024
+    total += len(rewriter.close())
+    assert total == 300 * len(filler) + len(REDIRECT_BLOCKER_SCRIPT)
+
+
+POLICY_PAGE = (
+    b"<html><head><script src='https://ads.example.com/loader.js'></script>"
+    b"<script>var s = '</body><iframe src=\"https://evil.net/\">';</script></head><body>"
+    b"<iframe src='/local'></iframe>"
+    b"<iframe src='//video.example.net/embed'></iframe>"
+    b"<iframe src='https://other.net/x'><p>x</p></iframe>"
+    b"<ins class='adsbygoogle' data-ad-slot='1'></ins>"
+    b"<div data-ad-slot='2'><div>nested</div><span>ad</span></div>"
+    b"<DIV class=\"box adsbygoogle\"><div><div>deep</div></div></DIV>"
+    b"<img data-ad-unit='4' src='/banner.png'>"
+    b"<p>end</p></body></html>"
+)
+
+POLICY_EXPECTED = (
+    b"<html><head>"
+    b"<script>var s = '</body><iframe src=\"https://evil.net/\">';</script>" + REDIRECT_BLOCKER_SCRIPT + b"</head><body>"
+    b"<iframe src='/local'></iframe>"
+    b"<iframe src='//video.example.net/embed'></iframe>"
+    b"<ins class='adsbygoogle' data-ad-slot='1'></ins>"
+    b"<div data-ad-slot='2'><div>nested</div><span>ad</span></div>"
+    b"<p>end</p></body></html>"
+)
+
+
+def _policy_rewriter():
+    from adfree_proxy.matcher import IframeAllowlist
+
+    return HtmlRewriter(['ads.example.com'], REDIRECT_BLOCKER_SCRIPT,
+                        IframeAllowlist(['self', 'https://*.example.net']), 'news.example.com', 2)
+
+
+def test_single_pass_enforces_whole_policy():
+    for size in (len(POLICY_PAGE), 1, 7, 64):
+        rewriter = _policy_rewriter()
+        out = b''.join(rewriter.feed(POLICY_PAGE[i:i + size]) for i in range(0, len(POLICY_PAGE), size))
+        out += rewriter.close()
+        assert out == POLICY_EXPECTED, size
+        assert [kind for _, _, kind in rewriter.violations] == [
+            'script_blocked', 'iframe_not_allowed', 'ad_limit', 'ad_limit']
+        assert rewriter.ads == 4
+
+
+def test_iframe_allowlist():
+    from adfree_proxy.matcher import IframeAllowlist
+
+    allowlist = IframeAllowlist(['self', 'https://cdn.example.org', '*.example.net'])
+    assert allowlist.allows(None, 'news.example.com')
+    assert allowlist.allows('NEWS.example.com', 'news.example.com')
+    assert allowlist.allows('cdn.example.org', 'news.example.com')
+    assert allowlist.allows('a.b.example.net', 'news.example.com')
+    assert not allowlist.allows('example.org', 'news.example.com')
+    assert not IframeAllowlist([]).allows(None, 'news.example.com')
+    assert IframeAllowlist(['*']).allows('anything.com', 'news.example.com')
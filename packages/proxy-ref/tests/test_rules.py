@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+
+from adfree_proxy.policy import AdfreePolicy
+from adfree_proxy.rules import RuleSet, RuleStore, RulesFile, load_rules_file
+
+
+def _write(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def test_rules_merge_blocked_domains_and_override_fields():
+    rules = RuleSet(RulesFile.model_validate({
+        'blocked_domains': ['*.doubleclick.net'],
+        'origins': {
+            'news.example.com': {'blocked_domains': ['ads.partner.com'], 'allow_redirects': False},
+            '*.example.org': {'mode': 'report-only'},
+        },
+    }), version='v1')
+    policy = AdfreePolicy.model_validate({'mode': 'strict', 'blocked_domains': ['ads.example.com']})
+
+    news = rules.apply('news.example.com:8080', policy)
+    assert news.allow_redirects is False and news.mode == 'strict'
+    assert news.blocked_matcher.match('ads.example.com') == 'ads.example.com'
+    assert news.blocked_matcher.match('x.doubleclick.net') == '*.doubleclick.net'
+    assert news.blocked_matcher.match('ads.partner.com') == 'ads.partner.com'
+    assert rules.apply('news.example.com:8080', policy) is news  # Memoizada
+
+    org = rules.apply('blog.example.org', policy)
+    assert org.mode == 'report-only'
+    assert org.blocked_matcher.match('ads.partner.com') is None
+
+    other = rules.apply('example.net', policy)
+    assert other.blocked_matcher.match('x.doubleclick.net') and other.blocked_matcher.match('ads.example.com')
+    assert other.blocked_matcher.match('ads.partner.com') is None
+    # La política original no cambia
+    assert policy.blocked_domains == ['ads.example.com'] and policy.mode == 'strict'
+    assert policy.blocked_matcher.match('x.doubleclick.net') is None
+
+    assert RuleSet().apply('news.example.com', policy) is policy
+
+
+def test_operator_blocklist_is_compiled_once_and_memo_is_bounded_by_size():
+    rules = RuleSet(RulesFile.model_validate({
+        'blocked_domains': [f'ads{i}.example.com' for i in range(20000)],
+    }), version='v1', max_memo_bytes=64 * 1024)
+    small = AdfreePolicy.model_validate({'mode': 'strict'})
+    effective = rules.apply('a.example', small)
+    # La lista del operador no se copia en cada política efectiva
+    assert effective.blocked_domains == []
+    assert effective.blocked_matcher.match('ads19999.example.com') == 'ads19999.example.com'
+
+    big = AdfreePolicy.model_validate({'mode': 'strict', 'blocked_domains': [f'x{i}.net' for i in range(1000)]})
+    for i in range(100):
+        rules.apply(f'o{i}.example', big)
+    assert rules.memo_bytes <= 64 * 1024 + 1000 * 200
+    assert rules.apply('o99.example', big) is rules.apply('o99.example', big)
+
+
+def test_failed_reload_keeps_previous_rules(tmp_path):
+    path = str(tmp_path / 'rules.json')
+    _write(path, {'blocked_domains': ['ads.one.com']})
+    store = RuleStore(path, poll_interval=0)
+    assert store.load()
+    first = store.current
+    assert first.blocked_domains == ('ads.one.com',)
+
+    with open(path, 'w') as f:
+        f.write('{"origins": {"a.com": {"mode": "lax"}}}')
+    assert not asyncio.run(store.reload())
+    assert store.current is first
+
+    _write(path, {'blocked_domains': ['ads.two.com']})
+    assert asyncio.run(store.reload())
+    assert store.current.blocked_domains == ('ads.two.com',)
+    assert store.current.version != first.version
+
+
+def test_yaml_rules(tmp_path):
+    path = str(tmp_path / 'rules.yaml')
+    with open(path, 'w') as f:
+        f.write('blocked_domains:\n  - ads.yaml.com\norigins:\n  shop.example.com:\n    max_ads_per_page: 0\n')
+    ruleset = load_rules_file(path)
+    assert ruleset.blocked_domains == ('ads.yaml.com',)
+    assert ruleset.rules_for('shop.example.com').max_ads_per_page == 0
+
+
+def test_rules_file_change_is_picked_up(tmp_path):
+    path = str(tmp_path / 'rules.json')
+    _write(path, {'blocked_domains': ['ads.one.com']})
+
+    async def run():
+        store = RuleStore(path, poll_interval=0.02)
+        store.load()
+        reloaded = []
+        store.on_reload.append(reloaded.append)
+        store.start()
+        try:
+            _write(path, {'blocked_domains': ['ads.one.com', 'ads.two.com']})
+            os.utime(path, ns=(0, 1))  # mtime distinto aunque el reloj tenga poca resolución
+            for _ in range(100):
+                if reloaded:
+                    break
+                await asyncio.sleep(0.02)
+        finally:
+            await store.close()
+        return store, reloaded
+
+    store, reloaded = asyncio.run(run())
+    assert reloaded == [store.current]
+    assert store.current.blocked_domains == ('ads.one.com', 'ads.two.com')
+
+
+def test_interceptor_applies_operator_rules(tmp_path):
+    path = str(tmp_path / 'rules.json')
+    _write(path, {'blocked_domains': ['ads.operator.com']})
+    html = (b"<html><body><p>hi</p><iframe src='https://ads.example.com/a'></iframe>"
+            b"<iframe src='https://ads.operator.com/b'></iframe></body></html>")
+
+    async def run():
+        from aiohttp import web
+        from aiohttp.test_utils import TestServer, TestClient
+        from adfree_proxy.interceptor import AdfreeInterceptor
+        from adfree_proxy.upstream import create_upstream_session
+
+        async def page(request):
+            return web.Response(body=html, content_type='text/html')
+
+        upstream_app = web.Application()
+        upstream_app.router.add_get('/', page)
+        upstream = TestServer(upstream_app)
+        await upstream.start_server()
+        session = create_upstream_session()
+        store = RuleStore(path, poll_interval=0)
+        store.load()
+        interceptor = AdfreeInterceptor(session, upstream_url=str(upstream.make_url('')), rules=store)
+
+        async def fake_policy(upstream_resp, origin):
+            return AdfreePolicy.model_validate({'mode': 'strict', 'allow_iframes': ['*'],
+                                                'blocked_domains': ['ads.example.com']})
+        interceptor._policy_from_upstream = fake_policy
+        client = TestClient(TestServer(web.Application(middlewares=[interceptor.intercept_request])))
+        await client.start_server()
+        try:
+            resp = await client.get('/', headers={'Adfree-Want': '1'})
+            first = await resp.read()
+            _write(path, {})
+            await store.reload()
+            resp = await client.get('/', headers={'Adfree-Want': '1'})
+            second = await resp.read()
+        finally:
+            await client.close()
+            await session.close()
+            await upstream.close()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert b'ads.example.com' not in first and b'ads.operator.com' not in first
+    assert b'ads.example.com' not in second and b'ads.operator.com' in second
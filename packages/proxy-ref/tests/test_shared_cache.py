@@ -0,0 +1,147 @@
+import asyncio
+import os
+
+import pytest
+from aiohttp import web
+
+from adfree_proxy.keys import CachedKey, PublicKeyCache
+from adfree_proxy.shared_cache import HEADER_SIZE, KIND_KEY, KIND_POLICY, PROBE, SharedCache, entry_hash
+
+# Reloj de pared plausible: las entradas guardan caducidades absolutas
+NOW = 1_700_000_000.0
+
+
+def test_entries_are_visible_to_other_mappings_until_they_expire(tmp_path, make_clock):
+    clock = make_clock(NOW)
+    path = str(tmp_path / 'shared.cache')
+    writer = SharedCache(path, slots=64, slot_size=256, clock=clock)
+    reader = SharedCache(path, slots=1, slot_size=1, clock=clock)  # Usa el tamaño del fichero existente
+    assert (reader.slots, reader.slot_size) == (64, 256)
+
+    key = entry_hash(KIND_KEY, b'example.com')
+    assert reader.get(KIND_KEY, key) is None
+    assert writer.put(KIND_KEY, key, b'value', clock.now + 10)
+    assert reader.get(KIND_KEY, key) == (b'value', clock.now + 10)
+    assert reader.get(KIND_POLICY, key) is None
+    assert writer.put(KIND_KEY, key, b'other', clock.now + 10)
+    assert reader.get(KIND_KEY, key)[0] == b'other'
+    assert not writer.put(KIND_KEY, key, b'x' * 256, clock.now + 10)  # No cabe en un slot
+    clock.now += 11
+    assert reader.get(KIND_KEY, key) is None
+    writer.close()
+    reader.close()
+
+
+def test_untrusted_files_are_refused(tmp_path):
+    path = str(tmp_path / 'shared.cache')
+    SharedCache(path, slots=64, slot_size=256).close()
+    for mode in (0o620, 0o602):
+        os.chmod(path, mode)
+        with pytest.raises(PermissionError):
+            SharedCache(path)
+    os.chmod(path, 0o600)
+    link = str(tmp_path / 'link.cache')
+    os.symlink(path, link)
+    with pytest.raises(OSError):
+        SharedCache(link)
+    if os.geteuid() == 0:
+        os.chown(path, 12345, -1)
+        with pytest.raises(PermissionError):
+            SharedCache(path)
+
+
+def test_full_window_evicts_soonest_expiring(make_clock):
+    clock = make_clock(NOW)
+    cache = SharedCache(slots=PROBE, slot_size=128, clock=clock)  # Una sola ventana
+    keys = [entry_hash(KIND_KEY, str(i).encode()) for i in range(PROBE + 1)]
+    for i, key in enumerate(keys[:PROBE]):
+        cache.put(KIND_KEY, key, b'v', clock.now + 100 + i)
+    cache.put(KIND_KEY, keys[-1], b'new', clock.now + 50)
+    assert cache.get(KIND_KEY, keys[0]) is None
+    assert all(cache.get(KIND_KEY, key) for key in keys[1:])
+
+
+def test_torn_slots_are_not_returned(make_clock):
+    clock = make_clock(NOW)
+    cache = SharedCache(slots=PROBE, slot_size=128, clock=clock)
+    key = entry_hash(KIND_KEY, b'example.com')
+    cache.put(KIND_KEY, key, b'value', clock.now + 10)
+    offsets = [HEADER_SIZE + i * 128 for i in range(PROBE)]
+    offset = next(o for o in offsets if (cache._read(o) or (0, b''))[1] == key)
+    cache._mm[offset] += 1  # Escritor a mitad: secuencia impar
+    assert cache.get(KIND_KEY, key) is None
+    cache._mm[offset] += 1
+    cache._mm[offset + 44] ^= 0xff  # Valor que no cuadra con su checksum
+    assert cache.get(KIND_KEY, key) is None
+
+
+def test_forked_workers_share_the_mapping():
+    cache = SharedCache(slots=64, slot_size=256)
+    key = entry_hash(KIND_KEY, b'example.com')
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if cache.put(KIND_KEY, key, b'from child', cache.clock() + 60) else 1)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert cache.get(KIND_KEY, key)[0] == b'from child'
+
+
+def test_key_fetched_by_one_process_is_reused_by_another(make_jwk, key_server):
+    calls = []
+    jwk = make_jwk('k1')
+
+    async def handler(request):
+        calls.append(1)
+        return web.json_response(jwk, headers={'Cache-Control': 'max-age=60', 'ETag': '"v1"'})
+
+    async def run():
+        server, template = await key_server(handler)
+        shared = SharedCache(slots=64, slot_size=1024)
+        first = PublicKeyCache(url_template=template, shared=shared)
+        second = PublicKeyCache(url_template=template, shared=shared)
+        try:
+            pem = await first.get('example.com')
+            entry = await second.lookup('example.com')
+            assert entry.pem == pem and entry.key_id == 'k1' and entry.etag == '"v1"'
+            assert 0 < entry.expires_at - second.clock() <= 60
+            assert calls == [1]
+        finally:
+            await server.close()
+
+    asyncio.run(run())
+
+
+def test_cached_key_round_trip():
+    entry = CachedKey(b'-----BEGIN PUBLIC KEY-----\n', 'kid', None, 5.0, 2)
+    copy = CachedKey.from_bytes(entry.to_bytes(), 7.0)
+    assert (copy.pem, copy.key_id, copy.etag, copy.expires_at, copy.failures) == (entry.pem, 'kid', None, 7.0, 2)
+    failed = CachedKey.from_bytes(CachedKey(None, None, None, 1.0, 3).to_bytes(), 1.0)
+    assert failed.pem is None and failed.failures == 3
+
+
+def test_policy_verified_by_one_process_is_not_verified_again(monkeypatch, signed_headers, seeded_key_cache):
+    from adfree_proxy import policy as policy_module
+    from adfree_proxy.policy_cache import VerifiedPolicyCache
+
+    headers = signed_headers({"mode": "strict", "blocked_domains": ["ads.example.com"]})
+    raw, signature = headers['Adfree-Policy'], headers['Adfree-Signature']
+    key_cache = seeded_key_cache('example.com')
+    shared = SharedCache(slots=64, slot_size=128)
+
+    calls = []
+    verify = policy_module.verify_policy_signature
+    monkeypatch.setattr(policy_module, 'verify_policy_signature', lambda *a: calls.append(1) or verify(*a))
+
+    async def run():
+        worker_a = VerifiedPolicyCache(shared=shared)
+        worker_b = VerifiedPolicyCache(shared=shared)
+        assert await policy_module.validate_policy_header(raw, signature, 'example.com', key_cache, worker_a)
+        policy = await policy_module.validate_policy_header(raw, signature, 'example.com', key_cache, worker_b)
+        assert policy is not None and policy.blocked_domains == ['ads.example.com']
+        assert len(calls) == 1
+        # Una firma distinta no se da por verificada
+        forged = await policy_module.validate_policy_header(raw, signature[:-4] + 'AAAA', 'example.com',
+                                                            key_cache, VerifiedPolicyCache(shared=shared))
+        assert forged is None and len(calls) == 2
+
+    asyncio.run(run())
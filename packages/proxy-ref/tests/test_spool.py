@@ -0,0 +1,71 @@
+import asyncio
+
+from adfree_proxy.spool import ReportSpool
+
+
+def test_spool_survives_restart_and_drains_when_endpoint_recovers(tmp_path):
+    up = {'a': False, 'b': True}
+    delivered = []
+
+    async def sender(endpoint, reports):
+        if up[endpoint]:
+            delivered.extend(r['n'] for r in reports)
+        return up[endpoint]
+
+    async def run():
+        spool = ReportSpool(str(tmp_path), segment_size=200, min_backoff=60)
+        for i in range(10):
+            await spool.append('a' if i % 2 else 'b', [{'n': i}])
+        await spool.close()
+
+        # Nueva instancia (reinicio del proxy) sobre el mismo directorio
+        spool = ReportSpool(str(tmp_path), segment_size=200, min_backoff=60)
+        assert spool.size > 0
+        assert await spool.drain_once(sender) == 5
+        assert sorted(delivered) == [0, 2, 4, 6, 8]
+
+        # 'a' sigue en backoff: no se reintenta ni se reescribe
+        up['a'] = True
+        assert await spool.drain_once(sender) == 0
+
+        spool._backoff.clear()
+        assert await spool.drain_once(sender) == 5
+        assert sorted(delivered) == list(range(10))
+        assert spool.size == 0
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_spool_drops_oldest_segments_over_limit(tmp_path):
+    async def run():
+        spool = ReportSpool(str(tmp_path), segment_size=100, max_bytes=500)
+        for i in range(100):
+            await spool.append('a', [{'n': i, 'pad': 'x' * 40}])
+        assert spool.size <= 500
+        assert len(list(tmp_path.iterdir())) <= 6
+        await spool.close()
+
+    asyncio.run(run())
+
+
+def test_steady_failure_does_not_multiply_segments(tmp_path):
+    async def down(endpoint, reports):
+        return False
+
+    async def run():
+        spool = ReportSpool(str(tmp_path), segment_size=10_000, segment_age=60, min_backoff=0)
+        await spool.append('a', [{'n': 1}])
+        # Ni por tamaño ni por edad: el segmento activo no se sella en cada pasada
+        assert await spool.drain_once(down) == 0
+        assert spool._sealed == [] and spool._active_size > 0
+
+        spool._active_opened -= 60
+        for _ in range(5):
+            assert await spool.drain_once(down) == 0
+        # El segmento sellado se reescribe en su sitio con lo pendiente
+        assert [p.name for p in tmp_path.iterdir()] == ['segment-000000000000.ndjson']
+        assert spool.size == (tmp_path / 'segment-000000000000.ndjson').stat().st_size
+        await spool.close()
+
+    asyncio.run(run())
@@ -0,0 +1,44 @@
+import os
+import re
+import subprocess
+import sys
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Lo que el proxy añade al import con asyncio y aiohttp ya cargados (ms). Se
+# toma el mínimo de varias muestras; ADFREE_IMPORT_BUDGET_MS lo ajusta en
+# máquinas más lentas.
+IMPORT_BUDGET_MS = float(os.environ.get('ADFREE_IMPORT_BUDGET_MS', 120))
+
+_IMPORTTIME_RE = re.compile(r'import time:\s+\d+ \|\s+(\d+) \| (\S+)$')
+
+
+def _run(code: str, *flags: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *flags, '-c', code], cwd=PACKAGE_ROOT,
+                          capture_output=True, text=True, check=True)
+
+
+def test_import_does_not_load_heavy_dependencies():
+    result = _run("import sys, adfree_proxy.interceptor, adfree_proxy.main; "
+                  "print(' '.join(sorted({m.split('.')[0] for m in sys.modules})))")
+    loaded = set(result.stdout.split())
+    assert not loaded & {'pydantic', 'pydantic_core', 'cryptography', 'multiprocessing'}
+
+
+def test_heavy_dependencies_load_on_first_use():
+    result = _run("import sys; from adfree_proxy.policy import AdfreePolicy, verify_policy_signature; "
+                  "assert 'pydantic' in sys.modules and 'cryptography' not in sys.modules; "
+                  "verify_policy_signature({'mode': 'strict'}, 'AAAA', b'not a key'); "
+                  "assert 'cryptography' in sys.modules; "
+                  "print(AdfreePolicy.model_validate({'mode': 'strict'}).mode)")
+    assert result.stdout.strip() == 'strict'
+
+
+def test_import_time_budget():
+    samples = []
+    for _ in range(3):
+        stderr = _run('import asyncio, aiohttp, aiohttp.web; import adfree_proxy.interceptor', '-X', 'importtime').stderr
+        [cumulative] = [int(m.group(1)) for m in map(_IMPORTTIME_RE.match, stderr.splitlines())
+                        if m and m.group(2) == 'adfree_proxy.interceptor']
+        samples.append(cumulative / 1000)
+    assert min(samples) <= IMPORT_BUDGET_MS, f'importing adfree_proxy took {min(samples):.1f} ms'
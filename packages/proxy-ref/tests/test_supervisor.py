@@ -0,0 +1,87 @@
+import os
+import queue
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_SERVING_RE = re.compile(r'Worker (\d+) \(pid (\d+)\) serving')
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _wait_stopped(pid: int, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    with open(f'/proc/{pid}/stat') as f:
+        while f.read().rsplit(')', 1)[1].split()[0] != 'T':
+            assert time.monotonic() < deadline, f'worker {pid} did not stop'
+            time.sleep(0.01)
+            f.seek(0)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class _Log:
+    """Líneas de stderr del supervisor, leídas en un hilo para poder esperar con timeout."""
+
+    def __init__(self, stream):
+        self.lines = queue.Queue()
+        threading.Thread(target=lambda: [self.lines.put(line) for line in stream], daemon=True).start()
+
+    def serving(self, count: int, timeout: float = 20.0) -> dict:
+        workers = {}
+        deadline = time.monotonic() + timeout
+        while len(workers) < count:
+            line = self.lines.get(timeout=max(deadline - time.monotonic(), 0.01))
+            m = _SERVING_RE.search(line)
+            if m:
+                workers[int(m.group(1))] = int(m.group(2))
+        return workers
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='--workers needs fork')
+@pytest.mark.skipif(not os.path.exists('/proc/self/stat'), reason='reads process state from /proc')
+def test_supervisor_respawns_and_stops_hung_workers():
+    proc = subprocess.Popen(
+        [sys.executable, '-u', '-m', 'adfree_proxy.main', '--workers', '2', '--port', str(_free_port()),
+         '--shared-cache-slots', '0', '--shutdown-timeout', '0.5', '--loop-lag-interval', '0'],
+        cwd=PACKAGE_ROOT, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+    try:
+        log = _Log(proc.stderr)
+        workers = log.serving(2)
+        assert sorted(workers) == [0, 1]
+
+        # Un worker que muere se reinicia con el mismo id
+        os.kill(workers[0], signal.SIGKILL)
+        respawned = log.serving(1)
+        assert list(respawned) == [0] and respawned[0] != workers[0]
+        workers.update(respawned)
+
+        # Workers colgados no bloquean el apagado: se matan tras el plazo
+        for pid in workers.values():
+            os.kill(pid, signal.SIGSTOP)
+            _wait_stopped(pid)
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=20) == 0
+        assert not any(_alive(pid) for pid in workers.values())
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+import socket
+import ssl
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from adfree_proxy.metrics import TLS_HANDSHAKES
+from adfree_proxy.tls import CertificateStore, TLSSite, UpstreamTLS
+
+
+def write_cert(directory, filename, names):
+    """Certificado autofirmado con certificado y clave en un único PEM."""
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, names[0])])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(subject).issuer_name(subject)
+            .public_key(key.public_key()).serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(n) for n in names]), critical=False)
+            .sign(key, hashes.SHA256()))
+    path = directory / filename
+    path.write_bytes(cert.public_bytes(serialization.Encoding.PEM) + key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    return str(path)
+
+
+def make_store(tmp_path):
+    certs = tmp_path / 'certs'
+    certs.mkdir()
+    write_cert(certs, 'a.pem', ['a.test'])
+    write_cert(certs, 'b.pem', ['*.b.test', 'b.test'])
+    (certs / 'notes.txt').write_text('ignored')
+    store = CertificateStore()
+    default = write_cert(tmp_path, 'default.pem', ['default.test'])
+    store.add(default, default=True)
+    assert store.load_directory(str(certs)) == 2
+    return store
+
+
+def handshake_count(result):
+    return TLS_HANDSHAKES.labels(result=result)._value.get()
+
+
+def test_sni_selects_certificate(tmp_path):
+    store = make_store(tmp_path)
+    a = store.context_for('a.test')
+    assert a is not None and a is not store.default
+    assert store.context_for('A.TEST.') is a
+    wild = store.context_for('www.b.test')
+    assert wild is not None and wild is not a
+    assert store.context_for('b.test') is wild
+    assert store.context_for('x.www.b.test') is None  # El comodín cubre una sola etiqueta
+    assert store.context_for('c.test') is None
+    assert store.context_for(None) is None
+
+
+def test_terminates_tls_and_resumes_sessions(tmp_path):
+    from aiohttp import web
+
+    store = make_store(tmp_path)
+
+    client_ctx = ssl.create_default_context()
+    client_ctx.check_hostname = False
+    client_ctx.verify_mode = ssl.CERT_NONE
+
+    def client(server_name, port, session=None):
+        with socket.create_connection(('127.0.0.1', port)) as raw:
+            with client_ctx.wrap_socket(raw, server_hostname=server_name, session=session) as tls:
+                tls.sendall(f'GET / HTTP/1.1\r\nHost: {server_name}\r\nConnection: close\r\n\r\n'.encode())
+                # Leer hasta el cierre: el ticket de TLS 1.3 llega tras el handshake
+                data = b''
+                while chunk := tls.recv(4096):
+                    data += chunk
+                cert = x509.load_der_x509_certificate(tls.getpeercert(binary_form=True))
+                san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+                return data, san.value.get_values_for_type(x509.DNSName), tls.session, tls.session_reused
+
+    async def run():
+        async def hello(request):
+            return web.Response(text=f'hello {request.scheme}')
+
+        app = web.Application()
+        app.router.add_get('/', hello)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        sock = socket.create_server(('127.0.0.1', 0))
+        site = TLSSite(runner, sock, store)
+        await site.start()
+        port = sock.getsockname()[1]
+        loop = asyncio.get_running_loop()
+        try:
+            first = await loop.run_in_executor(None, client, 'www.b.test', port)
+            second = await loop.run_in_executor(None, client, 'www.b.test', port, first[2])
+            unknown = await loop.run_in_executor(None, client, 'c.test', port)
+            return first, second, unknown
+        finally:
+            await runner.cleanup()
+
+    full, resumed = handshake_count('full'), handshake_count('resumed')
+    first, second, unknown = asyncio.run(run())
+    assert first[0].endswith(b'hello https') and first[1] == ['*.b.test', 'b.test']
+    assert not first[3]
+    assert second[0].endswith(b'hello https') and second[3]
+    assert unknown[1] == ['default.test']
+    assert handshake_count('full') == full + 2
+    assert handshake_count('resumed') == resumed + 1
+
+
+def test_upstream_contexts_are_reused(tmp_path):
+    cas = tmp_path / 'cas'
+    cas.mkdir()
+    write_cert(cas, 'internal.test.pem', ['internal.test'])
+    upstream_tls = UpstreamTLS(ca_dir=str(cas))
+    internal = upstream_tls.context_for('internal.test')
+    assert internal is not upstream_tls.default
+    assert upstream_tls.context_for('internal.test') is internal
+    assert upstream_tls.context_for('public.test') is upstream_tls.default
+    assert UpstreamTLS().context_for('internal.test') is not None
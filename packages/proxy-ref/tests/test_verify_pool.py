@@ -0,0 +1,27 @@
+import asyncio
+
+from adfree_proxy.verify_pool import SignatureVerifier
+
+
+def _check(mode, sign, pem):
+    policies = [{'mode': 'strict', 'max_ads_per_page': i} for i in range(10)]
+    signatures = [sign(p) for p in policies]
+    signatures[3] = signatures[4]  # firma de otra política
+
+    async def run():
+        verifier = SignatureVerifier(mode, max_workers=2, max_pending=4, max_batch=4)
+        try:
+            return await asyncio.gather(*(verifier.verify(p, s, pem) for p, s in zip(policies, signatures)))
+        finally:
+            verifier.close()
+
+    results = asyncio.run(run())
+    assert results == [i != 3 for i in range(10)]
+
+
+def test_thread_pool_verifies_in_batches(sign, public_pem):
+    _check('thread', sign, public_pem())
+
+
+def test_process_pool_verifies(sign, public_pem):
+    _check('process', sign, public_pem())
@@ -0,0 +1,77 @@
+# tools/report_loadgen.py
+
+"""
+Generador de carga para tools/report_server.py.
+
+Envía lotes de reportes con concurrencia fija durante un tiempo y mide los
+reportes/segundo sostenidos. Ejemplo:
+
+    python tools/report_server.py --ingest-dir /tmp/reports &
+    python tools/report_loadgen.py --url http://127.0.0.1:8089/adfree --batch 50 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+
+def make_batch(batch_size: int, seq: int):
+    return [{
+        "version": "1.0",
+        "generated_at": time.time(),
+        "type": "policy_violation",
+        "policy_mode": "report-only",
+        "violation": {"type": "blocked_iframe", "url": f"https://ads.example.com/{seq}-{i}",
+                      "domain": "ads.example.com", "action": "blocked"},
+    } for i in range(batch_size)]
+
+
+async def worker(session, url, batch_size, deadline, stats):
+    seq = 0
+    while time.monotonic() < deadline:
+        payload = make_batch(batch_size, seq) if batch_size > 1 else make_batch(1, seq)[0]
+        seq += 1
+        try:
+            async with session.post(url, json=payload) as resp:
+                await resp.read()
+                if resp.status in (200, 202):
+                    stats["reports"] += batch_size
+                    stats["requests"] += 1
+                elif resp.status == 503:
+                    stats["rejected"] += 1
+                else:
+                    stats["errors"] += 1
+        except aiohttp.ClientError:
+            stats["errors"] += 1
+
+
+async def run(args):
+    stats = {"reports": 0, "requests": 0, "rejected": 0, "errors": 0}
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.monotonic()
+        deadline = start + args.duration
+        await asyncio.gather(*(worker(session, args.url, args.batch, deadline, stats)
+                               for _ in range(args.concurrency)))
+        elapsed = time.monotonic() - start
+
+    stats.update({
+        "duration_s": round(elapsed, 2),
+        "batch_size": args.batch,
+        "concurrency": args.concurrency,
+        "reports_per_s": round(stats["reports"] / elapsed, 1),
+        "requests_per_s": round(stats["requests"] / elapsed, 1),
+    })
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8089/adfree')
+    parser.add_argument('--batch', type=int, default=50, help='Reportes por petición (1 = sin array)')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0, help='Segundos de carga')
+    asyncio.run(run(parser.parse_args()))
@@ -1,7 +1,12 @@
 # tools/report_server.py
 
+import argparse
 import asyncio
+import gzip
 import logging
+import os
+import time
+from collections import deque
 from aiohttp import web
 import json
 
@@ -39,15 +44,220 @@ async def health_check(request):
     """Endpoint de salud para verificar que el servidor está vivo."""
     return web.json_response({"status": "healthy"}, status=200)
 
-def create_app():
+
+class RateMeter:
+    """Reportes/segundo sobre una ventana deslizante de cubos de 1 s."""
+
+    def __init__(self, window: int = 10):
+        self.window = window
+        self._buckets = deque()  # (segundo, cuenta)
+
+    def add(self, count: int):
+        now = int(time.monotonic())
+        if self._buckets and self._buckets[-1][0] == now:
+            self._buckets[-1][1] += count
+        else:
+            self._buckets.append([now, count])
+        self._trim(now)
+
+    def _trim(self, now: int):
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+
+    def rate(self) -> float:
+        self._trim(int(time.monotonic()))
+        return sum(c for _, c in self._buckets) / self.window
+
+
+class IngestWriter:
+    """
+    Escritor de reportes en ficheros NDJSON rotativos (opcionalmente gzip).
+
+    Los handlers encolan líneas ya serializadas; una tarea en segundo plano
+    las agrupa y las escribe en un hilo, así el loop nunca espera al disco.
+    La cola está acotada: si se llena, el handler responde 503.
+
+    No se hace flush por escritura (con gzip cerraría un bloque deflate cada
+    vez): se vacía cada flush_interval segundos sin escrituras y al rotar.
+    rotate_bytes cuenta bytes en disco, comprimidos si se usa gzip.
+    """
+
+    def __init__(self, directory: str, rotate_bytes: int = 64 * 1024 * 1024,
+                 compress: bool = False, queue_size: int = 10000, max_write_bytes: int = 1024 * 1024,
+                 flush_interval: float = 1.0):
+        self.directory = directory
+        self.rotate_bytes = rotate_bytes
+        self.compress = compress
+        self.max_write_bytes = max_write_bytes
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.pending_reports = 0
+        self.ingested = 0
+        self.bytes_written = 0
+        self.rate = RateMeter()
+        self._file = None
+        self._file_path = None
+        self._file_bytes = 0
+        self._dirty = False
+        self._seq = 0
+        self._task = None
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, lines) -> bool:
+        try:
+            self.queue.put_nowait(lines)
+        except asyncio.QueueFull:
+            return False
+        self.pending_reports += len(lines)
+        self.ingested += len(lines)
+        self.rate.add(len(lines))
+        return True
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            await self.queue.join()
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.get_running_loop().run_in_executor(None, self._close_file)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                batches = [await asyncio.wait_for(self.queue.get(), self.flush_interval)]
+            except asyncio.TimeoutError:
+                # Sin escrituras durante flush_interval: lo escrito llega al disco
+                if self._dirty:
+                    await loop.run_in_executor(None, self._flush)
+                continue
+            size = sum(len(line) for line in batches[0])
+            while size < self.max_write_bytes and not self.queue.empty():
+                batches.append(self.queue.get_nowait())
+                size += sum(len(line) for line in batches[-1])
+            data = b''.join(line for batch in batches for line in batch)
+            try:
+                await loop.run_in_executor(None, self._write, data)
+            except Exception as e:
+                logger.error(f"❌ Error escribiendo reportes: {e}")
+            finally:
+                for batch in batches:
+                    self.pending_reports -= len(batch)
+                    self.queue.task_done()
+
+    def _open_file(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        suffix = '.ndjson.gz' if self.compress else '.ndjson'
+        self._file_path = os.path.join(self.directory, f"reports-{stamp}-{self._seq:05d}{suffix}")
+        self._seq += 1
+        if self.compress:
+            self._file = gzip.open(self._file_path, 'ab', compresslevel=6)
+        else:
+            self._file = open(self._file_path, 'ab', buffering=1024 * 1024)
+        self._file_bytes = 0
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._dirty = False
+
+    def _flush(self):
+        if self._file is not None:
+            self._file.flush()
+            self._dirty = False
+
+    def _write(self, data: bytes):
+        if self._file is None:
+            self._open_file()
+        self._file.write(data)
+        self._dirty = True
+        self.bytes_written += len(data)
+        # Tamaño en disco: con gzip, lo que ya salió del compresor
+        self._file_bytes = self._file.fileobj.tell() if self.compress else self._file.tell()
+        if self._file_bytes >= self.rotate_bytes:
+            self._close_file()
+
+    def stats(self):
+        return {
+            "ingested_total": self.ingested,
+            "ingest_rate_per_s": round(self.rate.rate(), 1),
+            "queue_depth": self.queue.qsize(),
+            "pending_reports": self.pending_reports,
+            "bytes_written": self.bytes_written,
+            "current_file": self._file_path,
+        }
+
+
+def _valid_report(report) -> bool:
+    return isinstance(report, dict) and isinstance(report.get("type"), str)
+
+
+async def handle_ingest(request):
+    """Ingesta: acepta un reporte o un array JSON de reportes y los encola para disco."""
+    writer = request.app["writer"]
+    try:
+        data = json.loads(await request.read())
+    except ValueError:
+        return web.json_response({"error": "Invalid JSON"}, status=400)
+
+    reports = data if isinstance(data, list) else [data]
+    if not reports or not all(_valid_report(r) for r in reports):
+        return web.json_response({"error": "Invalid report"}, status=400)
+
+    lines = [json.dumps(r, separators=(',', ':'), ensure_ascii=False).encode('utf-8') + b'\n' for r in reports]
+    if not writer.submit(lines):
+        return web.json_response({"error": "Ingest queue full"}, status=503, headers={"Retry-After": "1"})
+    return web.json_response({"status": "received", "count": len(reports)}, status=202)
+
+
+async def handle_stats(request):
+    return web.json_response(request.app["writer"].stats())
+
+
+def create_app(ingest_dir=None, compress=False, rotate_mb=64, queue_size=10000):
+    """
+    Sin ingest_dir, los reportes solo se registran en el log (modo desarrollo).
+    Con ingest_dir, se guardan en NDJSON rotativo y se expone GET /stats.
+    """
     app = web.Application()
-    app.router.add_post('/adfree', handle_report)
     app.router.add_get('/health', health_check)
+
+    if ingest_dir is None:
+        app.router.add_post('/adfree', handle_report)
+        return app
+
+    app["writer"] = IngestWriter(ingest_dir, rotate_bytes=rotate_mb * 1024 * 1024,
+                                 compress=compress, queue_size=queue_size)
+
+    async def start_writer(app):
+        app["writer"].start()
+
+    async def stop_writer(app):
+        await app["writer"].stop()
+
+    app.on_startup.append(start_writer)
+    app.on_cleanup.append(stop_writer)
+    app.router.add_post('/adfree', handle_ingest)
+    app.router.add_get('/stats', handle_stats)
     return app
 
 if __name__ == '__main__':
-    app = create_app()
-    logger.info("🚀 Servidor de reportes Adfree escuchando en http://127.0.0.1:8089")
+    parser = argparse.ArgumentParser(description="Servidor de reportes Adfree")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--ingest-dir', default=None, help='Guardar reportes en NDJSON en este directorio')
+    parser.add_argument('--gzip', action='store_true', help='Comprimir los ficheros de ingesta')
+    parser.add_argument('--rotate-mb', type=int, default=64, help='Tamaño de rotación de ficheros (MB)')
+    parser.add_argument('--queue-size', type=int, default=10000, help='Peticiones encoladas antes de responder 503')
+    args = parser.parse_args()
+
+    app = create_app(args.ingest_dir, args.gzip, args.rotate_mb, args.queue_size)
+    logger.info(f"🚀 Servidor de reportes Adfree escuchando en http://{args.host}:{args.port}")
     logger.info("   POST /adfree para recibir reportes")
     logger.info("   GET  /health para chequeo de salud")
-    web.run_app(app, host='127.0.0.1', port=8089)
+    if args.ingest_dir:
+        logger.info(f"   Ingesta en {args.ingest_dir}; GET /stats para estadísticas")
+    web.run_app(app, host=args.host, port=args.port)
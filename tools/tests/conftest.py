@@ -0,0 +1,5 @@
+import os
+import sys
+
+# tools/ no es un paquete: los scripts se importan por nombre
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,89 @@
+import asyncio
+import glob
+import gzip
+import json
+import os
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from report_server import IngestWriter, create_app
+
+
+def _read_ndjson(directory):
+    lines = []
+    for path in sorted(glob.glob(os.path.join(directory, '*'))):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rb') as f:
+            lines.extend(json.loads(line) for line in f.read().splitlines())
+    return lines
+
+
+def test_ingest_writes_ndjson_and_stats(tmp_path):
+    async def run():
+        client = TestClient(TestServer(create_app(str(tmp_path))))
+        await client.start_server()
+        try:
+            resp = await client.post('/adfree', json={'type': 'ad-blocked', 'n': 0})
+            assert resp.status == 202
+            resp = await client.post('/adfree', json=[{'type': 'ad-blocked', 'n': i} for i in (1, 2)])
+            assert resp.status == 202 and (await resp.json())['count'] == 2
+            assert (await client.post('/adfree', data=b'not json')).status == 400
+            assert (await client.post('/adfree', json=[{'n': 3}])).status == 400
+
+            writer = client.server.app['writer']
+            await writer.queue.join()
+            stats = await (await client.get('/stats')).json()
+            assert stats['ingested_total'] == 3
+            assert stats['queue_depth'] == 0 and stats['pending_reports'] == 0
+            assert stats['current_file'].startswith(str(tmp_path))
+            assert stats['bytes_written'] > 0
+        finally:
+            await client.close()
+
+    asyncio.run(run())
+    assert [r['n'] for r in _read_ndjson(str(tmp_path))] == [0, 1, 2]
+
+
+def test_idle_writer_flushes_to_disk(tmp_path):
+    async def run():
+        writer = IngestWriter(str(tmp_path), flush_interval=0.05)
+        writer.start()
+        try:
+            writer.submit([b'{"type":"x"}\n'])
+            await writer.queue.join()
+            await asyncio.sleep(0.2)
+            # Sin cerrar el fichero, lo escrito ya está en disco
+            assert _read_ndjson(str(tmp_path)) == [{'type': 'x'}]
+        finally:
+            await writer.stop()
+
+    asyncio.run(run())
+
+
+def test_gzip_rotation_counts_compressed_bytes(tmp_path):
+    rotate_bytes = 64 * 1024
+    reports = [json.dumps({'type': 'ad-blocked', 'n': i, 'pad': os.urandom(1024).hex()}).encode() + b'\n'
+               for i in range(400)]
+
+    async def run():
+        writer = IngestWriter(str(tmp_path), rotate_bytes=rotate_bytes, compress=True, max_write_bytes=4096)
+        writer.start()
+        for line in reports:
+            assert writer.submit([line])
+            await asyncio.sleep(0)
+        await writer.stop()
+        return writer
+
+    writer = asyncio.run(run())
+    files = glob.glob(os.path.join(str(tmp_path), '*.gz'))
+    assert len(files) > 1
+    # Se rota por tamaño comprimido, no por bytes de NDJSON sin comprimir
+    assert writer.bytes_written > rotate_bytes * len(files)
+    assert all(os.path.getsize(path) < rotate_bytes * 2 for path in files)
+    assert [r['n'] for r in _read_ndjson(str(tmp_path))] == list(range(400))
+
+
+def test_full_queue_is_rejected(tmp_path):
+    writer = IngestWriter(str(tmp_path), queue_size=1)
+    assert writer.submit([b'{"type":"x"}\n'])
+    assert not writer.submit([b'{"type":"x"}\n'])